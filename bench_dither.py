@@ -0,0 +1,38 @@
+"""
+Measures how fast screenshots are palettized with each dithering method, in megapixels per second.
+
+    python bench_dither.py [width] [height]
+"""
+
+import sys
+import time
+import numpy as np
+from colorgrade_core import *
+
+palette = [parse_color(c) for c in '000000; 5F574F; C2C3C7; FFF1E8; FF004D; FFA300; FFEC27; 00E436; 29ADFF; 83769C'.split('; ')]
+
+def best_time(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 960
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 540
+    # A smooth gradient, where banding is most visible
+    y, x = np.mgrid[0:height, 0:width]
+    screenshot = stack_rgb(x / width, y / height, 0.5 + 0.5 * np.sin(x / 97 + y / 53))
+
+    megapixels = width * height / 1e6
+    print(f"{width}x{height}, {len(palette)} colors; best of 3")
+    for method in ['none', 'ordered', 'diffusion']:
+        for mode in [None, 'oklab']:
+            t, result = best_time(lambda: dither_palettize(screenshot, palette, method=method, mode=mode))
+            error = np.abs(result.mean(axis=(0,1)) - screenshot.mean(axis=(0,1))).max()
+            print(
+                f"{method:<10}{mode or 'rgb':<7}{1000 * t:9.1f} ms {megapixels / t:8.2f} MP/s"
+                f"   mean color off by {255 * error:5.2f}/255"
+            )
@@ -0,0 +1,56 @@
+"""
+Compares running chains of pointwise steps one step at a time and fused into one kernel,
+checking that the final colorgrades are identical.
+
+    python bench_fusion.py [size]
+"""
+
+import sys
+import time
+import numpy as np
+from colorgrade_engine import create_steps, run_pipeline
+
+pipelines = {
+    'recolor chain': [
+        ('8-value-recolor', {'red': 'E04020', 'blue': '2040A0', 'which-step': '0'}),
+        ('adjust-rgb', {'r-shift': '0.05', 'g-shift': '0', 'b-shift': '-0.05'}),
+        ('brightness-contrast', {'bright-shift': '0.05', 'con-shift': '0.2'}),
+        ('simple-recolor', {'black': '101018', 'white': 'F8F0E0'}),
+    ],
+    'hsv + custom + palettize': [
+        ('adjust-hsv', {'h-shift': '20', 's-shift': '0.1', 'v-shift': '0'}),
+        ('custom', {'new-r': 'r**0.9', 'new-g': 'g', 'new-b': 'b*0.9+0.05'}),
+        ('palettize', {'colors': '000000; 5F574F; C2C3C7; FFF1E8; FF004D; FFA300; FFEC27; 00E436; 29ADFF'}),
+    ],
+    'chain with a read-back': [
+        ('adjust-rgb', {'r-shift': '0.1', 'g-shift': '0', 'b-shift': '0'}),
+        ('adjust-hsv', {'h-shift': '-15', 's-shift': '0', 'v-shift': '0'}),
+        ('simple-recolor', {'black': '200000', 'white': 'FFFFFF'}),
+        ('if-else', {'condition': 'r > g', 'cond-input': '0', 'true-input': '1', 'false-input': '3'}),
+    ],
+}
+
+def best_time(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    print(f"size {size}, times in ms (best of 3)")
+
+    for name, ser_list in pipelines.items():
+        steps = create_steps(ser_list)
+        t_steps, by_step = best_time(lambda: run_pipeline(steps, size, tiled=False, parallel=False))
+        t_fused, fused = best_time(lambda: run_pipeline(steps, size, fuse=True, parallel=False))
+
+        n_skipped = sum(cg is None for cg in fused)
+        same = np.array_equal(by_step[-1], fused[-1])
+        print(
+            f"{name:<28}step by step {1000 * t_steps:8.1f}   fused {1000 * t_fused:8.1f}"
+            f"   speedup {t_steps / t_fused:5.2f}x   {n_skipped} intermediates skipped"
+            f"   {'identical' if same else 'MISMATCH'}"
+        )
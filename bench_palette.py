@@ -0,0 +1,54 @@
+"""
+Compares running steps after a palettizing step on every color and on the palette only,
+checking that the final colorgrades are identical.
+
+    python bench_palette.py [size]
+"""
+
+import sys
+import time
+import numpy as np
+from colorgrade_engine import create_steps, run_pipeline
+
+pipelines = {
+    'palettize + recolor chain': [
+        ('palettize', {'colors': '000000; 5F574F; C2C3C7; FFF1E8; FF004D; FFA300; FFEC27; 00E436; 29ADFF'}),
+        ('adjust-hsv', {'h-shift': '20', 's-shift': '0.1', 'v-shift': '0'}),
+        ('custom', {'new-r': 'r**0.9', 'new-g': 'g', 'new-b': 'b*0.9+0.05'}),
+        ('brightness-contrast', {'bright-shift': '0.05', 'con-shift': '0.2'}),
+    ],
+    'reduce colors + adjust': [
+        ('reduce-colors', {'n-colors': '16', 'seed': '97187', 'which-step': '0'}),
+        ('adjust-rgb', {'r-shift': '0.05', 'g-shift': '0', 'b-shift': '-0.05'}),
+        ('simple-recolor', {'black': '101018', 'white': 'F8F0E0'}),
+    ],
+    'palettize twice': [
+        ('adjust-hsv', {'h-shift': '-15', 's-shift': '0', 'v-shift': '0'}),
+        ('palettize', {'colors': '000000; 404040; 808080; C0C0C0; FFFFFF; FF0000; 00FF00; 0000FF'}),
+        ('adjust-hsv', {'h-shift': '30', 's-shift': '0', 'v-shift': '0'}),
+        ('palettize', {'colors': '000000; FFFFFF; FF004D; 29ADFF'}),
+    ],
+}
+
+def best_time(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    print(f"size {size}, times in ms (best of 3)")
+
+    for name, ser_list in pipelines.items():
+        steps = create_steps(ser_list)
+        t_full, full = best_time(lambda: run_pipeline(steps, size, fuse=True, parallel=False))
+        t_palette, palette = best_time(lambda: run_pipeline(steps, size, fuse=True, parallel=False, compress=True))
+
+        same = np.array_equal(full[-1], palette[-1])
+        print(
+            f"{name:<28}all colors {1000 * t_full:8.1f}   palette {1000 * t_palette:8.1f}"
+            f"   speedup {t_full / t_palette:5.2f}x   {'identical' if same else 'MISMATCH'}"
+        )
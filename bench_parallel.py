@@ -0,0 +1,60 @@
+"""
+Compares running pipelines with independent branches serially and on a thread pool,
+checking that both give exactly the same colorgrades.
+
+    python bench_parallel.py [size] [repeats]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from colorgrade_engine import create_steps, run_pipeline
+
+# Each pipeline has several branches from the starting colorgrade, merged by If-Else steps
+pipelines = {
+    'two recolors, merged': [
+        ('adjust-hsv', {'h-shift': '40', 's-shift': '0.2', 'v-shift': '0', 'which-step': '0'}),
+        ('palettize', {'colors': '101020; 405080; A0C0E0; F0E0C0', 'which-step': '0'}),
+        ('if-else', {'condition': 'r > 0.5', 'cond-input': '0', 'true-input': '1', 'false-input': '2'}),
+    ],
+    'three branches': [
+        ('reduce-colors', {'n-colors': '24', 'seed': '5', 'which-step': '0'}),
+        ('adjust-rgb', {'r-shift': '0.1', 'g-shift': '-0.05', 'b-shift': '0', 'which-step': '0'}),
+        ('custom', {'new-r': 'g', 'new-g': 'b', 'new-b': 'r', 'which-step': '0'}),
+        ('palettize', {'colors': '000000; 808080; FFFFFF', 'which-step': '1'}),
+        ('if-else', {'condition': 'g > b', 'cond-input': '0', 'true-input': '2', 'false-input': '3'}),
+        ('if-else', {'condition': 'r+g+b > 1.5', 'cond-input': '0', 'true-input': '4', 'false-input': '5'}),
+    ],
+    'two chains': [
+        ('adjust-hsv', {'h-shift': '-30', 's-shift': '0', 'v-shift': '0.1', 'which-step': '0'}),
+        ('reduce-colors', {'n-colors': '16', 'seed': '1', 'which-step': '-1'}),
+        ('brightness-contrast', {'bright-shift': '0.1', 'con-shift': '0.2', 'which-step': '0'}),
+        ('reduce-colors', {'n-colors': '16', 'seed': '2', 'which-step': '-1'}),
+        ('if-else', {'condition': 'b > 0.5', 'cond-input': '0', 'true-input': '2', 'false-input': '4'}),
+    ],
+}
+
+def best_time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 48
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    print(f"size {size}, {os.cpu_count()} cpus, best of {repeats}")
+
+    for name, ser_list in pipelines.items():
+        steps = create_steps(ser_list)
+        t_serial, serial = best_time(lambda: run_pipeline(steps, size, parallel=False), repeats)
+        t_parallel, parallel = best_time(lambda: run_pipeline(steps, size, parallel=True), repeats)
+
+        same = all(np.array_equal(a, b) for a, b in zip(serial, parallel))
+        print(
+            f"{name:<24}serial {1000 * t_serial:8.1f} ms   parallel {1000 * t_parallel:8.1f} ms"
+            f"   speedup {t_serial / t_parallel:5.2f}x   {'identical' if same else 'MISMATCH'}"
+        )
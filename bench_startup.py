@@ -0,0 +1,72 @@
+"""
+Measures where the page's startup time goes, without a browser.
+The `js` and `pyscript` modules are replaced by stand-ins that accept any use,
+so this only covers the Python side (imports and `setup_page`), not loading Pyodide itself.
+
+    python bench_startup.py
+"""
+
+import sys
+import time
+import types
+
+class FakeJsObject:
+    """
+    Stands in for any javascript object: every attribute and call gives another one
+    """
+    def __init__(self, name='js'):
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = FakeJsObject(f'{self._name}.{name}')
+        setattr(self, name, value)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return FakeJsObject(f'{self._name}()')
+
+    def __len__(self):
+        return 0
+
+    def __getitem__(self, key):
+        return ''
+
+def install_fake_modules():
+    """
+    Puts fake `js`, `pyscript` and `pyscript.ffi` modules into `sys.modules`
+    """
+    js = types.ModuleType('js')
+    root = FakeJsObject()
+    js.__getattr__ = lambda name: getattr(root, name)
+
+    pyscript = types.ModuleType('pyscript')
+    pyscript.when = lambda event, selector: (lambda fn: fn)
+    ffi = types.ModuleType('pyscript.ffi')
+    ffi.create_proxy = lambda fn: fn
+    ffi.to_js = lambda obj, **kwargs: obj
+    pyscript.ffi = ffi
+
+    sys.modules.update({'js': js, 'pyscript': pyscript, 'pyscript.ffi': ffi})
+
+def timed(label, fn, timings):
+    start = time.perf_counter()
+    result = fn()
+    timings.append((label, time.perf_counter() - start))
+    return result
+
+if __name__ == '__main__':
+    install_fake_modules()
+    timings = []
+
+    timed('import numpy', lambda: __import__('numpy'), timings)
+    timed('import colorgrade_core', lambda: __import__('colorgrade_core'), timings)
+    timed('import colorgrade_steps', lambda: __import__('colorgrade_steps'), timings)
+    gen = timed('import colorgrade_gen', lambda: __import__('colorgrade_gen'), timings)
+    timed('setup_page()', gen.setup_page, timings)
+
+    total = sum(t for _, t in timings)
+    for label, t in timings:
+        print(f"{label:<28}{1000 * t:8.2f} ms")
+    print(f"{'startup total':<28}{1000 * total:8.2f} ms")
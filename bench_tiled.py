@@ -0,0 +1,67 @@
+"""
+Measures how tiled execution scales with the number of worker threads,
+for single steps on a large colorgrade and for grading a screenshot-sized image.
+Also checks that the tiled results are identical to processing everything at once.
+
+    python bench_tiled.py [size] [max workers]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from colorgrade_core import *
+from colorgrade_engine import create_steps, run_step_tiled, apply_tiled
+
+steps = {
+    '8-value recolor': ('8-value-recolor', {'red': 'FF8000', 'blue': '2040A0'}),
+    'adjust rgb': ('adjust-rgb', {'r-shift': '0.1', 'b-shift': '-0.05'}),
+    'adjust hsv': ('adjust-hsv', {'h-shift': '30', 's-shift': '0.1'}),
+    'custom': ('custom', {'new-r': 'g*b', 'new-g': 'r**0.5', 'new-b': 'b'}),
+    'palettize': ('palettize', {'colors': '000000; 5F574F; C2C3C7; FFF1E8; FF004D; FFA300; FFEC27; 00E436; 29ADFF; 83769C'}),
+    'recenter (reduction)': ('recenter-colors', {}),
+    'reduce colors (reduction)': ('reduce-colors', {'n-colors': '16'}),
+}
+
+def best_time(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    worker_counts = list(range(1, max_workers + 1))
+
+    cg = get_default_colorgrade(size)
+    screenshot = np.random.RandomState(0).random_sample((1080, 1920, 3))
+    graded = linear_recolor(cg, [parse_color(c) for c in ['102030', 'F0E0D0', 'C03020', '40A040', '2040C0', 'E0C040', 'A040A0', '40C0C0']])
+
+    cases = dict()
+    for name, (step_type, params) in steps.items():
+        step = create_steps([(step_type, {**params, 'which-step': '0'})])[0]
+        cases[f'{name} {size}^3'] = (
+            lambda step=step: step.do_processing([cg]),
+            lambda pool, step=step: run_step_tiled(step, [cg], pool=pool),
+        )
+    cases['apply to 1920x1080 image'] = (
+        lambda: apply_colorgrade(graded, screenshot),
+        lambda pool: apply_tiled(lambda colors: apply_colorgrade(graded, colors), screenshot, pool=pool),
+    )
+
+    print(f"{os.cpu_count()} cpus; times in ms (best of 3), speedup relative to processing all at once")
+    print(f"{'':<32}{'all at once':>12}" + ''.join(f"{f'{n} thread' + ('s' if n > 1 else ''):>18}" for n in worker_counts))
+
+    for name, (whole, tiled) in cases.items():
+        t_whole, expected = best_time(whole)
+        line = f"{name:<32}{1000 * t_whole:12.1f}"
+        for n in worker_counts:
+            with ThreadPoolExecutor(max_workers=n) as pool:
+                t, result = best_time(lambda: tiled(pool if n > 1 else None))
+            mark = '' if np.array_equal(result, expected) else ' MISMATCH'
+            line += f"{1000 * t:9.1f} ({t_whole / t:4.2f}x){mark}"
+        print(line)
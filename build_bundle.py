@@ -0,0 +1,90 @@
+"""
+Builds the files the page loads at startup:
+    colorgrade_bundle.zip   all of the Python modules, fetched in a single request (see config.toml)
+    default_colorgrade.png  the default colorgrade, drawn on the canvas before Python has loaded
+
+Run this after changing any of the Python files, and commit the results with them;
+`python build_bundle.py --check` fails if the bundle doesn't match the modules.
+The bundle is built the same way every time (fixed timestamps, sorted files),
+so it only changes when the modules do.
+"""
+
+import glob
+import io
+import os
+import zipfile
+
+BUNDLE_PATH = 'colorgrade_bundle.zip'
+DEFAULT_STRIP_PATH = 'default_colorgrade.png'
+# Timestamp given to every file in the bundle
+BUNDLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def bundle_modules(directory='.'):
+    """
+    Returns the paths of the modules that go in the bundle
+    """
+    return sorted(glob.glob(os.path.join(directory, 'colorgrade_*.py')))
+
+def make_bundle(directory='.'):
+    """
+    Returns the contents of the bundle for the modules in the directory, as bytes
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for module in bundle_modules(directory):
+            info = zipfile.ZipInfo(os.path.basename(module), date_time=BUNDLE_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(module, 'rb') as f:
+                bundle.writestr(info, f.read())
+    return buffer.getvalue()
+
+def bundle_is_fresh(directory='.'):
+    """
+    Whether the bundle in the directory matches its modules
+    """
+    try:
+        with open(os.path.join(directory, BUNDLE_PATH), 'rb') as f:
+            return f.read() == make_bundle(directory)
+    except OSError:
+        return False
+
+def build_bundle(directory='.'):
+    """
+    Zips up every colorgrade module, returning their paths.
+    The file is only rewritten if its contents changed.
+    """
+    if not bundle_is_fresh(directory):
+        data = make_bundle(directory)
+        with open(os.path.join(directory, BUNDLE_PATH), 'wb') as f:
+            f.write(data)
+    return bundle_modules(directory)
+
+def build_default_strip(path=DEFAULT_STRIP_PATH):
+    """
+    Writes the default colorgrade as an image
+    """
+    from colorgrade_core import get_default_colorgrade, process_colorgrade
+    from colorgrade_io import encode_png
+
+    with open(path, 'wb') as f:
+        f.write(encode_png(process_colorgrade(get_default_colorgrade()).transpose(1,0,2)))
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Build the files the page loads at startup")
+    parser.add_argument('--check', action='store_true', help="only check that the bundle is up to date")
+    args = parser.parse_args()
+
+    if args.check:
+        if not bundle_is_fresh():
+            print(f"{BUNDLE_PATH} is out of date; run python build_bundle.py")
+            sys.exit(1)
+        print(f"{BUNDLE_PATH} is up to date")
+        sys.exit(0)
+
+    modules = build_bundle()
+    print(f"Wrote {BUNDLE_PATH} with {len(modules)} modules")
+    build_default_strip()
+    print(f"Wrote {DEFAULT_STRIP_PATH}")
@@ -0,0 +1,54 @@
+"""
+Checks that expressions that would take practically forever to evaluate are rejected quickly,
+both on their own and in a rendered pipeline.
+
+    python check_expressions.py
+"""
+
+import time
+import numpy as np
+from colorgrade_core import *
+from colorgrade_engine import render_pipeline, DEFAULT_STEP_BUDGET
+
+rejected = [
+    '9**9**9',
+    '((10**1000)**1000)**1000',
+    'int(9)**int(9)**int(9)',
+    '1 << 10**9',
+    '((10**1000)**1000)**1000 + r',
+]
+accepted = ['r**2 + g', '2**r', '10**100 * r', '1**10**100', '0.5**3000 + b', 'max(r, g)**2']
+
+if __name__ == '__main__':
+    channels = dict(r=np.linspace(0, 1, 5), g=np.linspace(1, 0, 5), b=np.full(5, 0.5))
+    failed = 0
+
+    for expression in rejected:
+        start = time.perf_counter()
+        try:
+            eval_with(expression, **channels)
+            message = "was evaluated"
+        except ValueError:
+            message = None if time.perf_counter() - start < 1 else "took too long to reject"
+        if message is not None:
+            failed += 1
+            print(f"FAIL {expression}: {message}")
+
+    for expression in accepted:
+        try:
+            eval_with(expression, **channels)
+        except ValueError as e:
+            failed += 1
+            print(f"FAIL {expression}: {e}")
+
+    start = time.perf_counter()
+    try:
+        render_pipeline([('custom', {'new-r': rejected[-1], 'new-g': 'g', 'new-b': 'b'})], budget=DEFAULT_STEP_BUDGET)
+        failed += 1
+        print("FAIL render: was evaluated")
+    except ValueError:
+        if time.perf_counter() - start > 1:
+            failed += 1
+            print("FAIL render: took too long to reject")
+
+    print("all expressions checked" if failed == 0 else f"{failed} checks failed")
@@ -1,29 +1,97 @@
+import ast
+import functools
 import numpy as np
 
 ## Utility functions for managing colorgrades
 
-def get_default_colorgrade():
+def get_default_colorgrade(size=16):
     """
-    Creates the default colorgrade and returns it with color values as floats in [0,1], as an array of shape (16,16,16,3)
+    Creates the default colorgrade and returns it with color values as floats in [0,1], as an array of shape (size,size,size,3)
     """
-    v = np.linspace(0,1,16)
+    v = np.linspace(0,1,size)
     G,R,B = np.meshgrid(v,v,v)
     return np.stack((R,G,B), axis=3)
 
 def sep_rgb(cg):
-    return cg[:,:,:,0],cg[:,:,:,1],cg[:,:,:,2]
+    return cg[...,0],cg[...,1],cg[...,2]
     
 def sep_exp_rgb(cg):
-    return np.expand_dims(cg[:,:,:,0],3), np.expand_dims(cg[:,:,:,1],3), np.expand_dims(cg[:,:,:,2],3)
+    return cg[...,0:1], cg[...,1:2], cg[...,2:3]
+
+def stack_rgb(r, g, b):
+    """
+    Combines separate channels into one array of colors, broadcasting them against each other
+    """
+    return np.stack(np.broadcast_arrays(r, g, b), axis=-1)
 
 def process_colorgrade(cg):
     """
-    Transforms a colorgrade into a flat image with integer values to prepare to write to the canvas
+    Transforms a colorgrade into a flat image with integer values to prepare to write to the canvas.
+    Also works on a stack of colorgrades (..., n,n,n,3), giving a stack of images.
+    """
+    size = cg.shape[-2]
+    # [r,g,b] -> [b,r,g] -> [b*size+r, g]
+    flat = np.moveaxis(cg, -2, -4).reshape(cg.shape[:-4] + (size*size, size, 3))
+    return np.clip(255 * flat, 0, 255).astype(np.uint8)
+
+def image_to_colorgrade(image):
+    """
+    Converts a colorgrade image as used by Celeste (uint8, of shape (n, n*n, 3 or 4)) back to a colorgrade
+    """
+    size = image.shape[0]
+    if image.shape[1] != size*size:
+        raise ValueError(f"invalid colorgrade image size {image.shape[1]}x{image.shape[0]}")
+    # [g, b*size+r] -> [g,b,r] -> [r,g,b]
+    return image[:,:,:3].reshape(size, size, size, 3).transpose(2,0,1,3) / 255
+
+def resample_colorgrade(cg, size=16):
     """
-    return np.clip(
-        255 * cg.transpose(1,2,0,3).reshape(16,256,3),
-        0, 255
-    ).transpose(1,0,2).astype(np.uint8)
+    Resamples a colorgrade of shape (n,n,n,3) onto a (size,size,size,3) grid using trilinear interpolation
+    """
+    n = cg.shape[0]
+    if n == size:
+        return cg.copy()
+    
+    # Position of each new grid point in units of the old grid's spacing
+    pos = np.linspace(0, n-1, size)
+    i0 = np.minimum(np.floor(pos).astype(int), n-2)
+    t = pos - i0
+    i1 = i0 + 1
+    
+    # Interpolate one axis at a time
+    t0 = t.reshape(-1,1,1,1)
+    result = cg[i0] * (1-t0) + cg[i1] * t0
+    t1 = t.reshape(1,-1,1,1)
+    result = result[:,i0] * (1-t1) + result[:,i1] * t1
+    t2 = t.reshape(1,1,-1,1)
+    result = result[:,:,i0] * (1-t2) + result[:,:,i1] * t2
+    
+    return result
+    
+def apply_colorgrade(cg, colors):
+    """
+    Looks up colors (array of shape (..., 3), with values in [0,1]) in the colorgrade,
+    interpolating trilinearly between its grid points
+    """
+    n = cg.shape[0]
+    pos = np.clip(colors, 0, 1) * (n-1)
+    i0 = np.minimum(pos.astype(int), n-2)
+    t = pos - i0
+    
+    r0, g0, b0 = i0[...,0], i0[...,1], i0[...,2]
+    r1, g1, b1 = r0+1, g0+1, b0+1
+    tr, tg, tb = t[...,0:1], t[...,1:2], t[...,2:3]
+    
+    # Interpolate along r, then g, then b
+    c00 = cg[r0,g0,b0] * (1-tr) + cg[r1,g0,b0] * tr
+    c10 = cg[r0,g1,b0] * (1-tr) + cg[r1,g1,b0] * tr
+    c01 = cg[r0,g0,b1] * (1-tr) + cg[r1,g0,b1] * tr
+    c11 = cg[r0,g1,b1] * (1-tr) + cg[r1,g1,b1] * tr
+    
+    c0 = c00 * (1-tg) + c10 * tg
+    c1 = c01 * (1-tg) + c11 * tg
+    
+    return c0 * (1-tb) + c1 * tb
     
 def parse_color(color_str):
     """
@@ -46,7 +114,7 @@ def parse_color(color_str):
 def rgb_to_hsv(colors):
     """
     Based on https://www.rapidtables.com/convert/color/rgb-to-hsv.html
-    Only works on a whole colorgrade
+    Works on any array of colors with shape (..., 3)
     """
     r, g, b = sep_rgb(np.array(colors))
     
@@ -73,12 +141,12 @@ def rgb_to_hsv(colors):
     # Value
     v = c_max
     
-    return np.stack((h, s, v), axis=3)
+    return np.stack((h, s, v), axis=-1)
     
 def hsv_to_rgb(colors):
     """
     Based on https://www.rapidtables.com/convert/color/hsv-to-rgb.html
-    Only works on a whole colorgrade
+    Works on any array of colors with shape (..., 3)
     """    
     h, s, v = sep_rgb(np.array(colors))
     
@@ -87,7 +155,7 @@ def hsv_to_rgb(colors):
     
     c = v * s
     x = c * (1 - np.abs((h/60) % 2 - 1))
-    m = np.expand_dims(v - c, axis=3)
+    m = np.expand_dims(v - c, axis=-1)
     
     result = np.zeros_like(colors)
     hue_section = (h//60).astype(int)
@@ -122,6 +190,133 @@ def hsv_to_rgb(colors):
     
     return result
     
+## Perceptual color spaces
+# Colors are sRGB; the matrices are for the D65 white point
+
+SRGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+XYZ_TO_SRGB = np.linalg.inv(SRGB_TO_XYZ)
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+# From https://bottosson.github.io/posts/oklab/
+OKLAB_M1 = np.array([
+    [0.4122214708, 0.5363325363, 0.0514459929],
+    [0.2119034982, 0.6806995451, 0.1073969566],
+    [0.0883024619, 0.2817188376, 0.6299787005],
+])
+OKLAB_M2 = np.array([
+    [0.2104542553, 0.7936177850, -0.0040720468],
+    [1.9779984951, -2.4285922050, 0.4505937099],
+    [0.0259040371, 0.7827717662, -0.8086757660],
+])
+OKLAB_M1_INV = np.linalg.inv(OKLAB_M1)
+OKLAB_M2_INV = np.linalg.inv(OKLAB_M2)
+
+# Matrices transposed once, to multiply arrays of colors of shape (..., 3) on the right
+_SRGB_TO_XYZ_T = (SRGB_TO_XYZ / D65_WHITE[:,None]).T
+_XYZ_TO_SRGB_T = (XYZ_TO_SRGB * D65_WHITE[None,:]).T
+_OKLAB_M1_T, _OKLAB_M2_T = OKLAB_M1.T, OKLAB_M2.T
+_OKLAB_M1_INV_T, _OKLAB_M2_INV_T = OKLAB_M1_INV.T, OKLAB_M2_INV.T
+
+def srgb_to_linear(colors, out=None):
+    """
+    Removes the sRGB gamma; works on any array of colors with shape (..., 3)
+    """
+    colors = np.asarray(colors, dtype=float)
+    if out is None:
+        out = np.empty_like(colors)
+    small = colors <= 0.04045
+    np.power((colors + 0.055) / 1.055, 2.4, out=out, where=~small)
+    np.divide(colors, 12.92, out=out, where=small)
+    return out
+
+def linear_to_srgb(colors, out=None):
+    """
+    Applies the sRGB gamma; works on any array of colors with shape (..., 3)
+    """
+    colors = np.asarray(colors, dtype=float)
+    if out is None:
+        out = np.empty_like(colors)
+    small = colors <= 0.0031308
+    np.power(np.maximum(colors, 0.0031308), 1 / 2.4, out=out)
+    out *= 1.055
+    out -= 0.055
+    np.multiply(colors, 12.92, out=out, where=small)
+    return out
+
+def rgb_to_oklab(colors, out=None):
+    """
+    Converts colors (..., 3) to OKLab (L from 0 to 1, a and b roughly from -0.4 to 0.4)
+    """
+    lms = np.matmul(srgb_to_linear(colors), _OKLAB_M1_T)
+    np.cbrt(lms, out=lms)
+    return np.matmul(lms, _OKLAB_M2_T, out=out)
+
+def oklab_to_rgb(colors, out=None):
+    """
+    Converts OKLab colors (..., 3) to RGB
+    """
+    lms = np.matmul(np.asarray(colors, dtype=float), _OKLAB_M2_INV_T)
+    lms **= 3
+    return linear_to_srgb(np.matmul(lms, _OKLAB_M1_INV_T, out=lms), out=out)
+
+def rgb_to_lab(colors, out=None):
+    """
+    Converts colors (..., 3) to CIELAB (L from 0 to 100, a and b roughly from -100 to 100)
+    """
+    # XYZ relative to the white point
+    f = np.matmul(srgb_to_linear(colors), _SRGB_TO_XYZ_T)
+    small = f <= (6/29)**3
+    np.divide(f, 3 * (6/29)**2, out=f, where=small)
+    f[small] += 4/29
+    np.cbrt(f, out=f, where=~small)
+    
+    fx, fy, fz = sep_rgb(f)
+    if out is None:
+        out = np.empty_like(f)
+    out[...,0] = 116 * fy - 16
+    out[...,1] = 500 * (fx - fy)
+    out[...,2] = 200 * (fy - fz)
+    return out
+
+def lab_to_rgb(colors, out=None):
+    """
+    Converts CIELAB colors (..., 3) to RGB
+    """
+    l, a, b = sep_rgb(np.asarray(colors, dtype=float))
+    fy = (l + 16) / 116
+    f = stack_rgb(fy + a / 500, fy, fy - b / 200)
+    
+    small = f <= 6/29
+    xyz = np.where(small, 3 * (6/29)**2 * (f - 4/29), f**3)
+    return linear_to_srgb(np.matmul(xyz, _XYZ_TO_SRGB_T, out=xyz), out=out)
+
+# Conversions to and from RGB for each color space, by name
+color_spaces = {
+    'rgb': (lambda colors, out=None: colors, lambda colors, out=None: colors),
+    'oklab': (rgb_to_oklab, oklab_to_rgb),
+    'lab': (rgb_to_lab, lab_to_rgb),
+}
+
+def to_color_space(colors, space, out=None):
+    """
+    Converts RGB colors (..., 3) to the named color space (see `color_spaces`)
+    """
+    if space not in color_spaces:
+        raise ValueError(f"unknown color space '{space}'")
+    return color_spaces[space][0](colors, out=out)
+
+def from_color_space(colors, space, out=None):
+    """
+    Converts colors (..., 3) in the named color space back to RGB
+    """
+    if space not in color_spaces:
+        raise ValueError(f"unknown color space '{space}'")
+    return color_spaces[space][1](colors, out=out)
+
 def commutative_map(vals, a, vmin=0, vmax=1):
     """
     Applies a map to the range [vmin, vmax], maintaining anything outside as-is.
@@ -131,19 +326,18 @@ def commutative_map(vals, a, vmin=0, vmax=1):
     that is, a=0 will do nothing, negating a will have the inverse effect, and it is commutative 
     with respect to repeated applications. Mostly this just means that this will behave "nicely", 
     particularly with respect to using it multiple times.
+    
+    `a` can also be an array that broadcasts against `vals`, to apply several maps at once.
     """
     mask = (vals >= vmin) & (vals <= vmax)
     if vmin == vmax:
         # Don't do anything
         return vals.copy()
-    scaled = (vals[mask] - vmin) / (vmax - vmin) 
+    scaled = np.clip((vals - vmin) / (vmax - vmin), 0, 1)
     
     scaled_result = scaled ** np.exp(-a / 10)
     
-    result = vals.copy()
-    result[mask] = scaled_result * (vmax - vmin) + vmin
-    
-    return result
+    return np.where(mask, scaled_result * (vmax - vmin) + vmin, vals)
     
 def centered_commutative_map(vals, a, vmin=0, vmax=1):
     """
@@ -155,19 +349,18 @@ def centered_commutative_map(vals, a, vmin=0, vmax=1):
     that is, a=0 will do nothing, negating a will have the inverse effect, and it is commutative 
     with respect to repeated applications. Mostly this just means that this will behave "nicely", 
     particularly with respect to using it multiple times.
+    
+    `a` can also be an array that broadcasts against `vals`, to apply several maps at once.
     """
     mask = (vals >= vmin) & (vals <= vmax)
     if vmin == vmax:
         # Don't do anything
         return vals.copy()
-    scaled = 2 * (vals[mask] - vmin) / (vmax - vmin) - 1
+    scaled = np.clip(2 * (vals - vmin) / (vmax - vmin) - 1, -1, 1)
     
     scaled_result = np.abs(scaled) ** np.exp(-a / 10) * np.sign(scaled)
     
-    result = vals.copy()
-    result[mask] = (scaled_result + 1) * (vmax - vmin) / 2 + vmin
-    
-    return result
+    return np.where(mask, (scaled_result + 1) * (vmax - vmin) / 2 + vmin, vals)
     
 # Functions pertaining to evaluating expressions
 def get_comparison_func(orig_fun):
@@ -201,27 +394,109 @@ eval_globals = dict(
     log=np.log,
     log2=np.log2,
     log10=np.log10,
+    # The only builtins expressions can use
+    __builtins__=dict(round=round, int=int, float=float, bool=bool),
+)
+
+# Largest integer, in bits, that a part of an expression without any variables can make:
+# Python computes those exactly, which can take practically forever (e.g. 9**9**9)
+MAX_CONSTANT_BITS = 4096
+
+# Syntax that expressions can't use
+_forbidden_expression_nodes = (
+    ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp,
+    ast.List, ast.Tuple, ast.Set, ast.Dict, ast.Starred, ast.NamedExpr, ast.JoinedStr,
 )
 
+@functools.lru_cache(maxsize=256)
+def compile_expression(expression, names):
+    """
+    Checks and compiles an expression using the given variable names, as well as the functions in `eval_globals`.
+    Returns the compiled code and the number of operations in the expression.
+    Raises a ValueError for anything that could run arbitrary code or take practically forever
+    before any of it is evaluated.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"invalid expression '{expression}': {e.msg}") from e
+    
+    allowed_names = set(names) | set(eval_globals) | set(eval_globals['__builtins__'])
+    n_operations = 0
+    for node in ast.walk(tree):
+        if isinstance(node, _forbidden_expression_nodes):
+            raise ValueError(f"expressions can't use {type(node).__name__}")
+        elif isinstance(node, ast.Attribute):
+            raise ValueError(f"expressions can't use attributes ('.{node.attr}')")
+        elif isinstance(node, ast.Name) and node.id not in allowed_names:
+            raise ValueError(f"unknown name '{node.id}' in expression")
+        elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float, complex)):
+            raise ValueError(f"expressions can only contain numbers, not {node.value!r}")
+        
+        if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call, ast.Subscript)):
+            n_operations += 1
+    
+    _check_constant_sizes(tree, set(names))
+    return compile(tree, '<expression>', 'eval'), n_operations
+
+def _check_constant_sizes(node, variables):
+    """
+    Raises a ValueError if a power or shift in a part of the expression not using any of the `variables`
+    would make an integer over `MAX_CONSTANT_BITS`. Returns whether the node doesn't use any variables.
+    Parts are checked innermost first, so every constant evaluated along the way is already known to be small.
+    """
+    is_constant = all([_check_constant_sizes(child, variables) for child in ast.iter_child_nodes(node)])
+    if isinstance(node, ast.Name):
+        return node.id not in variables
+    if not (is_constant and isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Pow, ast.LShift))):
+        return is_constant
+    
+    left, right = _constant_value(node.left), _constant_value(node.right)
+    if isinstance(left, int) and isinstance(right, int) and right > 0:
+        if isinstance(node.op, ast.LShift):
+            bits = abs(left).bit_length() + right
+        else:
+            # Powers of 0, 1 and -1 stay small
+            bits = 0 if abs(left) <= 1 else abs(left).bit_length() * right
+        if bits > MAX_CONSTANT_BITS:
+            raise ValueError(f"the constant '{ast.unparse(node)}' in the expression is too large")
+    return True
+
+def _constant_value(node):
+    """
+    Evaluates a part of an expression without variables, or returns None if that fails
+    (the error is then raised when the whole expression is evaluated)
+    """
+    try:
+        with np.errstate(all='ignore'):
+            return eval(compile(ast.Expression(node), '<expression>', 'eval'), eval_globals)
+    except Exception:
+        return None
+
 def eval_with(expression, _result_shape=None, **kwargs):
     """
     Evaluates a string expression with the given arguments as locals
+    (see `compile_expression` for what expressions can contain)
     """
-    result = eval(expression, eval_globals, {**eval_globals, **kwargs})
+    code, _ = compile_expression(expression, tuple(sorted(kwargs)))
+    result = eval(code, eval_globals, {**eval_globals, **kwargs})
     if _result_shape is not None and np.isscalar(result):
         return np.full(_result_shape, result)
     else:
         return result
     
 # Effects
+# These work on any array of colors with shape (..., 3), not just whole colorgrades.
+# Color and shift parameters can also be arrays that broadcast against the colors
+# (e.g. shape (n,1,1,1) or (n,1,1,1,3) for a colorgrade) to evaluate n parameter sets at once.
 
 def simple_recolor(cg, c_black, c_white):
     """
     Recolors black and white to the given colors
     """
     
-    c_black = np.array(c_black).reshape(1,1,1,-1)
-    c_white = np.array(c_white).reshape(1,1,1,-1)
+    c_black = np.asarray(c_black, dtype=float)
+    c_white = np.asarray(c_white, dtype=float)
     
     result = cg * (c_white - c_black) + c_black
     
@@ -231,19 +506,30 @@ def rescale_to_fill_range(cg):
     """
     Rescales a colorgrade so that the r,g,b values each extend over the whole range [0,1]
     """
-    max_c = np.max(cg, axis=(0,1,2), keepdims=True)
-    min_c = np.min(cg, axis=(0,1,2), keepdims=True)
+    return rescale_colors(cg, *color_range(cg))
+
+def color_range(colors):
+    """
+    Returns the smallest and largest values of r,g,b over all of the colors (..., 3)
+    """
+    flat = colors.reshape(-1, 3)
+    return np.min(flat, axis=0), np.max(flat, axis=0)
+
+def rescale_colors(colors, min_c, max_c):
+    """
+    Linearly maps each of r,g,b from [min_c, max_c] to [0,1]
+    """
     delta = max_c - min_c
-    delta[delta == 0] = 1
+    delta = np.where(delta == 0, 1, delta)
     
-    return (cg - min_c) / delta
+    return (colors - min_c) / delta
 
 def linear_recolor(cg, colors):
     """
     Recolors the eight corners of the color cube to the given colors,
     interpolated multilinearly.
     """
-    c_black, c_white, c_red, c_green, c_blue, c_yellow, c_magenta, c_cyan = [np.array(c).reshape(1,1,1,-1) for c in colors]
+    c_black, c_white, c_red, c_green, c_blue, c_yellow, c_magenta, c_cyan = [np.asarray(c, dtype=float) for c in colors]
     
     r, g, b = sep_exp_rgb(cg)
     
@@ -260,11 +546,11 @@ def linear_recolor(cg, colors):
     
     return result
     
-def get_filled_colorgrade(color):
+def get_filled_colorgrade(color, size=16):
     """
     Returns a colorgrade filled with the given color
     """
-    return np.zeros((16,16,16,3)) + np.array(color).reshape(1,1,1,3)
+    return np.zeros((size,size,size,3)) + np.array(color).reshape(1,1,1,3)
     
 def if_else(cg1, cg2, cond_cg, condition):
     """
@@ -288,7 +574,7 @@ def adjust_rgb(cg, r_shift, g_shift, b_shift):
     new_g = commutative_map(g, g_shift)
     new_b = commutative_map(b, b_shift)
     
-    return np.stack((new_r, new_g, new_b), axis=3)
+    return stack_rgb(new_r, new_g, new_b)
     
 def adjust_hsv(cg, hue_shift, sat_shift, val_shift):
     """
@@ -300,7 +586,7 @@ def adjust_hsv(cg, hue_shift, sat_shift, val_shift):
     new_s = commutative_map(s, sat_shift)
     new_v = commutative_map(v, val_shift)
     
-    new_hsv = np.stack((new_h, new_s, new_v), axis=3)
+    new_hsv = stack_rgb(new_h, new_s, new_v)
     
     return hsv_to_rgb(new_hsv)
     
@@ -313,10 +599,56 @@ def brightness_contrast(cg, bright_shift, con_shift):
     new_s = commutative_map(s, con_shift)
     new_v = centered_commutative_map(commutative_map(v, bright_shift), con_shift)
     
-    new_hsv = np.stack((h, new_s, new_v), axis=3)
+    new_hsv = stack_rgb(h, new_s, new_v)
     
     return hsv_to_rgb(new_hsv)
     
+def adjust_lab(cg, l_shift, a_shift, b_shift):
+    """
+    Shifts the OKLab lightness and a, b coordinates of a colorgrade,
+    clipping the result to the RGB cube
+    """
+    l, a, b = sep_rgb(rgb_to_oklab(cg))
+    
+    new_lab = stack_rgb(l + l_shift, a + a_shift, b + b_shift)
+    
+    return np.clip(oklab_to_rgb(new_lab), 0, 1)
+    
+# Number of entries in the lookup tables for gradient maps
+GRADIENT_TABLE_SIZE = 1024
+
+@functools.lru_cache(maxsize=64)
+def gradient_table(stops, size=GRADIENT_TABLE_SIZE):
+    """
+    Returns the colors of the gradient at `size` evenly spaced points from 0 to 1, as a read-only (size,3) array.
+    `stops` is a tuple of (position, (r,g,b)); colors are interpolated linearly between them.
+    Tables are cached by their stops, so each gradient is only built once.
+    """
+    positions = np.array([position for position, _ in stops], dtype=float)
+    colors = np.array([color for _, color in stops], dtype=float)
+    order = np.argsort(positions, kind='stable')
+    
+    x = np.linspace(0, 1, size)
+    table = np.stack([np.interp(x, positions[order], colors[order,c]) for c in range(3)], axis=-1)
+    table.flags.writeable = False
+    return table
+    
+def gradient_map(cg, stops, weights=(0.299, 0.587, 0.114)):
+    """
+    Maps the luma of each color (the RGB values weighted by `weights`, scaled to sum to 1)
+    onto the gradient with the given stops (see `gradient_table`)
+    """
+    weights = np.asarray(weights, dtype=float)
+    if weights.sum() <= 0:
+        raise ValueError("the luma weights must add up to more than 0")
+    table = gradient_table(tuple(stops))
+    
+    luma = np.clip(cg @ (weights / weights.sum()), 0, 1) * (len(table) - 1)
+    i = np.minimum(luma.astype(int), len(table) - 2)
+    frac = (luma - i)[...,None]
+    
+    return table[i] + frac * (table[i+1] - table[i])
+    
 def custom_rgb_adjust(cg, r_expr, g_expr, b_expr):
     expressions = [r_expr, g_expr, b_expr]
     
@@ -326,32 +658,392 @@ def custom_rgb_adjust(cg, r_expr, g_expr, b_expr):
         eval_with(expr, r=r, g=g, b=b, shape=r.shape) for expr in expressions
     ]
     
-    return np.stack(result_colors, axis=3)
+    return np.stack(result_colors, axis=-1)
     
 def palettize(cg, colors, mode=None):
     """
-    `colors`: list of (3,) color arrays, or (n,3) array of colors
+    `colors`: list of (3,) color arrays, or (n,3) array of colors.
+    `mode` is the color space the closest colors are found in (see `color_spaces`), by default RGB.
+    """
+    colors, which = palettize_indices(cg, colors, mode=mode)
+    return colors[which]
+
+def palettize_indices(cg, colors, mode=None, chunk_size=1024):
     """
-    colors = np.array(colors,dtype=float)[:,None,None,None,:]
+    Like `palettize`, but returns the palette as an (n,3) array and the index of
+    the closest color for each pixel, so that `palette[which]` is the palettized colorgrade
+    """
+    colors = np.array(colors,dtype=float)
+    space = 'rgb' if mode is None else mode
+    
+    points = to_color_space(cg, space).reshape(-1, 3)
+    targets = to_color_space(colors, space)
+    which = _closest_colors(points, targets, chunk_size=chunk_size)
+    
+    return colors, which.reshape(cg.shape[:-1])
+
+def _closest_colors(points, targets, targets_sq=None, chunk_size=1024):
+    """
+    Returns the index of the closest of `targets` (n,3) for each of `points` (m,3)
+    """
+    # Find the closest color for each pixel, a chunk at a time:
+    # the squared distance less the squared norm of the pixel is |c|^2 - 2 p.c
+    if targets_sq is None:
+        targets_sq = np.einsum('ij,ij->i', targets, targets)
+    which = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), chunk_size):
+        dists = targets_sq - 2 * (points[start:start+chunk_size] @ targets.T)
+        which[start:start+chunk_size] = np.argmin(dists, axis=-1)
+    return which
+    
+def soft_palettize(cg, colors, k=3, mode=None, power=2, chunk_size=1024):
+    """
+    Like `palettize`, but blends the `k` closest colors of the palette,
+    weighted by the inverse of their distance to the `power` (in the color space `mode`).
+    Colors are processed a chunk at a time, so memory use doesn't grow with the size of the palette times the colorgrade.
+    """
+    colors = np.array(colors,dtype=float)
+    space = 'rgb' if mode is None else mode
+    k = min(k, len(colors))
+    
+    points = to_color_space(cg, space).reshape(-1, 3)
+    targets = to_color_space(colors, space)
+    targets_sq = np.einsum('ij,ij->i', targets, targets)
+    
+    result = np.empty((len(points), 3))
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start+chunk_size]
+        # The squared distance less the squared norm of the point, which doesn't change which are closest
+        partial_dists = chunk @ targets.T
+        partial_dists *= -2
+        partial_dists += targets_sq
+        
+        # Only the k closest are needed, in any order
+        nearest = np.argpartition(partial_dists, k - 1, axis=-1)[:,:k]
+        sq_dists = np.take_along_axis(partial_dists, nearest, axis=-1) + np.einsum('ij,ij->i', chunk, chunk)[:,None]
+        dists = np.sqrt(np.maximum(sq_dists, 0))
+        
+        # A color exactly on a palette color gets just that color
+        weights = 1 / np.maximum(dists, 1e-9) ** power
+        weights /= weights.sum(axis=-1, keepdims=True)
+        result[start:start+chunk_size] = np.einsum('nk,nkc->nc', weights, colors[nearest])
     
-    # Find the distances
-    dists = np.linalg.norm(cg - colors, axis=4)
+    return result.reshape(cg.shape)
     
-    # Find the closest color for each pixel
-    which = np.argmin(dists, axis=0)
+def bayer_matrix(n):
+    """
+    Returns the n x n Bayer threshold matrix (n a power of 2), with values evenly spread in (-0.5, 0.5)
+    """
+    m = np.zeros((1, 1))
+    while len(m) < n:
+        m = np.block([[4*m, 4*m + 2], [4*m + 3, 4*m + 1]])
+    return (m + 0.5) / m.size - 0.5
+
+def palette_spacing(colors):
+    """
+    Returns the average distance from each palette color to the closest other one
+    """
+    colors = np.array(colors, dtype=float)
+    if len(colors) < 2:
+        return 0.
+    dists = np.linalg.norm(colors[:,None,:] - colors[None,:,:], axis=-1)
+    np.fill_diagonal(dists, np.inf)
+    return float(dists.min(axis=1).mean())
+
+def ordered_dither(image, colors, mode=None, matrix_size=4, strength=1.):
+    """
+    Palettizes an image (height, width, 3) with ordered (Bayer) dithering:
+    each pixel is offset by its threshold from a tiled Bayer matrix,
+    scaled by `strength` times the spacing of the palette, before finding its closest color
+    """
+    colors = np.array(colors, dtype=float)
+    height, width = image.shape[:2]
+    thresholds = np.tile(bayer_matrix(matrix_size), (-(-height // matrix_size), -(-width // matrix_size)))
+    offset = strength * palette_spacing(colors) * thresholds[:height,:width,None]
     
-    return colors[which][:,:,:,0,0,0,:]
+    colors, which = palettize_indices(image + offset, colors, mode=mode)
+    return colors[which]
+
+def error_diffusion_dither(image, colors, mode=None):
+    """
+    Palettizes an image (height, width, 3) with Floyd-Steinberg error diffusion.
+    Pixel (y, x) only depends on pixels at an earlier x + 2y, so each of these diagonal wavefronts
+    is processed at once; the result is the same as going through the pixels one at a time.
+    """
+    colors = np.array(colors, dtype=float)
+    space = 'rgb' if mode is None else mode
+    targets = to_color_space(colors, space)
+    targets_sq = np.einsum('ij,ij->i', targets, targets)
+    
+    height, width = image.shape[:2]
+    # A border of one pixel on each side (and below) catches the error diffused off the edges
+    work = np.zeros((height + 1, width + 2, 3))
+    work[:height,1:width+1] = image
+    result = np.empty((height, width, 3))
+    
+    for t in range(width + 2 * (height - 1)):
+        y = np.arange(max(0, -(-(t - width + 1) // 2)), min(height - 1, t // 2) + 1)
+        x = t - 2 * y
+        old = work[y, x+1]
+        new = colors[_closest_colors(to_color_space(old, space), targets, targets_sq)]
+        result[y, x] = new
+        error = old - new
+        
+        # In the same order as going through the pixels one at a time:
+        # the pixel below left receives this error before the pixel to the right of it does
+        work[y+1, x] += error * (3/16)
+        work[y+1, x+1] += error * (5/16)
+        work[y+1, x+2] += error * (1/16)
+        work[y, x+2] += error * (7/16)
     
+    return result
+
+def dither_palettize(image, colors, method='ordered', mode=None):
+    """
+    Palettizes an image (height, width, 3) with dithering, by the method 'ordered' or 'diffusion'
+    (or 'none' for plain `palettize`)
+    """
+    if method == 'ordered':
+        return ordered_dither(image, colors, mode=mode)
+    elif method == 'diffusion':
+        return error_diffusion_dither(image, colors, mode=mode)
+    elif method == 'none':
+        return palettize(image, colors, mode=mode)
+    raise ValueError(f"unknown dithering method '{method}'")
+
 def sample_colors(cg, n_colors, seed=91):
-    np.random.seed(seed)
+    size = cg.shape[0]
     points = zip(*np.unravel_index(
-        np.random.choice(16**3, size=n_colors, replace=False),
-        (16,16,16)
+        sample_indices(size**3, n_colors, seed=seed),
+        (size,size,size)
     ))
     
     colors = [cg[point] for point in points]
     return colors
+
+def sample_indices(n_points, n_colors, seed=91):
+    """
+    Returns the (flat) indices of the colors `sample_colors` picks out of `n_points`
+    """
+    # A generator of its own (rather than the global one), so steps can run in parallel
+    rng = np.random.RandomState(seed)
+    return rng.choice(n_points, size=n_colors, replace=False)
     
-def reduce_colors(cg, n_colors, seed=91):
+def reduce_colors(cg, n_colors, seed=91, mode=None):
     colors = sample_colors(cg, n_colors, seed=seed)
-    return palettize(cg, colors)
\ No newline at end of file
+    return palettize(cg, colors, mode=mode)
+
+def nearest_neighbours(points, queries, k, exact=True, cell_cap=None, chunk_size=1024):
+    """
+    Finds the `k` nearest of `points` (m,3) to each of `queries` (q,3).
+    Returns the indices of the neighbours (q,k) and their distances (q,k), closest first.
+    
+    Points are bucketed into a uniform grid so each query only looks at the 3x3x3 block of cells around it;
+    queries whose neighbours might lie outside of that block fall back to checking every point.
+    If not `exact`, this only happens for queries with fewer than `k` points in their block.
+    Cells holding more than `cell_cap` points (by default `2*k`; e.g. where many colors collapse into one)
+    only keep that many, so results there are approximate.
+    """
+    points = np.asarray(points, dtype=float)
+    queries = np.asarray(queries, dtype=float)
+    m = len(points)
+    k = min(k, m)
+    n_cells = max(2, round((m / (k/2)) ** (1/3)))
+    
+    lo = np.minimum(points.min(axis=0), queries.min(axis=0))
+    hi = np.maximum(points.max(axis=0), queries.max(axis=0))
+    cell_size = np.maximum(hi - lo, 1e-9) / n_cells
+    
+    # Table of the points in each cell, padded with -1; the extra last row is always empty
+    coords = np.clip(((points - lo) / cell_size).astype(int), 0, n_cells-1)
+    cell = np.ravel_multi_index(coords.T, (n_cells,)*3)
+    order = np.argsort(cell, kind='stable')
+    counts = np.bincount(cell, minlength=n_cells**3)
+    cell_cap = min(2*k if cell_cap is None else cell_cap, counts.max())
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank = np.arange(m) - starts[cell[order]]
+    keep = rank < cell_cap
+    table = np.full((n_cells**3 + 1, cell_cap), -1)
+    table[cell[order][keep], rank[keep]] = order[keep]
+    # With a padding point far away from everything; candidates are compared in single precision
+    # (each channel separately, which is faster to gather), and only the chosen ones measured exactly
+    padded = np.concatenate((points, np.full((1,3), np.inf)))
+    padded_channels = [padded[:,c].astype(np.float32) for c in range(3)]
+    
+    offsets = np.stack(np.meshgrid([-1,0,1], [-1,0,1], [-1,0,1], indexing='ij'), axis=-1).reshape(-1,3)
+    
+    nearest = np.empty((len(queries), k), dtype=int)
+    nearest_sq = np.empty((len(queries), k))
+    unsure = np.empty(len(queries), dtype=bool)
+    
+    for start in range(0, len(queries), chunk_size):
+        q = queries[start:start+chunk_size]
+        
+        # Gather candidates from the block of cells around each cell holding queries
+        pos = (q - lo) / cell_size
+        q_coords = np.clip(pos.astype(int), 0, n_cells-1)
+        cells, which_cell = np.unique(np.ravel_multi_index(q_coords.T, (n_cells,)*3), return_inverse=True)
+        neighbour_coords = np.stack(np.unravel_index(cells, (n_cells,)*3), axis=-1)[:,None,:] + offsets
+        valid = np.all((neighbour_coords >= 0) & (neighbour_coords < n_cells), axis=-1)
+        neighbour_cells = np.where(
+            valid,
+            np.ravel_multi_index(np.clip(neighbour_coords, 0, n_cells-1).transpose(2,0,1), (n_cells,)*3),
+            n_cells**3,
+        )
+        blocks = table[neighbour_cells].reshape(len(cells), -1)
+        # Most of each block is padding: move the points to the front, and only keep as many columns as needed
+        blocks = -np.sort(-blocks, axis=1)
+        blocks = blocks[:, :max(k, np.max(np.sum(blocks >= 0, axis=1)))]
+        candidates = blocks[which_cell.ravel()]
+        
+        q32 = q.astype(np.float32)
+        sq = sum((padded_channels[c][candidates] - q32[:,c:c+1]) ** 2 for c in range(3))
+        chosen = np.take_along_axis(candidates, _smallest_k(sq, k), axis=1)
+        nearest[start:start+len(q)] = chosen
+        nearest_sq[start:start+len(q)] = np.sum((padded[chosen] - q[:,None,:]) ** 2, axis=-1)
+        
+        furthest = np.max(nearest_sq[start:start+len(q)], axis=1)
+        if exact:
+            # Anything outside the block is at least this far away
+            frac = pos - q_coords
+            guaranteed = np.min(cell_size * (1 + np.minimum(frac, 1-frac)), axis=1)
+            unsure[start:start+len(q)] = furthest > guaranteed**2
+        else:
+            unsure[start:start+len(q)] = np.isinf(furthest)
+    
+    if np.any(unsure):
+        # Check every point, using |q-p|^2 = |q|^2 - 2 q.p + |p|^2 (leaving out |q|^2, the same for every point)
+        which = np.nonzero(unsure)[0]
+        points32 = points.astype(np.float32)
+        points_sq = np.sum(points32**2, axis=1)
+        for start in range(0, len(which), chunk_size):
+            rows = which[start:start+chunk_size]
+            q = queries[rows]
+            sq = points_sq - 2 * (q.astype(np.float32) @ points32.T)
+            idx = _smallest_k(sq, k)
+            nearest[rows] = idx
+            nearest_sq[rows] = np.sum((points[idx] - q[:,None,:]) ** 2, axis=-1)
+    
+    # Sort the neighbours of each query by distance
+    order = np.argsort(nearest_sq, axis=1)
+    dists = np.sqrt(np.maximum(np.take_along_axis(nearest_sq, order, axis=1), 0))
+    return np.take_along_axis(nearest, order, axis=1), dists
+    
+def _smallest_k(values, k):
+    """
+    Returns the column indices of the `k` smallest values in each row, in no particular order
+    """
+    # Partitioning the values is much faster than partitioning their indices,
+    # and without ties the values up to the k-th smallest are exactly the ones wanted
+    kth = np.partition(values, k-1, axis=1)[:,k-1:k]
+    rows, cols = np.nonzero(values <= kth)
+    if len(rows) == values.shape[0] * k and np.all(np.bincount(rows, minlength=len(values)) == k):
+        return cols.reshape(-1, k)
+    return np.argpartition(values, k-1, axis=1)[:,:k]
+
+# Distance (as a fraction of the spacing of the colorgrade's points) within which
+# a point of an inverse colorgrade doesn't need refining any further
+INVERSE_TOLERANCE = 1e-3
+
+def invert_colorgrade(cg, k=8, iterations=3, return_diagnostics=False):
+    """
+    Finds the colorgrade that undoes `cg`, i.e. one mapping each output color of `cg` back to its input color.
+    
+    For each point of the new colorgrade, the nearest output colors of `cg` are found,
+    and a local linear map from output to input colors is fitted to them;
+    this is then refined by a few Newton steps using `cg` itself.
+    
+    Colors that `cg` never produces, or that several very different colors are mapped to, have no real inverse;
+    they get the closest match. With `return_diagnostics`, also returns a dictionary with masks of shape (n,n,n):
+    `unreached` for colors far from any output of `cg`, and `non_invertible` for points where the result 
+    does not map back to the original color, along with the `residual` distance itself.
+    """
+    n = cg.shape[0]
+    inputs = get_default_colorgrade(n).reshape(-1,3)
+    outputs = cg.reshape(-1,3)
+    
+    # The inverse is sampled on the same regular grid
+    targets = inputs
+    # Neighbours don't need to be exact, since the result gets refined afterwards
+    neighbours, dists = nearest_neighbours(outputs, targets, k, exact=False)
+    
+    # Weighted least squares fit of input = a + (output - target) @ J for each target,
+    # with a little regularization of J for when the outputs are (nearly) degenerate
+    weights = 1 / (dists + 0.1 / (n-1))
+    design = np.concatenate((
+        np.ones(neighbours.shape + (1,)),
+        outputs[neighbours] - targets[:,None,:],
+    ), axis=-1)
+    weighted = design * weights[:,:,None]
+    lhs = np.einsum('qki,qkj->qij', weighted, design)
+    lhs[:,1:,1:] += 1e-6 * np.sum(weights, axis=1)[:,None,None] * np.eye(3)
+    rhs = np.einsum('qki,qkj->qij', weighted, inputs[neighbours])
+    coef = np.linalg.solve(lhs, rhs)
+    
+    x = np.clip(coef[:,0,:], 0, 1)
+    jacobian_inv = coef[:,1:,:]
+    
+    # Only the points that haven't converged yet are refined
+    active = np.arange(len(x))
+    error = targets - apply_colorgrade(cg, x)
+    for _ in range(iterations):
+        active = active[np.max(np.abs(error[active]), axis=-1) > INVERSE_TOLERANCE / (n-1)]
+        if len(active) == 0:
+            break
+        x[active] = np.clip(x[active] + np.einsum('qi,qij->qj', error[active], jacobian_inv[active]), 0, 1)
+        error[active] = targets[active] - apply_colorgrade(cg, x[active])
+    
+    inverse = x.reshape(n,n,n,3)
+    if not return_diagnostics:
+        return inverse
+    
+    residual = np.linalg.norm(error, axis=-1).reshape(n,n,n)
+    return inverse, dict(
+        unreached=(dists[:,0] > 1 / (n-1)).reshape(n,n,n),
+        non_invertible=residual > 0.25 / (n-1),
+        residual=residual,
+    )
+    
+def analyze_colorgrade(cg):
+    """
+    Gathers statistics about the colors of a colorgrade, as they would be written to the image.
+    Returns a dictionary with
+        `n_points`: number of points in the colorgrade
+        `unique_colors`: number of distinct output colors
+        `largest_group`: number of points sharing the most common output color
+        `collapsed`: fraction of points whose color is already produced by another point
+        `histograms`: array (3,256) of how many points have each value, per channel
+        `clipped_low`, `clipped_high`: per-channel number of values below 0 or above 1 before quantizing
+    """
+    flat = cg.reshape(-1,3)
+    quantized = np.clip(255 * flat, 0, 255).astype(np.uint8)
+    
+    # Pack each color into a single integer so they can be compared all at once
+    keys = (
+        (quantized[:,0].astype(np.uint32) << 16)
+        | (quantized[:,1].astype(np.uint32) << 8)
+        | quantized[:,2]
+    )
+    _, counts = np.unique(keys, return_counts=True)
+    
+    return dict(
+        n_points=len(flat),
+        unique_colors=len(counts),
+        largest_group=int(counts.max()),
+        collapsed=1 - len(counts) / len(flat),
+        histograms=np.stack([np.bincount(quantized[:,c], minlength=256) for c in range(3)]),
+        clipped_low=np.sum(flat < 0, axis=0),
+        clipped_high=np.sum(flat > 1, axis=0),
+    )
+    
+def describe_analysis(analysis):
+    """
+    Summarizes the result of `analyze_colorgrade` as text
+    """
+    clipped = analysis['clipped_low'] + analysis['clipped_high']
+    return (
+        f"{analysis['unique_colors']} unique colors; "
+        f"{100 * analysis['collapsed']:.1f}% of points repeat a color used elsewhere, "
+        f"the most common color covers {100 * analysis['largest_group'] / analysis['n_points']:.1f}%; "
+        f"clipped values (R, G, B): {clipped[0]}, {clipped[1]}, {clipped[2]}"
+    )
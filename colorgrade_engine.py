@@ -0,0 +1,550 @@
+"""
+Runs colorgrade pipelines from serialized steps, without needing the page.
+"""
+
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from colorgrade_core import *
+from colorgrade_steps import *
+
+def create_steps(ser_list):
+    """
+    Creates process steps (without html elements) from a list of serialized steps,
+    as produced by `ColorgradeProcessStep.serialize`
+    """
+    steps = []
+    for i, (name, params) in enumerate(ser_list):
+        if name not in process_step_types:
+            raise ValueError(f"unknown step type '{name}'")
+        steps.append(process_step_types[name](i, None, name, dict(params)))
+
+    return steps
+
+# Number of colors processed at a time by the tiled executor,
+# small enough for a step's temporary arrays to stay in the CPU cache
+TILE_SIZE = 1 << 13
+# Smallest tile used to keep a step within its memory budget
+MIN_TILE_SIZE = 1 << 8
+
+# Limits on the time and memory each step can use
+StepBudget = namedtuple('StepBudget', ['seconds', 'bytes'])
+DEFAULT_STEP_BUDGET = StepBudget(seconds=10., bytes=512 << 20)
+
+# Rough speed of operations on array elements, for turning a `StepCost` into a time
+OPERATIONS_PER_SECOND = 2e8
+# Estimates are rough, so steps are only refused before running if they would take this many times their limit;
+# the others are stopped if they actually run out of time
+ESTIMATE_MARGIN = 2
+
+class BudgetExceeded(ValueError):
+    """
+    A step would take, or took, more time or memory than its `StepBudget`
+    """
+
+def get_step_inputs(steps, only=None):
+    """
+    Returns, for each step, the set of colorgrades it reads as indices into the list of all colorgrades
+    (0 being the starting colorgrade and i the result of step i).
+    If `only` is given, steps whose numbers aren't in it are treated as reading nothing.
+    """
+    return [
+        _get_step_input(step, i) if only is None or i in only else set()
+        for i, step in enumerate(steps, start=1)
+    ]
+
+def get_live_steps(steps):
+    """
+    Returns the set of numbers of the steps that the final colorgrade depends on,
+    following the inputs of each step back from the last one.
+    Any other step can be skipped without changing the result.
+    """
+    live = set()
+    to_visit = [len(steps)] if len(steps) > 0 else []
+    while len(to_visit) > 0:
+        i = to_visit.pop()
+        if i == 0 or i in live:
+            continue
+        live.add(i)
+        to_visit.extend(_get_step_input(steps[i-1], i))
+    
+    return live
+
+def _get_step_input(step, i):
+    try:
+        indices = step.get_input_indices()
+        for idx in indices:
+            if not -i <= idx < i:
+                raise ValueError(f"input {idx} is not an earlier step")
+    except Exception as e:
+        raise ValueError(f"error in step {i} ({step.title()}): {e}") from e
+    
+    return set(idx % i for idx in indices)
+
+def threads_available(max_workers=None):
+    """
+    Whether running steps on other threads is possible and worthwhile
+    (Pyodide in the browser can't start threads)
+    """
+    return sys.platform != 'emscripten' and (max_workers or os.cpu_count() or 1) > 1
+
+def run_pipeline(
+    steps, size=16, parallel=None, max_workers=None, tiled=None, fuse=False, prune=False, compress=False, budget=None
+):
+    """
+    Applies every step, starting from the default colorgrade of the given size.
+    Returns the list of all intermediate colorgrades.
+    
+    If `parallel`, steps that don't depend on each other (such as the branches merged by an If-Else)
+    are run at the same time on a thread pool; the results are the same as running them one by one.
+    By default this is done whenever threads are available and some steps are independent.
+    
+    If `tiled`, steps are run a tile of colors at a time where possible (see `run_step_tiled`),
+    by default when the colorgrade is larger than one tile.
+    
+    If `fuse`, runs of steps that act on each color independently are combined into one kernel
+    that goes through the colorgrade once, tile by tile (see `fuse_steps`).
+    The intermediate colorgrades inside those runs are then left as None.
+    
+    If `prune`, only the steps the final colorgrade depends on are run (see `get_live_steps`);
+    the results of the others are left as None.
+    
+    If `compress`, steps that reduce the colorgrade to a few colors (such as Palettize) keep their result
+    as a palette and an index for each color, and the steps acting on each color independently after them
+    only process the palette. Colorgrades are only expanded where a later step needs all of the colors
+    (or for the final one); the others are left as None.
+    
+    With a `budget` (a `StepBudget`), the cost of every step is estimated before anything runs (see `plan_budget`):
+    steps that would need too much memory at once run on smaller tiles, and otherwise `BudgetExceeded` is raised.
+    Steps that run out of time while running are stopped between tiles, also raising `BudgetExceeded`.
+    """
+    live = get_live_steps(steps) if prune else set(range(1, len(steps) + 1))
+    inputs = get_step_inputs(steps, only=live)
+    cg_steps = [get_default_colorgrade(size)] + [None] * len(steps)
+    
+    if fuse or compress:
+        kernels = [_try_get_kernel(step) if i in live else None for i, step in enumerate(steps, start=1)]
+    else:
+        kernels = [None] * len(steps)
+    if fuse:
+        groups = fuse_steps(inputs, kernels)
+    else:
+        groups = [[i] for i in range(1, len(steps) + 1)]
+    
+    palettes = None
+    keep_full = ()
+    if compress:
+        groups = _split_at_palette_steps(groups, steps)
+        palettes = dict()
+        keep_full = _get_expanded_colorgrades(groups, inputs, kernels, len(steps))
+    groups = [group for group in groups if group[-1] in live]
+    
+    if parallel is None:
+        parallel = threads_available(max_workers) and _has_independent_steps(inputs)
+    if tiled is None:
+        tiled = size**3 > TILE_SIZE
+    
+    tile_sizes = None
+    if budget is not None:
+        n_workers = (max_workers or os.cpu_count() or 1) if threads_available(max_workers) else 1
+        tile_sizes = plan_budget(steps, size, budget, live=live, n_workers=n_workers)
+    
+    tile_pool = None
+    try:
+        if (tiled or fuse or tile_sizes) and threads_available(max_workers):
+            tile_pool = ThreadPoolExecutor(max_workers=max_workers)
+        run_group = lambda group: _run_group(
+            group, steps, kernels, cg_steps, tiled, tile_pool, palettes, keep_full, budget, tile_sizes
+        )
+        
+        if parallel:
+            try:
+                _run_parallel(groups, inputs, cg_steps, max_workers, run_group)
+                return cg_steps
+            except RuntimeError:
+                # Couldn't start a thread, so run them one by one instead, without the tile pool either
+                if tile_pool is not None:
+                    tile_pool.shutdown()
+                    tile_pool = None
+        
+        for group in groups:
+            cg_steps[group[-1]] = run_group(group)
+    
+    finally:
+        if tile_pool is not None:
+            tile_pool.shutdown()
+    
+    return cg_steps
+
+def fuse_steps(inputs, kernels):
+    """
+    Groups steps into runs that can be computed as one: each step of a run after the first
+    has a kernel and reads only the step before it, which has a kernel and isn't read by any other step.
+    `inputs` is from `get_step_inputs` and `kernels` has each step's kernel (or None).
+    Returns the list of runs, each a list of step numbers.
+    """
+    n_readers = [0] * (len(inputs) + 1)
+    for indices in inputs:
+        for idx in indices:
+            n_readers[idx] += 1
+    
+    groups = []
+    for i, (indices, kernel) in enumerate(zip(inputs, kernels), start=1):
+        if (
+            i > 1 and kernel is not None and kernels[i-2] is not None
+            and indices == {i-1} and n_readers[i-1] == 1
+        ):
+            groups[-1].append(i)
+        else:
+            # Start a new run, e.g. when an earlier intermediate is read by index
+            groups.append([i])
+    
+    return groups
+
+def plan_budget(steps, size, budget, live=None, n_workers=1):
+    """
+    Checks the estimated cost of each step (see `ColorgradeProcessStep.estimate_cost`)
+    on a colorgrade of the given size against the budget, before running anything.
+    Steps that would need more memory than the budget are given a smaller tile size, if they can run tiled,
+    so that `n_workers` tiles at once fit in it.
+    Returns a dictionary from those steps' numbers to their tile size.
+    Raises `BudgetExceeded` for steps that would take well over the time limit (see `ESTIMATE_MARGIN`),
+    or need too much memory and can't be tiled.
+    Only the steps in `live` are checked, if given.
+    """
+    n_points = size**3
+    tile_sizes = dict()
+    for i, step in enumerate(steps, start=1):
+        if live is not None and i not in live:
+            continue
+        try:
+            cost = step.estimate_cost(n_points)
+            tileable = _try_get_kernel(step) is not None or (
+                step.has_input() and step.get_reduction(n_points) is not None
+            )
+        except Exception:
+            # Invalid arguments are reported when the step is run
+            continue
+        
+        seconds = cost.operations / OPERATIONS_PER_SECOND
+        if seconds > ESTIMATE_MARGIN * budget.seconds:
+            raise BudgetExceeded(
+                f"error in step {i} ({step.title()}): would take about {seconds:.3g} s, "
+                f"more than the limit of {budget.seconds:g} s"
+            )
+        if cost.bytes <= budget.bytes:
+            continue
+        
+        tile_size = TILE_SIZE
+        while tileable and tile_size > MIN_TILE_SIZE and n_workers * step.estimate_cost(tile_size).bytes > budget.bytes:
+            tile_size //= 2
+        if not tileable or n_workers * step.estimate_cost(tile_size).bytes > budget.bytes:
+            raise BudgetExceeded(
+                f"error in step {i} ({step.title()}): would need about {cost.bytes / (1 << 20):.0f} MB, "
+                f"more than the limit of {budget.bytes / (1 << 20):.0f} MB"
+            )
+        tile_sizes[i] = tile_size
+    
+    return tile_sizes
+
+def map_tiles(fn, colors, tile_size=TILE_SIZE, pool=None, deadline=None):
+    """
+    Calls `fn(tile, start)` for each run of `tile_size` colors of `colors` (flattened to (m,3)),
+    where `start` is the index of the first color of the tile.
+    The tiles are processed on `pool` if given (a `concurrent.futures` executor).
+    Returns the list of results, in order.
+    If the `deadline` (a `time.perf_counter()` time) passes, the remaining tiles are skipped and `BudgetExceeded` raised.
+    """
+    if deadline is not None:
+        fn = _before_deadline(fn, deadline)
+    flat = colors.reshape(-1, 3)
+    starts = range(0, len(flat), tile_size)
+    
+    if pool is None or len(starts) < 2:
+        return [fn(flat[start:start+tile_size], start) for start in starts]
+    
+    futures = [pool.submit(fn, flat[start:start+tile_size], start) for start in starts]
+    return [future.result() for future in futures]
+
+def _before_deadline(fn, deadline):
+    def checked(tile, start):
+        if time.perf_counter() > deadline:
+            raise BudgetExceeded("ran past its time limit")
+        return fn(tile, start)
+    return checked
+
+def apply_tiled(kernel, colors, tile_size=TILE_SIZE, pool=None, deadline=None):
+    """
+    Applies a kernel (see `ColorgradeProcessStep.get_kernel`) to the colors one tile at a time;
+    the result is the same as `kernel(colors)`
+    """
+    result = np.empty(colors.shape)
+    flat_result = result.reshape(-1, 3)
+    
+    def apply(tile, start):
+        flat_result[start:start+len(tile)] = kernel(tile)
+    
+    map_tiles(apply, colors, tile_size=tile_size, pool=pool, deadline=deadline)
+    return result
+
+def run_step_tiled(step, cg_steps, tile_size=TILE_SIZE, pool=None, deadline=None):
+    """
+    Returns the result of the step for the colorgrades before it, processing its input a tile at a time
+    if it acts on each color independently. Steps with a `Reduction` first summarize every tile
+    and combine that into their kernel. Any other step is run on the whole colorgrade.
+    """
+    kernel = step.get_kernel()
+    if kernel is None:
+        cg_in = cg_steps[step.get_target_index()] if step.has_input() else None
+        reduction = None if cg_in is None else step.get_reduction(cg_in.size // 3)
+        if reduction is None:
+            return step.do_processing(cg_steps)
+        
+        summaries = map_tiles(reduction.summarize, cg_in, tile_size=tile_size, pool=pool, deadline=deadline)
+        kernel = reduction.kernel_from_summary(reduction.combine(summaries))
+    
+    return apply_tiled(kernel, cg_steps[step.get_target_index()], tile_size=tile_size, pool=pool, deadline=deadline)
+
+def _run_step(step, i, cg_steps, tiled=False, tile_pool=None, tile_size=TILE_SIZE, deadline=None):
+    """
+    Runs step `i`, which sees the colorgrades before it
+    """
+    try:
+        if tiled:
+            return run_step_tiled(step, cg_steps[:i], tile_size=tile_size, pool=tile_pool, deadline=deadline)
+        return step.do_processing(cg_steps[:i])
+    except Exception as e:
+        raise _step_error(step, i, e) from e
+
+def _step_error(step, i, e):
+    """
+    Returns the error to raise for an exception in step `i`; running out of budget keeps its type
+    """
+    error_type = BudgetExceeded if isinstance(e, BudgetExceeded) else ValueError
+    return error_type(f"error in step {i} ({step.title()}): {e}")
+
+def _run_group(
+    group, steps, kernels, cg_steps, tiled, tile_pool, palettes=None, keep_full=(), budget=None, tile_sizes=None
+):
+    """
+    Runs a group of steps from `fuse_steps`, returning the result of the last one.
+    With `palettes` (see `compress` in `run_pipeline`), results that are a palette and indices
+    are stored in it, and only expanded if their index is in `keep_full`.
+    With a `budget`, the group gets the time of one step for each of its steps,
+    and `tile_sizes` (from `plan_budget`) gives steps that must run on smaller tiles.
+    """
+    first, last = group[0], group[-1]
+    deadline = None
+    if budget is not None:
+        deadline = time.perf_counter() + budget.seconds * len(group)
+    
+    palette_result = None
+    if palettes is not None:
+        palette_result = _run_group_palette(group, steps, kernels, cg_steps, palettes)
+    
+    tile_size = min([TILE_SIZE] + [tile_sizes[i] for i in group if i in (tile_sizes or ())])
+    if palette_result is not None:
+        palettes[last] = palette_result
+        result = None
+        if last in keep_full:
+            palette, indices = palette_result
+            result = palette[indices]
+    elif len(group) == 1:
+        result = _run_step(
+            steps[first-1], first, cg_steps, tiled or tile_size < TILE_SIZE, tile_pool, tile_size, deadline
+        )
+    else:
+        cg_in = cg_steps[:first][steps[first-1].get_target_index()]
+        try:
+            result = apply_tiled(
+                _fuse_kernels(group, steps, kernels), cg_in, tile_size=tile_size, pool=tile_pool, deadline=deadline
+            )
+        except BudgetExceeded as e:
+            raise _step_error(steps[first-1], first, e) from e
+    
+    # Steps that aren't tiled (including those giving a palette) can't be stopped partway,
+    # so are only checked once they finish
+    if deadline is not None and time.perf_counter() > deadline:
+        raise _step_error(steps[first-1], first, BudgetExceeded(
+            f"took longer than the limit of {budget.seconds * len(group):g} s"
+        ))
+    return result
+
+def _run_group_palette(group, steps, kernels, cg_steps, palettes):
+    """
+    Returns the result of the group as (palette, indices) if it can be found that way, otherwise None
+    """
+    first = group[0]
+    if all(kernels[i-1] is not None for i in group):
+        source = range(first)[steps[first-1].get_target_index()]
+        if source in palettes:
+            palette, indices = palettes[source]
+            return _fuse_kernels(group, steps, kernels)(palette), indices
+    
+    if len(group) == 1 and steps[first-1].palette_output:
+        try:
+            return steps[first-1].get_palette_output(cg_steps[:first])
+        except Exception as e:
+            raise ValueError(f"error in step {first} ({steps[first-1].title()}): {e}") from e
+    
+    return None
+
+def _fuse_kernels(group, steps, kernels):
+    """
+    Returns a kernel applying the kernels of each step in the group in turn
+    """
+    def fused_kernel(colors):
+        for i in group:
+            try:
+                colors = kernels[i-1](colors)
+            except Exception as e:
+                raise ValueError(f"error in step {i} ({steps[i-1].title()}): {e}") from e
+        return colors
+    
+    return fused_kernel
+
+def _split_at_palette_steps(groups, steps):
+    """
+    Puts steps that can give their result as a palette into groups of their own,
+    so the steps after them can run on the palette
+    """
+    split = []
+    for group in groups:
+        current = []
+        for i in group:
+            if steps[i-1].palette_output:
+                if len(current) > 0:
+                    split.append(current)
+                split.append([i])
+                current = []
+            else:
+                current.append(i)
+        if len(current) > 0:
+            split.append(current)
+    return split
+
+def _get_expanded_colorgrades(groups, inputs, kernels, n_steps):
+    """
+    Returns the indices of the colorgrades that have to be expanded if they are a palette:
+    the final one, and those read by groups that don't just apply kernels
+    """
+    keep_full = {n_steps}
+    for group in groups:
+        if not all(kernels[i-1] is not None for i in group):
+            keep_full.update(inputs[group[0]-1])
+    return keep_full
+
+def _try_get_kernel(step):
+    """
+    Returns the step's kernel, or None if it has none or its arguments are invalid
+    (the error is then raised when the step itself is run)
+    """
+    try:
+        return step.get_kernel()
+    except Exception:
+        return None
+
+def _has_independent_steps(inputs):
+    """
+    Whether any step could run without waiting for the one just before it
+    """
+    return any(i - 1 not in indices for i, indices in enumerate(inputs, start=1) if i > 1)
+
+def _run_parallel(groups, inputs, cg_steps, max_workers, run_group):
+    """
+    Runs the groups of steps on a thread pool, each as soon as all of its inputs are ready.
+    Raises the error of the first failing step, as running them in order would.
+    """
+    # Groups are identified by their last step, which is the only one read by other groups
+    groups = {group[-1]: group for group in groups}
+    waiting_for = {last: inputs[group[0]-1] - {0} for last, group in groups.items()}
+    dependents = {idx: [] for idx in range(len(cg_steps))}
+    for last, group in groups.items():
+        for idx in inputs[group[0]-1]:
+            dependents[idx].append(last)
+    
+    ready = [last for last in groups if len(waiting_for[last]) == 0]
+    running = dict()
+    errors = dict()
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(ready) > 0 or len(running) > 0:
+            # Steps after a failed one would never have been reached
+            first_error = min(errors, default=len(cg_steps))
+            for last in ready:
+                if groups[last][0] < first_error:
+                    running[pool.submit(run_group, groups[last])] = last
+            ready = []
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                last = running.pop(future)
+                try:
+                    cg_steps[last] = future.result()
+                except ValueError as e:
+                    errors[groups[last][0]] = e
+                    continue
+                
+                for j in dependents[last]:
+                    waiting_for[j].discard(last)
+                    if len(waiting_for[j]) == 0:
+                        ready.append(j)
+    
+    if len(errors) > 0:
+        raise errors[min(errors)]
+
+def render_pipeline(ser_list, size=16, budget=None):
+    """
+    Returns the final colorgrade for a list of serialized steps, with each step limited to the `budget` if given
+    """
+    return run_pipeline(create_steps(ser_list), size=size, fuse=True, prune=True, compress=True, budget=budget)[-1]
+
+def run_pipeline_batch(steps, values, colors):
+    """
+    Evaluates the pipeline for a whole batch of parameter sets at once.
+
+    `values` has an entry for each step: a dictionary from names of numeric arguments
+    to arrays with the batch along the first axis (shape (n,) or (n,3) for colors),
+    replacing the step's own values for those arguments.
+    `colors` is the input to the first step, an array of shape (..., 3) such as the default colorgrade.
+
+    Returns the output for every parameter set, as an array of shape (n, ..., 3)
+    """
+    n_batch = None
+    cg_steps = [colors]
+
+    for i, (step, step_values) in enumerate(zip(steps, values), start=1):
+        if step_values:
+            # Line the batch up with the first axis of the colors
+            batch_values = dict()
+            for name, v in step_values.items():
+                v = np.asarray(v, dtype=float)
+                n_batch = len(v)
+                extra_axes = (1,) * (colors.ndim - 1) + v.shape[1:]
+                batch_values[name] = v.reshape((n_batch,) + extra_axes)
+            kernel = step.kernel_from_values({**step.get_values(), **batch_values})
+        else:
+            kernel = step.get_kernel()
+
+        try:
+            if kernel is not None:
+                cg_steps.append(kernel(cg_steps[step.get_target_index()]))
+            elif step.supports_batches:
+                cg_steps.append(step.do_processing(cg_steps))
+            else:
+                raise ValueError("this step can't be evaluated for a batch of parameters")
+        except Exception as e:
+            raise ValueError(f"error in step {i} ({step.title()}): {e}") from e
+
+    if n_batch is None:
+        raise ValueError("no values given to evaluate")
+
+    return np.broadcast_to(cg_steps[-1], (n_batch,) + colors.shape)
+
+def analyze_pipeline(ser_list, size=16, step=-1):
+    """
+    Runs the serialized steps and returns `analyze_colorgrade` of one of the results (by default the final one)
+    """
+    return analyze_colorgrade(run_pipeline(create_steps(ser_list), size=size)[step])
@@ -0,0 +1,160 @@
+"""
+Finds parameter values for a pipeline so that it reproduces a target colorgrade,
+or a set of (before, after) color pairs.
+
+Can also be run as a script:
+    python colorgrade_fit.py template.txt target.cube
+where the template is a list of steps as exported from the page.
+"""
+
+import time
+from collections import namedtuple
+from colorgrade_core import *
+from colorgrade_engine import *
+
+FitResult = namedtuple('FitResult', [
+    'ser_list',                 # the fitted pipeline, as serialized steps
+    'error',                    # root mean square difference from the target, with colors in [0,1]
+    'n_evaluations',            # number of parameter sets evaluated
+    'evaluations_per_second',
+])
+
+def get_free_parameters(steps):
+    """
+    Returns a list of (step index, argument name, number of values, min, max)
+    for every numeric argument in the steps
+    """
+    return [
+        (i, name, n_values, lo, hi)
+        for i, step in enumerate(steps)
+        for name, (n_values, lo, hi) in step.numeric_arguments().items()
+    ]
+
+def fit_pipeline(ser_list, target, source=None, free=None, population=48, iterations=80, seed=0, callback=None):
+    """
+    Fits the numeric arguments of the serialized steps in `ser_list`.
+
+    `target` is either a colorgrade of shape (n,n,n,3), or an array of colors (m,3)
+    giving the desired output for each color in `source`.
+    Steps that build a whole colorgrade from scratch (Fill, Import LUT) can only be fitted
+    to a target colorgrade.
+    `free` restricts which arguments are varied, as a list of (step index, argument name);
+    by default all numeric arguments are.
+
+    Uses the cross-entropy method: each iteration, a whole population of parameter sets
+    is sampled around the current estimate and evaluated as one batch,
+    and the estimate moves towards the best of them.
+    `callback(iteration, error)` is called after each iteration if given.
+
+    Returns a FitResult
+    """
+    target = np.asarray(target, dtype=float)
+    if source is None:
+        source = get_default_colorgrade(target.shape[0])
+    source = np.asarray(source, dtype=float)
+    if source.shape != target.shape:
+        raise ValueError(f"source colors of shape {source.shape} don't match target of shape {target.shape}")
+
+    steps = create_steps(ser_list)
+    if source.ndim != 4:
+        # These ignore their input and return a full colorgrade, which can't be compared with color pairs
+        for i, step in enumerate(steps, start=1):
+            if isinstance(step, (CGFill, CGImportLUT)):
+                raise ValueError(f"step {i} ({step.title()}) can only be fitted to a whole colorgrade, not to color pairs")
+    params = get_free_parameters(steps)
+    if free is not None:
+        free = set((i, name) for i, name in free)
+        params = [p for p in params if (p[0], p[1]) in free]
+    if len(params) == 0:
+        raise ValueError("no numeric arguments to fit")
+
+    # Each argument is a slice of one flat parameter vector
+    slices = []
+    lo, hi, start = [], [], []
+    for i, name, n_values, p_lo, p_hi in params:
+        slices.append(slice(len(lo), len(lo) + n_values))
+        lo += [p_lo] * n_values
+        hi += [p_hi] * n_values
+        start += list(np.atleast_1d(steps[i].get_values()[name]))
+    lo, hi = np.array(lo), np.array(hi)
+
+    def evaluate(x):
+        values = [dict() for _ in steps]
+        for (i, name, n_values, _, _), s in zip(params, slices):
+            values[i][name] = x[:, s] if n_values > 1 else x[:, s.start]
+        result = run_pipeline_batch(steps, values, source)
+        return np.sqrt(np.mean((result - target) ** 2, axis=tuple(range(1, result.ndim))))
+
+    rng = np.random.default_rng(seed)
+    n_elite = max(2, population // 8)
+    mean = np.clip(np.array(start), lo, hi)
+    sigma = (hi - lo) / 4
+
+    best_x = mean
+    best_error = evaluate(mean[None])[0]
+    n_evaluations = 1
+    start_time = time.perf_counter()
+
+    for iteration in range(iterations):
+        x = mean + sigma * rng.standard_normal((population, len(mean)))
+        # Always keep the best so far, so the error never gets worse
+        x[0] = best_x
+        x = np.clip(x, lo, hi)
+
+        errors = evaluate(x)
+        n_evaluations += population
+
+        order = np.argsort(errors)
+        if errors[order[0]] < best_error:
+            best_error = errors[order[0]]
+            best_x = x[order[0]]
+
+        elite = x[order[:n_elite]]
+        mean = elite.mean(axis=0)
+        # Smoothed update, so that the search doesn't collapse too early
+        sigma = 0.7 * sigma + 0.3 * elite.std(axis=0)
+
+        if callback is not None:
+            callback(iteration, best_error)
+
+    elapsed = time.perf_counter() - start_time
+
+    # Write the best values back into the steps
+    fitted = [(name, dict(step_params)) for name, step_params in ser_list]
+    for (i, name, n_values, _, _), s in zip(params, slices):
+        value = best_x[s] if n_values > 1 else best_x[s.start]
+        fitted[i][1].update(steps[i].format_values({name: value}))
+
+    return FitResult(
+        ser_list=fitted,
+        error=float(best_error),
+        n_evaluations=n_evaluations,
+        evaluations_per_second=(n_evaluations - 1) / max(elapsed, 1e-9),
+    )
+
+if __name__ == '__main__':
+    import argparse
+    from colorgrade_io import read_lut_file
+    from colorgrade_serialization import parse_serialization, to_json
+
+    parser = argparse.ArgumentParser(description="Fit the parameters of a pipeline to a target LUT")
+    parser.add_argument('template', help="file with the exported steps to fit")
+    parser.add_argument('target', help="target LUT, as a .cube file or Hald CLUT image")
+    parser.add_argument('--size', type=int, default=16, help="size to resample the target to")
+    parser.add_argument('--population', type=int, default=48)
+    parser.add_argument('--iterations', type=int, default=80)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.template) as f:
+        template = parse_serialization(f.read())
+    with open(args.target, 'rb') as f:
+        target = resample_colorgrade(read_lut_file(args.target, f.read()), args.size)
+
+    result = fit_pipeline(
+        template, target,
+        population=args.population, iterations=args.iterations, seed=args.seed,
+    )
+    print(to_json(result.ser_list))
+    print(f"RMS error: {255 * result.error:.2f} / 255")
+    print(f"{result.n_evaluations} evaluations, {result.evaluations_per_second:.0f} per second")
@@ -3,18 +3,47 @@ from collections import namedtuple
 from functools import wraps
 from colorgrade_core import *
 from colorgrade_steps import *
+# colorgrade_io, colorgrade_fit and colorgrade_serialization are only imported once they're needed,
+# to keep them out of the startup time
     
 ## Page functionality
 
 new_process_id = 0
 process_steps = []
-no_input_process_types = {'if-else', 'fill'}
+no_input_process_types = {'if-else', 'fill', 'import-lut'}
+
+# Live preview: size of the coarse colorgrade rendered while typing,
+# and how long the input needs to settle before rendering at full size
+preview_size = 8
+preview_settle_ms = 400
+preview_timeout_id = None
+
+# Undo/redo history (created on first use), the most states it keeps,
+# and the most memory its cached colorgrades can use
+history = None
+history_max_states = 200
+history_max_bytes = 64 << 20
+
+# The image last written to the canvas, so that only the columns that changed are redrawn,
+# and how many pixels have been sent to it (for instrumentation)
+last_canvas_image = None
+canvas_write_stats = {'writes': 0, 'unchanged': 0, 'pixels': 0, 'last_pixels': 0}
+# Changed columns with at most this many unchanged ones between them are sent as one span
+canvas_span_gap = 8
+
+# Most colors a colorgrade can have for the screenshot preview to dither to them
+screenshot_max_palette = 256
+
+# The variations shown by the explorer, as (serialized steps, values for each variation)
+shown_variations = None
+variations_columns = 4
 
 # get needed globals from the javascript
 import js
-from js import canvas, canvas_ctx, process_items, document, error_message, clear_err_message, serialize_textbox
+from js import canvas, canvas_ctx, process_items, document, error_message, clear_err_message, serialize_textbox, live_preview_checkbox
+from js import histogram_ctx, analysis_text, thumbnails_checkbox
 from pyscript import when
-from pyscript.ffi import create_proxy
+from pyscript.ffi import create_proxy, to_js
 
 
 @when("click", "#generate")
@@ -22,6 +51,15 @@ def handler_generate(event):
     clear_err_message()
     generate()
 
+@when("click", "#undo")
+def handler_undo(event):
+    clear_err_message()
+    undo()
+@when("click", "#redo")
+def handler_redo(event):
+    clear_err_message()
+    redo()
+
 @when("click", "#simplerecolor")
 def handler_simple_recolor(event):
     clear_err_message()
@@ -50,6 +88,10 @@ def handler_adjust_rgb(event):
 def handler_adjust_hsv(event):
     clear_err_message()
     create_process_step('adjust-hsv')
+@when("click", "#adjustlab")
+def handler_adjust_lab(event):
+    clear_err_message()
+    create_process_step('adjust-lab')
 @when("click", "#brightnesscontrast")
 def handler_brightness_contrast(event):
     clear_err_message()
@@ -66,11 +108,97 @@ def handler_reducecolors(event):
 def handler_palettize(event):
     clear_err_message()
     create_process_step('palettize')
+@when("click", "#gradientmap")
+def handler_gradient_map(event):
+    clear_err_message()
+    create_process_step('gradient-map')
+@when("click", "#invert")
+def handler_invert(event):
+    clear_err_message()
+    create_process_step('invert')
+
+@when("click", "#lut-import")
+async def handler_lut_import(event):
+    clear_err_message()
+    files = document.getElementById("lut-file").files
+    if files.length == 0:
+        show_error_text("Error: no LUT file selected.")
+        return
+    
+    file = files.item(0)
+    data = (await file.arrayBuffer()).to_bytes()
+    import_lut(file.name, data)
+@when("click", "#lut-export-cube")
+def handler_lut_export_cube(event):
+    clear_err_message()
+    export_lut('cube')
+@when("click", "#lut-export-hald")
+def handler_lut_export_hald(event):
+    clear_err_message()
+    export_lut('hald')
+@when("click", "#fit-steps")
+def handler_fit_steps(event):
+    clear_err_message()
+    fit_steps_to_lut()
+
+@when("click", "#transition-export")
+def handler_transition_export(event):
+    clear_err_message()
+    export_transition()
+
+@when("click", "#screenshot-preview")
+async def handler_screenshot_preview(event):
+    clear_err_message()
+    files = document.getElementById("screenshot-file").files
+    if files.length == 0:
+        show_error_text("Error: no screenshot selected.")
+        return
+    
+    # The browser decodes the image, much faster than doing it in Python
+    bitmap = await js.createImageBitmap(files.item(0))
+    preview_screenshot(read_image_pixels(bitmap))
+
+@when("click", "#variations-explore")
+def handler_variations_explore(event):
+    clear_err_message()
+    explore_variations()
+
+@when("click", "#variations-canvas")
+def handler_variations_canvas(event):
+    clear_err_message()
+    variations_canvas = event.target
+    # The canvas is scaled to fit the page
+    scale = variations_canvas.width / max(variations_canvas.clientWidth, 1)
+    pick_variation(event.offsetX * scale, event.offsetY * scale)
+
+@when("change", "#show-thumbnails")
+def handler_show_thumbnails(event):
+    if thumbnails_checkbox.checked:
+        process_items.classList.remove('hide_thumbnails')
+        clear_err_message()
+        generate()
+    else:
+        process_items.classList.add('hide_thumbnails')
+
+@when("input", "#process_items")
+def handler_preview_input(event):
+    if not live_preview_checkbox.checked:
+        return
+    clear_err_message()
+    generate_preview()
+    schedule_refine_preview()
 
 def setup_page():
-	write_colorgrade(get_default_colorgrade())
-	create_process_step('8-value-recolor')
-	hide_loading_overlay()
+	# The canvas already shows the precomputed default colorgrade (see build_bundle.py),
+	# so nothing needs to be rendered before the page is usable
+	try:
+		if len(js.location.hash) > 1:
+			load_shared_steps(js.location.hash[1:])
+		else:
+			create_process_step('8-value-recolor')
+	finally:
+		# Don't leave the page stuck behind the loading overlay, even if the steps fail
+		hide_loading_overlay()
 
 
 def hide_loading_overlay():
@@ -93,6 +221,15 @@ def display_errors(fn):
             raise
     return _inner
 
+@display_errors
+def load_shared_steps(compact):
+    """
+    Loads the steps from a share link
+    """
+    from colorgrade_serialization import parse_serialization
+    load_steps(parse_serialization(compact))
+    generate()
+
 @display_errors
 def create_process_step(process_type):
     """
@@ -114,20 +251,8 @@ def create_process_step_with_params(process_type, **params):
         process_id=str(new_process_id),
         _class="step_box",
     )
-    # alternative to this bit: use eval
-    process_step = {
-        '8-value-recolor': CG8ValueRecolor,
-        'simple-recolor': CGSimpleRecolor,
-        'recenter-colors': CGRecenterColors,
-        'fill': CGFill,
-        'if-else': CGIfElse,
-        'adjust-rgb': CGAdjustRGB,
-        'adjust-hsv': CGAdjustHSV,
-        'brightness-contrast': CGBrightnessContrast,
-        'palettize': CGPalettize,
-        'reduce-colors': CGReduceColors,
-        'custom': CGCustomMap,
-    }[process_type](new_process_id, element, process_type)
+    process_step = process_step_types[process_type](new_process_id, element, process_type)
+    source_index = params.pop('which-step', '-1')
     
     ## Populate the element
     # Index and display name 
@@ -144,6 +269,11 @@ def create_process_step_with_params(process_type, **params):
     # Populate with method-specific tags
     process_step.populate_html_element(element, **params)
     
+    # Thumbnail of this step's output, filled in by `show_thumbnails`
+    element.appendChild(create_element_with_tags(
+        "canvas", _class='step_thumbnail', width='256', height='16',
+    ))
+    
     ## Row for the source colorgrade and the buttons
     last_line_supercontainer = create_element_with_tags('table', _class='step_box_button_container')
     last_line_subcontainer = create_element_with_tags('tr')
@@ -151,7 +281,7 @@ def create_process_step_with_params(process_type, **params):
     if process_step.has_input():
         # Add a box for which step to take as input colorgrade
         source_holder = create_element_with_tags('td', align='left')
-        add_input_field(source_holder, 'which-step', 'Source step: ', '-1', size=2)
+        add_input_field(source_holder, 'which-step', 'Source step: ', source_index, size=2)
         last_line_subcontainer.appendChild(source_holder)
         
     end_buttons = create_element_with_tags('td', align='right')
@@ -267,41 +397,228 @@ def move_step_down(process_id):
     regenerate_display_indices()
     hide_error()
     
+def compute_colorgrade_steps(size=16):
+    """
+    Applies every process step, starting from the default colorgrade of the given size.
+    Returns the list of intermediate colorgrades; only the last is always filled in,
+    since runs of pointwise steps are fused and steps it doesn't depend on are skipped.
+    Colorgrades up to the displayed size are cached by the history instead.
+    Steps are limited to `DEFAULT_STEP_BUDGET`, so that a step that would hang the page fails instead.
+    """
+    from colorgrade_engine import run_pipeline, plan_budget, get_live_steps, DEFAULT_STEP_BUDGET
+    
+    try:
+        # Steps that the final colorgrade doesn't depend on are skipped
+        if size <= 16:
+            tile_sizes = plan_budget(process_steps, size, DEFAULT_STEP_BUDGET, live=get_live_steps(process_steps))
+            cg_steps = get_history().render(
+                [step.serialize() for step in process_steps], size=size, prune=True,
+                budget=DEFAULT_STEP_BUDGET, tile_sizes=tile_sizes
+            )
+        else:
+            # Independent branches run in parallel where threads are available (not in the browser)
+            cg_steps = run_pipeline(
+                process_steps, size=size, fuse=True, prune=True, compress=True, budget=DEFAULT_STEP_BUDGET
+            )
+    
+    except ValueError as e:
+        show_error_exception(e, prefix="", show_error_type=False)
+        raise
+    
+    mark_skipped_steps()
+    return cg_steps
+
+def mark_skipped_steps():
+    """
+    Marks the steps that aren't used for the final colorgrade, and so were skipped
+    """
+    from colorgrade_engine import get_live_steps
+    live = get_live_steps(process_steps)
+    
+    for i, step in enumerate(process_steps, start=1):
+        if i in live:
+            step.element.classList.remove('skipped_step')
+        else:
+            step.element.classList.add('skipped_step')
+
 def generate():
     """
     Generates the colorgrade using the given values
     note to self: in the future, add something to handle exceptions that occur
     """
     hide_error()
-    cg_steps = [get_default_colorgrade()]
-    
-    for i, process_step in enumerate(process_steps, start=1):
-        cg_out = None
-        try:
-            cg_steps.append(
-                process_step.do_processing(cg_steps)
-            )
-            
-        except Exception as e:
-            show_error_exception(
-                e,
-                prefix=f"Error parsing step {i}:",
-                show_error_type=False,
-            )
-            raise
+    cg_steps = compute_colorgrade_steps()
+    get_history().record([step.serialize() for step in process_steps])
         
     result = cg_steps[-1]
     write_colorgrade(result)
+    show_analysis(result)
+    show_thumbnails(cg_steps)
+
+def get_history():
+    """
+    Returns the undo/redo history, creating it the first time
+    """
+    global history
+    if history is None:
+        from colorgrade_history import PipelineHistory
+        history = PipelineHistory(max_states=history_max_states, max_cache_bytes=history_max_bytes)
+    return history
+
+@display_errors
+def undo():
+    """
+    Goes back to the steps before the last generated change
+    """
+    ser_list = get_history().undo()
+    if ser_list is not None:
+        show_steps(ser_list)
+
+@display_errors
+def redo():
+    """
+    Goes forward again to the steps of an undone change
+    """
+    ser_list = get_history().redo()
+    if ser_list is not None:
+        show_steps(ser_list)
+
+def show_steps(ser_list):
+    """
+    Replaces the current steps and displays their colorgrade (usually from the history's cache)
+    """
+    load_steps(ser_list)
+    hide_error()
+    cg_steps = compute_colorgrade_steps()
+    write_colorgrade(cg_steps[-1])
+    show_analysis(cg_steps[-1])
+    show_thumbnails(cg_steps)
+
+def generate_preview():
+    """
+    Quickly generates the colorgrade on a coarse cube and displays it upsampled to full size.
+    The full-size render happens separately (see `schedule_refine_preview`), 
+    so that the final result is exactly the same as with `generate`.
+    """
+    try:
+        cg_steps = compute_colorgrade_steps(size=preview_size)
+    except Exception:
+        # Values are often incomplete while typing; the error has already been displayed
+        return
+    
+    write_colorgrade(resample_colorgrade(cg_steps[-1], 16))
+    
+def schedule_refine_preview():
+    """
+    (Re)starts the timer for rendering the full-size colorgrade once the input settles
+    """
+    global preview_timeout_id
+    if preview_timeout_id is not None:
+        js.clearTimeout(preview_timeout_id)
+    preview_timeout_id = js.setTimeout(refine_preview_proxy, preview_settle_ms)
+    
+def refine_preview():
+    """
+    Replaces the coarse preview with the full-size colorgrade
+    """
+    global preview_timeout_id
+    preview_timeout_id = None
+    try:
+        generate()
+    except Exception:
+        # Already displayed to the error box
+        pass
 
 def write_colorgrade(cg):
     """
-    Writes the colorgrade to the canvas object
+    Writes the colorgrade to the canvas object.
+    Only the columns that differ from the last written image are sent; returns the number of pixels sent.
+    """
+    global last_canvas_image
+    image = process_colorgrade(cg).transpose(1,0,2)
+    spans = changed_column_spans(last_canvas_image, image, gap=canvas_span_gap)
+    
+    pixels = 0
+    for start, end in spans:
+        # One call per span rather than one per pixel
+        canvas_ctx.putImageData(to_image_data(image[:,start:end]), start, 0)
+        pixels += image.shape[0] * (end - start)
+    last_canvas_image = image
+    
+    canvas_write_stats['writes'] += 1
+    canvas_write_stats['unchanged'] += len(spans) == 0
+    canvas_write_stats['pixels'] += pixels
+    canvas_write_stats['last_pixels'] = pixels
+    return pixels
+
+def changed_column_spans(old, new, gap=0):
+    """
+    Returns the (start, end) column ranges where the images differ, merging spans separated by at most `gap` unchanged columns.
+    Everything has changed if there is no old image or it has a different shape.
+    """
+    if old is None or old.shape != new.shape:
+        return [(0, new.shape[1])]
+    
+    changed = np.nonzero(np.any(old != new, axis=(0,2)))[0]
+    if len(changed) == 0:
+        return []
+    
+    # Split where consecutive changed columns are further apart than the gap
+    breaks = np.nonzero(np.diff(changed) > gap + 1)[0]
+    starts = np.concatenate(([changed[0]], changed[breaks + 1]))
+    ends = np.concatenate((changed[breaks], [changed[-1]])) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def to_image_data(image):
+    """
+    Converts a uint8 image of shape (height, width, 3) to a javascript ImageData object
     """
-    flat_cg = process_colorgrade(cg)
-    for i in range(256):
-        for j in range(16):
-            canvas_ctx.fillStyle = f"rgb({flat_cg[i,j,0]},{flat_cg[i,j,1]},{flat_cg[i,j,2]})"
-            canvas_ctx.fillRect(i, j, 1, 1)
+    height, width = image.shape[:2]
+    rgba = np.full((height, width, 4), 255, dtype=np.uint8)
+    rgba[:,:,:3] = image
+    
+    data = js.Uint8ClampedArray.new(rgba.size)
+    data.assign(rgba)
+    return js.ImageData.new(data, width, height)
+    
+def show_thumbnails(cg_steps):
+    """
+    Shows the output of each step in its thumbnail, if enabled.
+    All of them are converted to images at once, and sent to the page in a single call.
+    """
+    if not thumbnails_checkbox.checked or len(process_steps) == 0:
+        return
+    
+    # Skipped steps, and steps fused into a later one, have no output of their own, so are left black
+    outputs = np.stack([
+        np.zeros_like(cg_steps[0]) if cg is None else cg for cg in cg_steps[1:]
+    ])
+    # Stacked vertically, as one tall image
+    images = process_colorgrade(outputs).transpose(0,2,1,3)
+    n_steps, height, width = images.shape[:3]
+    
+    js.write_thumbnails(
+        to_image_data(images.reshape(n_steps * height, width, 3)),
+        to_js([str(step.process_id) for step in process_steps]),
+    )
+    
+def show_analysis(cg):
+    """
+    Displays statistics about the colorgrade's colors, and histograms of each channel
+    """
+    analysis = analyze_colorgrade(cg)
+    analysis_text.innerHTML = describe_analysis(analysis)
+    
+    # Scale so the tallest bar (ignoring the ends, which are often huge from clipping) fills the height
+    height = histogram_ctx.canvas.height
+    histograms = analysis['histograms']
+    scale = max(1, histograms[:,1:-1].max())
+    bar_heights = np.minimum(height, np.ceil(height * histograms / scale))
+    
+    # Each channel's bars are drawn in its own color, overlapping additively
+    rows = np.arange(height, 0, -1).reshape(-1, 1, 1)
+    image = (255 * (rows <= bar_heights.T[None,:,:])).astype(np.uint8)
+    histogram_ctx.putImageData(to_image_data(image), 0, 0)
     
 def show_error_exception(e, prefix="Error:", post="", show_error_type=True):
     """
@@ -337,20 +654,26 @@ def import_serialization():
     Reads from `serialize_textbox` element to generate a list 
     of steps, and then populates the list in the html
     """
+    from colorgrade_serialization import parse_serialization
     ser_list = None
     try:
         # Decode the objects
         # Done separately to avoid mangling current steps if this fails
-        # eval() is ok here because they're wrecking their own computer if they do anything
-        ser_list = eval(serialize_textbox.value)
+        ser_list = parse_serialization(serialize_textbox.value)
     except Exception as e:
         raise Exception("unable to load; invalid import steps") from e
     
+    load_steps(ser_list)
+    
+def load_steps(ser_list):
+    """
+    Replaces all current steps with the given serialized steps
+    """
     # Create list of steps
     global process_steps
     
     # Clear old steps
-    # TODO make this its own function, add a button to do this
+    # TODO add a button to do this
     for item in process_steps:
         item.element.remove()
     process_steps = list()
@@ -364,12 +687,218 @@ def export_serialization():
     Creates a text representation of all current steps and places it 
     in the `serialize_textbox` element.
     """
+    from colorgrade_serialization import to_json
     ser_list = [step.serialize() for step in process_steps]
     
-    ser_string = repr(ser_list)
+    ser_string = to_json(ser_list)
     
     serialize_textbox.value = ser_string
 
+@display_errors
+def export_share_link():
+    """
+    Creates a link to the page with all current steps and places it 
+    in the `serialize_textbox` element.
+    """
+    from colorgrade_serialization import to_compact
+    ser_list = [step.serialize() for step in process_steps]
+    
+    js.location.hash = to_compact(ser_list)
+    
+    serialize_textbox.value = js.location.href
+
+    
+@display_errors
+def import_lut(name, data):
+    """
+    Loads a LUT from the contents of a .cube file or Hald CLUT image,
+    and adds a step that uses it as a source
+    """
+    from colorgrade_io import read_lut_file
+    imported_luts[name] = read_lut_file(name, data)
+    # Cached results may have used an earlier LUT with the same name
+    get_history().clear_cache()
+    create_process_step_with_params('import-lut', name=name)
+    
+@display_errors
+def export_lut(lut_format):
+    """
+    Generates the colorgrade at the export size and downloads it
+    as either a .cube file or a Hald CLUT image
+    """
+    from colorgrade_io import format_cube, encode_png, colorgrade_to_hald
+    size = int(document.getElementById("lut-export-size").value)
+    cg = compute_colorgrade_steps(size)[-1]
+    
+    if lut_format == 'cube':
+        download_file('colorgrade.cube', format_cube(cg, title='Celeste colorgrade'), 'text/plain')
+    else:
+        download_file('colorgrade_hald.png', encode_png(colorgrade_to_hald(cg)), 'image/png')
+    
+@display_errors
+def fit_steps_to_lut():
+    """
+    Adjusts the numeric values of the current steps so that the result matches an imported LUT
+    """
+    from colorgrade_fit import fit_pipeline
+    name = document.getElementById("fit-target").value
+    if name not in imported_luts:
+        raise ValueError(f"no LUT named '{name}' has been imported")
+    target = resample_colorgrade(imported_luts[name], 16)
+    
+    result = fit_pipeline([step.serialize() for step in process_steps], target)
+    
+    load_steps(result.ser_list)
+    generate()
+    document.getElementById("fit-result").innerHTML = (
+        f"RMS error {255 * result.error:.2f}/255 after {result.n_evaluations} evaluations "
+        f"({result.evaluations_per_second:.0f}/s)"
+    )
+    
+@display_errors
+def export_transition():
+    """
+    Downloads a zip of the colorgrades going from the current steps to the ones in the transition box
+    """
+    from colorgrade_serialization import parse_serialization
+    from colorgrade_transition import render_transition, frames_to_zip
+    end_ser = parse_serialization(document.getElementById("transition-end").value)
+    n_frames = int(document.getElementById("transition-frames").value)
+    if n_frames < 2:
+        raise ValueError("a transition needs at least 2 frames")
+    
+    frames = render_transition([step.serialize() for step in process_steps], end_ser, n_frames)
+    download_file('colorgrade_transition.zip', frames_to_zip(frames), 'application/zip')
+    
+@display_errors
+def read_image_pixels(bitmap):
+    """
+    Returns the pixels of a javascript ImageBitmap as a uint8 array of shape (height, width, 3)
+    """
+    image_canvas = document.createElement("canvas")
+    image_canvas.width = bitmap.width
+    image_canvas.height = bitmap.height
+    context = image_canvas.getContext("2d")
+    context.drawImage(bitmap, 0, 0)
+    data = context.getImageData(0, 0, bitmap.width, bitmap.height).data
+    rgba = np.frombuffer(data.to_py(), dtype=np.uint8).reshape(bitmap.height, bitmap.width, 4)
+    return rgba[:,:,:3]
+
+def preview_screenshot(pixels):
+    """
+    Shows the current colorgrade applied to a screenshot (a uint8 image of shape (height, width, 3)),
+    dithered if selected
+    """
+    image = pixels / 255
+    cg_steps = compute_colorgrade_steps()
+    
+    method = document.getElementById("screenshot-dither").value
+    dithering = None if method == 'none' else get_dither_palette(cg_steps)
+    if dithering is not None:
+        # Dither the screenshot as graded up to the palettizing step, so flat areas are dithered too
+        # (after it, every color in a cell of the colorgrade would already be one of the palette)
+        cg_in, palette, space, kernels = dithering
+        graded = dither_palettize(apply_colorgrade(cg_in, image), palette, method=method, mode=space)
+        for kernel in kernels:
+            graded = kernel(graded.reshape(-1, 3)).reshape(graded.shape)
+    else:
+        cg = cg_steps[-1]
+        graded = apply_colorgrade(cg, image)
+        if method != 'none':
+            palette = np.unique(cg.reshape(-1, 3), axis=0)
+            if len(palette) > screenshot_max_palette:
+                raise ValueError(
+                    f"dithering needs a colorgrade with at most {screenshot_max_palette} colors "
+                    f"(this one has {len(palette)}), such as one ending in Palettize"
+                )
+            graded = dither_palettize(graded, palette, method=method)
+    
+    screenshot_canvas = document.getElementById("screenshot-canvas")
+    screenshot_canvas.width = image.shape[1]
+    screenshot_canvas.height = image.shape[0]
+    screenshot_canvas.getContext("2d").putImageData(
+        to_image_data(np.clip(255 * graded, 0, 255).astype(np.uint8)), 0, 0
+    )
+    
+def get_dither_palette(cg_steps):
+    """
+    Finds the step that palettizes the final colorgrade, followed only by steps acting on each color
+    that each read the step before them. Returns (its input colorgrade, palette, color space,
+    kernels of the steps after it), or None if there is no such step.
+    """
+    kernels = []
+    i = len(process_steps)
+    while i > 0:
+        step = process_steps[i-1]
+        target = range(i)[step.get_target_index()] if step.has_input() else None
+        target_palette = step.get_target_palette(cg_steps[:i]) if target is not None else None
+        if target_palette is not None:
+            palette, space = target_palette
+            return cg_steps[target], palette, space, kernels[::-1]
+        
+        kernel = step.get_kernel()
+        if kernel is None or target != i - 1:
+            return None
+        kernels.append(kernel)
+        i -= 1
+    return None
+
+@display_errors
+def explore_variations():
+    """
+    Renders random variations of the current steps, and shows them all in the variations canvas at once
+    """
+    global shown_variations
+    from colorgrade_variations import sample_variations, render_variations, variations_image
+    n_variants = int(document.getElementById("variations-count").value)
+    strength = float(document.getElementById("variations-strength").value)
+    seed = int(document.getElementById("variations-seed").value)
+    if n_variants < 1:
+        raise ValueError("the number of variations must be at least 1")
+    
+    ser_list = [step.serialize() for step in process_steps]
+    values = sample_variations(ser_list, n_variants, strength=strength, seed=seed)
+    image = variations_image(render_variations(ser_list, values), columns=variations_columns)
+    shown_variations = (ser_list, values)
+    
+    variations_canvas = document.getElementById("variations-canvas")
+    variations_canvas.width = image.shape[1]
+    variations_canvas.height = image.shape[0]
+    variations_canvas.getContext("2d").putImageData(to_image_data(image), 0, 0)
+    
+@display_errors
+def pick_variation(x, y):
+    """
+    Loads the values of the variation at the given pixel of the variations canvas into the steps
+    """
+    from colorgrade_variations import variation_at, variation_steps
+    if shown_variations is None:
+        return
+    ser_list, values = shown_variations
+    n_variants = len(next(v for step_values in values for v in step_values.values()))
+    
+    index = variation_at(x, y, n_variants, columns=variations_columns)
+    if index is None:
+        return
+    load_steps(variation_steps(ser_list, values, index))
+    generate()
+    
+def download_file(filename, contents, mime_type):
+    """
+    Has the browser download the given contents (str or bytes) as a file
+    """
+    blob = js.Blob.new(
+        to_js([contents]),
+        to_js({'type': mime_type}, dict_converter=js.Object.fromEntries)
+    )
+    url = js.URL.createObjectURL(blob)
+    
+    link = document.createElement('a')
+    link.href = url
+    link.download = filename
+    link.click()
+    js.URL.revokeObjectURL(url)
+
 
 # Proxy functions
 js.move_step_up = create_proxy(move_step_up)
@@ -378,3 +907,5 @@ js.create_process_step_proxy = create_proxy(create_process_step)
 js.remove_process_step_proxy = create_proxy(remove_process_step)
 js.import_serialization_proxy = create_proxy(import_serialization)
 js.export_serialization_proxy = create_proxy(export_serialization)
+js.export_share_link_proxy = create_proxy(export_share_link)
+refine_preview_proxy = create_proxy(refine_preview)
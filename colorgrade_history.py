@@ -0,0 +1,148 @@
+"""
+Undo/redo history of pipelines, with the results of their steps cached
+so that going back to an earlier state doesn't need anything recomputed.
+"""
+
+from collections import OrderedDict
+from colorgrade_core import *
+from colorgrade_engine import create_steps, get_live_steps, _run_group
+
+class PipelineHistory:
+    """
+    A list of pipeline states that can be stepped back and forth through.
+
+    States are stored as tuples of step definitions, and identical step definitions
+    are only stored once, so states that share most of their steps take little extra memory.
+    The output of every step is cached by the steps leading up to it, so that any state
+    whose steps were computed before (in this or another state) is shown without recomputing them.
+    """
+    def __init__(self, max_states=200, max_cache_bytes=64 << 20):
+        """
+        Keeps at most `max_states` states, and at most `max_cache_bytes` of cached colorgrades;
+        the least recently used ones are dropped first
+        """
+        self.max_states = max_states
+        self.max_cache_bytes = max_cache_bytes
+
+        self.states = []
+        self.position = -1
+
+        # Canonical copy of each step definition
+        self._step_defs = dict()
+        # Step outputs by (size, definitions of the steps up to and including it)
+        self._cache = OrderedDict()
+        self.cache_bytes = 0
+
+    def record(self, ser_list):
+        """
+        Adds the serialized steps as the newest state, dropping any states that were undone.
+        Returns False if they are the same as the current state.
+        """
+        state = self._to_state(ser_list)
+        if self.position >= 0 and self.states[self.position] == state:
+            return False
+
+        del self.states[self.position + 1:]
+        self.states.append(state)
+        if len(self.states) > self.max_states:
+            del self.states[:len(self.states) - self.max_states]
+            self._forget_unused_step_defs()
+        self.position = len(self.states) - 1
+        return True
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.states) - 1
+
+    def undo(self):
+        """
+        Moves back one state and returns its serialized steps, or None if there is nothing to undo
+        """
+        if not self.can_undo():
+            return None
+        self.position -= 1
+        return self.current()
+
+    def redo(self):
+        """
+        Moves forward one state and returns its serialized steps, or None if there is nothing to redo
+        """
+        if not self.can_redo():
+            return None
+        self.position += 1
+        return self.current()
+
+    def current(self):
+        """
+        Returns the serialized steps of the current state
+        """
+        if self.position < 0:
+            return None
+        return self._to_ser_list(self.states[self.position])
+
+    def render(self, ser_list, size=16, prune=False, budget=None, tile_sizes=None):
+        """
+        Returns the colorgrades produced by each of the serialized steps (as `run_pipeline` does),
+        only computing the steps that aren't cached.
+        If `prune`, steps that the final colorgrade doesn't depend on are skipped, and their results left as None.
+        With a `budget`, steps are limited as `run_pipeline` limits them; `tile_sizes` is from `plan_budget`.
+        The returned colorgrades are shared with the cache, so must not be modified.
+        """
+        state = self._to_state(ser_list)
+        steps = create_steps(ser_list)
+        kernels = [None] * len(steps)
+        live = get_live_steps(steps) if prune else None
+        cg_steps = [get_default_colorgrade(size)]
+
+        for i in range(1, len(state) + 1):
+            if live is not None and i not in live:
+                cg_steps.append(None)
+                continue
+
+            key = (size, state[:i])
+            cg = self._cache.get(key)
+            if cg is not None:
+                self._cache.move_to_end(key)
+            else:
+                cg = _run_group(
+                    [i], steps, kernels, cg_steps, False, None, budget=budget, tile_sizes=tile_sizes
+                )
+                self._add_to_cache(key, cg)
+            cg_steps.append(cg)
+
+        return cg_steps
+
+    def clear_cache(self):
+        """
+        Drops all cached colorgrades, e.g. when something they depend on outside of the steps changed
+        """
+        self._cache.clear()
+        self.cache_bytes = 0
+
+    def _add_to_cache(self, key, cg):
+        cg = np.asarray(cg)
+        if cg.nbytes > self.max_cache_bytes:
+            return
+        cg.flags.writeable = False
+
+        self._cache[key] = cg
+        self.cache_bytes += cg.nbytes
+        while self.cache_bytes > self.max_cache_bytes:
+            _, dropped = self._cache.popitem(last=False)
+            self.cache_bytes -= dropped.nbytes
+
+    def _to_state(self, ser_list):
+        state = []
+        for name, params in ser_list:
+            step_def = (name, tuple(sorted(params.items())))
+            state.append(self._step_defs.setdefault(step_def, step_def))
+        return tuple(state)
+
+    def _to_ser_list(self, state):
+        return [(name, dict(params)) for name, params in state]
+
+    def _forget_unused_step_defs(self):
+        used = set(step_def for state in self.states for step_def in state)
+        self._step_defs = {step_def: step_def for step_def in used}
@@ -0,0 +1,343 @@
+"""
+Reading and writing colorgrades in formats used by other tools:
+.cube LUT files, Hald CLUT images, and PNG images.
+"""
+
+import re
+import struct
+import zlib
+import numpy as np
+from colorgrade_core import *
+
+# Size of the blocks read at a time when streaming a file
+CHUNK_SIZE = 1 << 20
+
+## .cube files
+
+def read_cube(path):
+    """
+    Reads the .cube file at the given path, see `parse_cube`
+    """
+    with open(path, 'rb') as f:
+        return parse_cube(f)
+
+def parse_cube(source):
+    """
+    Parses a 3D .cube LUT and returns it as a colorgrade of shape (n,n,n,3).
+    `source` is either the contents of the file (str or bytes) or a binary file object,
+    which is read in blocks.
+
+    The header is read line by line; the data itself is parsed a whole block at a time by numpy.
+    """
+    size = None
+    domain_min = np.zeros(3)
+    domain_max = np.ones(3)
+
+    values = None
+    n_values = 0
+    in_header = True
+    remainder = b''
+
+    for chunk in _iter_chunks(source):
+        block = remainder + chunk
+        if chunk:
+            # Only parse complete lines, keeping the rest for the next block
+            cut = block.rfind(b'\n') + 1
+            block, remainder = block[:cut], block[cut:]
+        else:
+            remainder = b''
+
+        if in_header:
+            # Go through header lines until the first line of data
+            lines = block.split(b'\n')
+            for i, line in enumerate(lines):
+                line = line.strip()
+                if len(line) == 0 or line.startswith(b'#'):
+                    continue
+                if line[:1].isdigit() or line[:1] in b'-+.':
+                    in_header = False
+                    block = b'\n'.join(lines[i:])
+                    break
+
+                keyword, _, rest = line.partition(b' ')
+                keyword = keyword.upper()
+                if keyword == b'LUT_3D_SIZE':
+                    size = int(rest)
+                elif keyword == b'LUT_1D_SIZE':
+                    raise ValueError("1D .cube LUTs are not supported")
+                elif keyword == b'DOMAIN_MIN':
+                    domain_min = np.array(rest.split(), dtype=float)
+                elif keyword == b'DOMAIN_MAX':
+                    domain_max = np.array(rest.split(), dtype=float)
+                elif keyword == b'LUT_3D_INPUT_RANGE':
+                    lo, hi = rest.split()
+                    domain_min = np.full(3, float(lo))
+                    domain_max = np.full(3, float(hi))
+                # TITLE and anything else is ignored
+
+            if in_header:
+                continue
+            if size is None:
+                raise ValueError("missing LUT_3D_SIZE in .cube header")
+            values = np.empty(size**3 * 3)
+
+        if b'#' in block:
+            block = re.sub(rb'#[^\n]*', b'', block)
+        parsed = np.fromstring(block, dtype=float, sep=' ')
+
+        if n_values + len(parsed) > len(values):
+            raise ValueError(f"too many values in .cube file for LUT_3D_SIZE {size}")
+        values[n_values:n_values+len(parsed)] = parsed
+        n_values += len(parsed)
+
+    if values is None or n_values != len(values):
+        raise ValueError(
+            f"expected {0 if size is None else size**3} colors in .cube file, got {n_values // 3}"
+        )
+
+    # Red changes fastest, so the data is ordered [b,g,r]
+    cg = values.reshape(size, size, size, 3).transpose(2,1,0,3)
+
+    if np.any(domain_min != 0) or np.any(domain_max != 1):
+        # The LUT is sampled over a different range of input colors
+        points = (get_default_colorgrade(size) - domain_min) / (domain_max - domain_min)
+        cg = apply_colorgrade(cg, points)
+
+    return np.ascontiguousarray(cg)
+
+def format_cube(cg, title=None):
+    """
+    Returns the text of a .cube file for the colorgrade
+    """
+    return ''.join(_iter_cube_text(cg, title))
+
+def write_cube(path, cg, title=None):
+    """
+    Writes the colorgrade as a .cube file to the given path, a block of lines at a time
+    """
+    with open(path, 'w') as f:
+        for text in _iter_cube_text(cg, title):
+            f.write(text)
+
+def _iter_cube_text(cg, title):
+    size = cg.shape[0]
+    header = ''
+    if title is not None:
+        header += f'TITLE "{title}"\n'
+    header += f'LUT_3D_SIZE {size}\n'
+    yield header
+
+    data = np.clip(cg, 0, 1).transpose(2,1,0,3).reshape(-1, 3)
+    lines_per_block = CHUNK_SIZE // 32
+    for start in range(0, len(data), lines_per_block):
+        block = data[start:start+lines_per_block]
+        yield ('%.6f %.6f %.6f\n' * len(block)) % tuple(block.ravel().tolist())
+
+def _iter_chunks(source):
+    """
+    Yields blocks of bytes from the source, followed by a final empty block
+    """
+    if isinstance(source, str):
+        source = source.encode()
+    if isinstance(source, (bytes, bytearray)):
+        for start in range(0, len(source), CHUNK_SIZE):
+            yield bytes(source[start:start+CHUNK_SIZE])
+    else:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if not chunk:
+                break
+            yield chunk
+    yield b''
+
+## Hald CLUT images
+
+def hald_to_colorgrade(image):
+    """
+    Converts a Hald CLUT image (uint8 array of shape (level**3, level**3, 3 or 4))
+    to a colorgrade of shape (level**2, level**2, level**2, 3)
+    """
+    height, width = image.shape[:2]
+    level = round(width ** (1/3))
+    if width != height or level**3 != width:
+        raise ValueError(f"invalid Hald CLUT image size {width}x{height}")
+    size = level**2
+
+    # Pixels are in the same order as .cube data: red fastest, then green, then blue
+    data = image[:,:,:3].reshape(size, size, size, 3)
+    return data.transpose(2,1,0,3) / 255
+
+def colorgrade_to_hald(cg):
+    """
+    Converts a colorgrade to a Hald CLUT image, as a uint8 array.
+    The colorgrade's size needs to be a perfect square (e.g. 16 or 64).
+    """
+    size = cg.shape[0]
+    level = round(size ** 0.5)
+    if level**2 != size:
+        raise ValueError(f"colorgrade size {size} is not a perfect square; resample it first")
+
+    data = np.clip(np.round(255 * cg.transpose(2,1,0,3)), 0, 255).astype(np.uint8)
+    return data.reshape(level**3, level**3, 3)
+
+## PNG images
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def encode_png(image):
+    """
+    Encodes a uint8 image of shape (height, width, 3 or 4) as a PNG file, returned as bytes
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width, channels = image.shape
+    color_type = {3: 2, 4: 6}[channels]
+
+    # Every scanline uses filter type 0 (none)
+    raw = np.zeros((height, width*channels + 1), dtype=np.uint8)
+    raw[:,1:] = image.reshape(height, -1)
+
+    return b''.join([
+        PNG_SIGNATURE,
+        _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)),
+        _png_chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        _png_chunk(b'IEND', b''),
+    ])
+
+def decode_png(data):
+    """
+    Decodes a (non-interlaced) PNG file given as bytes.
+    Returns a uint8 image of shape (height, width, 3), or (height, width, 4) if it has transparency.
+    """
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("not a PNG file")
+
+    pos = 8
+    idat = []
+    palette = None
+    header = None
+    while pos < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos+8])
+        body = data[pos+8:pos+8+length]
+        pos += 12 + length
+        if chunk_type == b'IHDR':
+            header = struct.unpack('>IIBBBBB', body)
+        elif chunk_type == b'PLTE':
+            palette = np.frombuffer(body, dtype=np.uint8).reshape(-1, 3)
+        elif chunk_type == b'IDAT':
+            idat.append(body)
+        elif chunk_type == b'IEND':
+            break
+
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if interlace != 0:
+        raise ValueError("interlaced PNG images are not supported")
+    if bit_depth not in (8, 16) or (color_type == 3 and bit_depth != 8):
+        raise ValueError(f"unsupported PNG bit depth {bit_depth}")
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    bpp = channels * bit_depth // 8
+
+    raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8)
+    raw = raw.reshape(height, width*bpp + 1)
+    pixels = _unfilter_png(raw[:,1:], raw[:,0], bpp)
+
+    if bit_depth == 16:
+        # Keep the most significant byte
+        pixels = pixels[:,0::2]
+    pixels = pixels.reshape(height, width, channels)
+
+    if color_type == 3:
+        return palette[pixels[:,:,0]]
+    if color_type in (0, 4):
+        # Grayscale
+        gray = np.repeat(pixels[:,:,:1], 3, axis=2)
+        return gray if color_type == 0 else np.concatenate((gray, pixels[:,:,1:]), axis=2)
+    return pixels
+
+def _png_chunk(chunk_type, body):
+    return (
+        struct.pack('>I', len(body)) + chunk_type + body
+        + struct.pack('>I', zlib.crc32(chunk_type + body) & 0xFFFFFFFF)
+    )
+
+def _unfilter_png(filtered, filter_types, bpp):
+    """
+    Undoes the per-scanline filters of a PNG image
+    """
+    if np.any(filter_types >= 3):
+        return _unfilter_png_wavefront(filtered, filter_types, bpp)
+
+    height, stride = filtered.shape
+    result = np.zeros((height + 1, stride), dtype=np.uint8)
+
+    for y in range(height):
+        line = filtered[y]
+        filter_type = filter_types[y]
+
+        if filter_type == 0:
+            recon = line
+        elif filter_type == 1:
+            # Sub: a running sum along each byte of the pixel (wrapping around at 256)
+            recon = np.cumsum(line.reshape(-1, bpp), axis=0, dtype=np.uint8).ravel()
+        else:
+            recon = line + result[y]
+
+        result[y+1] = recon
+
+    return result[1:]
+
+def _unfilter_png_wavefront(filtered, filter_types, bpp):
+    """
+    Undoes the filters of an image using Average or Paeth, which depend on the reconstructed pixels
+    to the left, above and above-left. All pixels on a diagonal (x + y the same) only depend on earlier
+    diagonals, so each diagonal is reconstructed at once, with every row using its own filter.
+    """
+    height, stride = filtered.shape
+    width = stride // bpp
+    n_diagonals = height + width - 1
+
+    # Skewed so that each diagonal is a column: pixel (y, x) is at [y, x + y]
+    pixels = np.zeros((height, n_diagonals, bpp), dtype=np.int16)
+    for y in range(height):
+        pixels[y, y:y+width] = filtered[y].reshape(width, bpp)
+    # Reconstructed pixels, skewed the same way but with a row and two columns of zeros before them,
+    # which also gives zeros to the left of and above the image
+    recon = np.zeros((height + 1, n_diagonals + 2, bpp), dtype=np.int16)
+    types = filter_types.astype(np.int16)[:, None]
+    is_sub, is_up, is_average, is_paeth = (types == 1), (types == 2), (types == 3), (types == 4)
+
+    for d in range(n_diagonals):
+        lo, hi = max(0, d - width + 1), min(height, d + 1)
+        left = recon[lo+1:hi+1, d+1]
+        up = recon[lo:hi, d+1]
+        up_left = recon[lo:hi, d]
+
+        # Paeth: whichever of left, up and up-left is closest to left + up - up-left
+        pa, pb, pc = np.abs(up - up_left), np.abs(left - up_left), np.abs(left + up - 2*up_left)
+        paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+
+        predictor = np.select(
+            [is_sub[lo:hi], is_up[lo:hi], is_average[lo:hi], is_paeth[lo:hi]],
+            [left, up, (left + up) >> 1, paeth],
+            0,
+        )
+        recon[lo+1:hi+1, d+2] = (pixels[lo:hi, d] + predictor) & 0xFF
+
+    result = np.empty((height, width, bpp), dtype=np.uint8)
+    for y in range(height):
+        result[y] = recon[y+1, y+2:y+2+width]
+    return result.reshape(height, stride)
+
+def read_lut_file(name, data):
+    """
+    Reads a LUT from the contents of a file, choosing the format from the file name:
+    either a .cube file, or a .png that is a Hald CLUT image or a Celeste colorgrade image
+    """
+    if name.lower().endswith('.png'):
+        image = decode_png(data)
+        if image.shape[1] == image.shape[0]**2:
+            return image_to_colorgrade(image)
+        return hald_to_colorgrade(image)
+    else:
+        return parse_cube(data)
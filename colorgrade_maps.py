@@ -0,0 +1,362 @@
+"""
+Builds every colorgrade used by a set of Celeste maps.
+
+The maps (.bin files) are scanned for attributes naming a colorgrade
+(such as the map's ColorGrade, or a trigger's colorGrade / colorGradeA / colorGradeB),
+and each name is looked up in a manifest, a JSON file giving the steps for each colorgrade:
+    {
+        "colorgrades": {
+            "MyMod/sunset": "pipelines/sunset.json",
+            "MyMod/cave": {"format": "celeste-colorgrade-pipeline", "version": 1, "steps": [...]}
+        },
+        "luts": {"film.cube": "luts/film.cube"}
+    }
+Pipelines are given either inline or as the path of an exported file, relative to the manifest;
+"luts" lists files for any Import LUT steps to use.
+
+Only colorgrades that are missing or whose steps changed since the last build are rendered,
+into the mod's Graphics/ColorGrading folder. Run as a script:
+    python colorgrade_maps.py manifest.json path/to/Mod Maps/MyMod/*.bin
+"""
+
+import hashlib
+import json
+import os
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from colorgrade_core import *
+from colorgrade_engine import *
+from colorgrade_io import encode_png, read_lut_file
+
+# Stores what was built last time, in the output folder
+BUILD_STATE_FILE = '.colorgrade_build.json'
+
+# Values that mean no colorgrade
+NO_COLORGRADE = {'', 'none'}
+
+# LUTs read by any build, by their name (which gives the format) and the hash of their file's contents
+_loaded_luts = dict()
+
+BuildResult = namedtuple('BuildResult', [
+    'rendered',     # names of the colorgrades that were rendered
+    'up_to_date',   # names of the colorgrades that were already built
+    'unmapped',     # names referenced by the maps but not in the manifest
+    'failed',       # dictionary of names to error messages
+])
+
+## Reading maps
+
+def read_map_colorgrades(path):
+    """
+    Returns the set of colorgrade names referenced by the map at the given path
+    """
+    with open(path, 'rb') as f:
+        return find_colorgrade_references(f.read())
+
+def find_colorgrade_references(data):
+    """
+    Returns the set of colorgrade names referenced in the contents of a map .bin file:
+    the values of every attribute whose name contains "colorgrade" (in any case)
+    """
+    reader = _MapReader(data)
+    if reader.string() != 'CELESTE MAP':
+        raise ValueError("not a Celeste map file")
+    reader.string()  # package name
+
+    lookup = [reader.string() for _ in range(reader.short())]
+    wanted = set(i for i, name in enumerate(lookup) if 'colorgrade' in name.lower())
+
+    names = set()
+    # Elements left to read, as a stack of the number of children remaining at each level
+    remaining = [1]
+    while len(remaining) > 0:
+        if remaining[-1] == 0:
+            remaining.pop()
+            continue
+        remaining[-1] -= 1
+
+        reader.short()  # element name
+        for _ in range(reader.byte()):
+            key = reader.short()
+            value = reader.value(lookup, decode=key in wanted)
+            if key in wanted and isinstance(value, str) and value.lower() not in NO_COLORGRADE:
+                names.add(value)
+
+        remaining.append(reader.short())
+
+    return names
+
+class _MapReader:
+    """
+    Reads the values of a map .bin file, which is written with .NET's BinaryWriter
+    """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt, size):
+        value = struct.unpack_from(fmt, self.data, self.pos)[0]
+        self.pos += size
+        return value
+
+    def byte(self):
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def short(self):
+        return self.unpack('<h', 2)
+
+    def string_length(self):
+        # 7 bits at a time, lowest first
+        length, shift = 0, 0
+        while True:
+            b = self.byte()
+            length |= (b & 0x7F) << shift
+            shift += 7
+            if b < 0x80:
+                return length
+
+    def string(self):
+        length = self.string_length()
+        self.pos += length
+        return self.data[self.pos - length:self.pos].decode('utf-8')
+
+    def value(self, lookup, decode=True):
+        """
+        Reads an attribute value; strings are only decoded if `decode`
+        """
+        value_type = self.byte()
+        if value_type == 0:
+            return self.byte() != 0
+        elif value_type == 1:
+            return self.byte()
+        elif value_type == 2:
+            return self.short()
+        elif value_type == 3:
+            return self.unpack('<i', 4)
+        elif value_type == 4:
+            return self.unpack('<f', 4)
+        elif value_type == 5:
+            return lookup[self.short()]
+        elif value_type == 6:
+            if decode:
+                return self.string()
+            length = self.string_length()
+            self.pos += length
+            return None
+        elif value_type == 7:
+            # Run-length encoded string (used for tile data): pairs of (count, character)
+            length = self.short()
+            self.pos += length
+            if not decode:
+                return None
+            pairs = self.data[self.pos - length:self.pos]
+            return ''.join(chr(c) * n for n, c in zip(pairs[0::2], pairs[1::2]))
+
+        raise ValueError(f"unknown value type {value_type} in map file")
+
+## Manifest
+
+def load_manifest(path):
+    """
+    Reads a manifest, returning a dictionary of colorgrade names to their serialized steps,
+    and a dictionary of LUT names to file paths
+    """
+    from colorgrade_serialization import parse_serialization, from_document, validate_steps
+
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+
+    pipelines = dict()
+    for name, entry in manifest.get('colorgrades', dict()).items():
+        try:
+            if isinstance(entry, str):
+                with open(os.path.join(base, entry)) as f:
+                    pipelines[name] = parse_serialization(f.read())
+            elif isinstance(entry, dict):
+                pipelines[name] = from_document(entry)
+            else:
+                pipelines[name] = validate_steps(entry)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"invalid manifest entry for '{name}': {e}") from e
+
+    luts = {
+        name: os.path.join(base, lut_path)
+        for name, lut_path in manifest.get('luts', dict()).items()
+    }
+    return pipelines, luts
+
+def colorgrade_path(output_dir, name):
+    """
+    Returns where Celeste looks for the colorgrade with the given name, under Graphics/ColorGrading
+    """
+    parts = name.replace('\\', '/').split('/')
+    if any(part in ('', '.', '..') for part in parts):
+        raise ValueError(f"invalid colorgrade name '{name}'")
+    return os.path.join(output_dir, *parts) + '.png'
+
+def pipeline_hash(ser_list, lut_paths):
+    """
+    Returns a hash identifying the rendered result of the steps,
+    including the contents of any LUTs they import
+    """
+    from colorgrade_serialization import to_json
+
+    digest = hashlib.sha256(to_json(ser_list).encode())
+    for name, params in ser_list:
+        if name == 'import-lut':
+            lut_name = params.get('name', '')
+            if lut_name not in lut_paths:
+                raise ValueError(f"no LUT named '{lut_name}' in the manifest")
+            with open(lut_paths[lut_name], 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+
+    return digest.hexdigest()
+
+def load_pipeline_luts(ser_list, lut_paths):
+    """
+    Reads the LUTs imported by the steps into `imported_luts`.
+    Files are only read again when their contents changed, so a LUT edited since an earlier build is picked up.
+    """
+    for name, params in ser_list:
+        if name != 'import-lut':
+            continue
+        lut_name = params.get('name', '')
+        if lut_name not in lut_paths:
+            raise ValueError(f"no LUT named '{lut_name}' in the manifest")
+        with open(lut_paths[lut_name], 'rb') as f:
+            data = f.read()
+        
+        key = (lut_name, hashlib.sha256(data).hexdigest())
+        if key not in _loaded_luts:
+            try:
+                _loaded_luts[key] = read_lut_file(lut_name, data)
+            except Exception as e:
+                raise ValueError(f"could not read LUT '{lut_name}': {e}") from e
+        imported_luts[lut_name] = _loaded_luts[key]
+
+## Building
+
+def build_colorgrades(manifest_path, map_paths, mod_dir, force=False, max_workers=None):
+    """
+    Renders every colorgrade referenced by the maps into the mod's Graphics/ColorGrading folder,
+    skipping the ones that are already up to date (unless `force`).
+    Returns a BuildResult.
+    """
+    output_dir = os.path.join(mod_dir, 'Graphics', 'ColorGrading')
+    state_path = os.path.join(output_dir, BUILD_STATE_FILE)
+    state = _load_state(state_path)
+
+    # Maps that haven't changed since last time don't need to be read again
+    names = set()
+    map_state = dict()
+    for path in map_paths:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = state['maps'].get(key)
+        if cached is not None and cached['mtime_ns'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            map_names = cached['names']
+        else:
+            map_names = sorted(read_map_colorgrades(path))
+        map_state[key] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'names': map_names}
+        names.update(map_names)
+
+    pipelines, lut_paths = load_manifest(manifest_path)
+    unmapped = sorted(names - set(pipelines))
+
+    to_render = dict()
+    up_to_date = []
+    failed = dict()
+    for name in sorted(names & set(pipelines)):
+        try:
+            path = colorgrade_path(output_dir, name)
+            hash_value = pipeline_hash(pipelines[name], lut_paths)
+        except (OSError, ValueError) as e:
+            failed[name] = str(e)
+            continue
+        if not force and state['colorgrades'].get(name) == hash_value and os.path.exists(path):
+            up_to_date.append(name)
+        else:
+            to_render[name] = (path, hash_value)
+
+    # Load the LUTs that the pipelines being rendered import; a LUT that can't be read only fails its pipelines
+    for name in list(to_render):
+        try:
+            load_pipeline_luts(pipelines[name], lut_paths)
+        except (OSError, ValueError) as e:
+            failed[name] = str(e)
+            del to_render[name]
+            state['colorgrades'].pop(name, None)
+
+    def render(name):
+        path, _ = to_render[name]
+        steps = create_steps(pipelines[name])
+        # Colorgrades are small, so each one runs on a single thread; the pool works on several at once
+        cg = run_pipeline(steps, size=16, parallel=False, tiled=False, fuse=True, compress=True)[-1]
+        _write_file(path, encode_png(process_colorgrade(cg).transpose(1,0,2)))
+
+    rendered = []
+    if len(to_render) > 0:
+        with ThreadPoolExecutor(max_workers=max_workers if threads_available(max_workers) else 1) as pool:
+            futures = {name: pool.submit(render, name) for name in to_render}
+            for name, future in futures.items():
+                try:
+                    future.result()
+                    rendered.append(name)
+                    state['colorgrades'][name] = to_render[name][1]
+                except Exception as e:
+                    failed[name] = str(e)
+                    state['colorgrades'].pop(name, None)
+
+    state['maps'] = map_state
+    os.makedirs(output_dir, exist_ok=True)
+    _write_file(state_path, json.dumps(state, indent=1).encode())
+
+    return BuildResult(rendered=rendered, up_to_date=up_to_date, unmapped=unmapped, failed=failed)
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        return {'maps': state.get('maps', dict()), 'colorgrades': state.get('colorgrades', dict())}
+    except (OSError, ValueError):
+        return {'maps': dict(), 'colorgrades': dict()}
+
+def _write_file(path, data):
+    """
+    Writes the file through a temporary one, so an interrupted build never leaves a partial file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render the colorgrades used by Celeste maps")
+    parser.add_argument('manifest', help="JSON file with the steps for each colorgrade")
+    parser.add_argument('mod_dir', help="the mod's folder; images go in Graphics/ColorGrading")
+    parser.add_argument('maps', nargs='+', help="map .bin files to scan")
+    parser.add_argument('--force', action='store_true', help="render every colorgrade, even if up to date")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    result = build_colorgrades(args.manifest, args.maps, args.mod_dir, force=args.force, max_workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    for name in result.rendered:
+        print(f"rendered   {name}")
+    for name in result.unmapped:
+        print(f"not in manifest: {name}")
+    for name, message in result.failed.items():
+        print(f"failed     {name}: {message}")
+    print(
+        f"{len(result.rendered)} rendered, {len(result.up_to_date)} up to date, "
+        f"{len(result.unmapped)} not in manifest, {len(result.failed)} failed, in {elapsed:.3f} s"
+    )
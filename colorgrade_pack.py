@@ -0,0 +1,247 @@
+"""
+A library of many colorgrades in a single file.
+
+The file is a short header followed by fixed-size records, one per colorgrade:
+the colorgrade as a uint8 image of shape (16, 256, 3) (as it is saved for Celeste),
+its name, and optionally the steps that made it (in the compact serialized form).
+Since every record is the same size, opening a pack only reads the header,
+records are read straight from a memory map, and adding colorgrades only appends to the file.
+
+Can also be run as a script:
+    python colorgrade_pack.py library.cgpack add Graphics/ColorGrading/MyMod/*.png
+    python colorgrade_pack.py library.cgpack list
+    python colorgrade_pack.py library.cgpack nearest some_colorgrade.png
+    python colorgrade_pack.py library.cgpack extract MyMod/sunset sunset.png
+"""
+
+import os
+import struct
+import numpy as np
+from colorgrade_core import *
+
+PACK_MAGIC = b'CGPACK\x00\x00'
+PACK_VERSION = 1
+# magic, version, colorgrade size, bytes for the name, bytes for the steps
+HEADER_FORMAT = '<8sIIII'
+HEADER_SIZE = 64
+
+class LUTPack:
+    """
+    A pack file of colorgrades, opened for reading and appending
+    """
+    def __init__(self, path):
+        """
+        Opens an existing pack (see `create` for making a new one)
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError("not a colorgrade pack file")
+
+        magic, version, size, name_bytes, steps_bytes = struct.unpack_from(HEADER_FORMAT, header)
+        if magic != PACK_MAGIC:
+            raise ValueError("not a colorgrade pack file")
+        if version > PACK_VERSION:
+            raise ValueError(f"pack version {version} is newer than this version of the generator supports")
+
+        self.size = size
+        self.dtype = np.dtype([
+            ('image', np.uint8, (size, size*size, 3)),
+            ('name', f'S{name_bytes}'),
+            ('steps', f'S{steps_bytes}'),
+        ])
+        self._records = None
+        self._name_index = None
+
+    @classmethod
+    def create(cls, path, size=16, name_bytes=128, steps_bytes=1024):
+        """
+        Creates a new, empty pack file, replacing any existing file
+        """
+        with open(path, 'wb') as f:
+            header = struct.pack(HEADER_FORMAT, PACK_MAGIC, PACK_VERSION, size, name_bytes, steps_bytes)
+            f.write(header.ljust(HEADER_SIZE, b'\x00'))
+        return cls(path)
+
+    @classmethod
+    def open_or_create(cls, path, **kwargs):
+        if os.path.exists(path):
+            return cls(path)
+        return cls.create(path, **kwargs)
+
+    def __len__(self):
+        # Any incomplete record at the end (from an interrupted write) is ignored
+        return (os.path.getsize(self.path) - HEADER_SIZE) // self.dtype.itemsize
+
+    @property
+    def records(self):
+        """
+        The records as a read-only memory-mapped structured array, with fields 'image', 'name' and 'steps'
+        """
+        n_records = len(self)
+        if self._records is None or len(self._records) != n_records:
+            if n_records == 0:
+                self._records = np.zeros(0, dtype=self.dtype)
+            else:
+                self._records = np.memmap(
+                    self.path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(n_records,)
+                )
+        return self._records
+
+    def append(self, name, cg, ser_list=None):
+        """
+        Adds a colorgrade (of shape (n,n,n,3), resampled to the pack's size if needed)
+        with its name and optionally the steps that made it.
+        A colorgrade with the same name as an earlier one replaces it in lookups.
+        Returns the index of the new record.
+        """
+        return self.extend([(name, cg, ser_list)])[0]
+
+    def extend(self, items):
+        """
+        Adds several (name, colorgrade, steps or None) at once; returns their indices
+        """
+        from colorgrade_serialization import to_compact
+
+        records = np.zeros(len(items), dtype=self.dtype)
+        for record, (name, cg, ser_list) in zip(records, items):
+            encoded_name = name.encode('utf-8')
+            encoded_steps = b'' if ser_list is None else to_compact(ser_list).encode()
+            if len(encoded_name) > self.dtype['name'].itemsize:
+                raise ValueError(f"name '{name}' is too long for this pack")
+            if len(encoded_steps) > self.dtype['steps'].itemsize:
+                raise ValueError(f"the steps of '{name}' are too long for this pack")
+
+            record['image'] = process_colorgrade(resample_colorgrade(cg, self.size)).transpose(1,0,2)
+            record['name'] = encoded_name
+            record['steps'] = encoded_steps
+
+        start = len(self)
+        with open(self.path, 'r+b') as f:
+            # Write over any incomplete record at the end
+            f.seek(HEADER_SIZE + start * self.dtype.itemsize)
+            f.write(records.tobytes())
+            f.truncate()
+
+        indices = list(range(start, start + len(items)))
+        if self._name_index is not None:
+            for i, (name, _, _) in zip(indices, items):
+                self._name_index[name] = i
+        return indices
+
+    def name(self, i):
+        return self.records['name'][i].decode('utf-8')
+
+    def names(self):
+        return [name.decode('utf-8') for name in self.records['name']]
+
+    def find(self, name):
+        """
+        Returns the index of the latest colorgrade with the given name, or None
+        """
+        if self._name_index is None:
+            # Built the first time it's needed, so that opening stays quick
+            self._name_index = {n: i for i, n in enumerate(self.names())}
+        return self._name_index.get(name)
+
+    def _index(self, key):
+        if isinstance(key, str):
+            i = self.find(key)
+            if i is None:
+                raise KeyError(key)
+            return i
+        return key
+
+    def get_image(self, key):
+        """
+        Returns the colorgrade image (uint8, (size, size*size, 3)) by index or name
+        """
+        return self.records['image'][self._index(key)]
+
+    def get_colorgrade(self, key):
+        """
+        Returns the colorgrade (n,n,n,3) by index or name
+        """
+        return image_to_colorgrade(self.get_image(key))
+
+    def get_steps(self, key):
+        """
+        Returns the serialized steps stored with a colorgrade (by index or name), or None
+        """
+        from colorgrade_serialization import parse_serialization
+
+        steps = self.records['steps'][self._index(key)]
+        if len(steps) == 0:
+            return None
+        return parse_serialization(steps.decode())
+
+    def nearest(self, cg, k=5, chunk_size=256):
+        """
+        Finds the `k` colorgrades in the pack closest to the given one (by root mean square difference).
+        Returns a list of (index, name, distance), closest first, with distances for colors in [0,1].
+        The pack is compared a chunk of records at a time.
+        """
+        n_records = len(self)
+        if n_records == 0:
+            return []
+        target = process_colorgrade(resample_colorgrade(cg, self.size)).transpose(1,0,2).astype(np.int32)
+
+        images = self.records['image']
+        sq_dists = np.empty(n_records)
+        for start in range(0, n_records, chunk_size):
+            diff = images[start:start+chunk_size].astype(np.int32) - target
+            sq_dists[start:start+chunk_size] = np.einsum('nhwc,nhwc->n', diff, diff)
+
+        k = min(k, n_records)
+        best = np.argpartition(sq_dists, k - 1)[:k]
+        best = best[np.argsort(sq_dists[best], kind='stable')]
+        rms = np.sqrt(sq_dists[best] / target.size) / 255
+        return [(int(i), self.name(i), float(d)) for i, d in zip(best, rms)]
+
+if __name__ == '__main__':
+    import argparse
+    from colorgrade_io import decode_png, encode_png, read_lut_file
+
+    parser = argparse.ArgumentParser(description="Manage a pack file of colorgrades")
+    parser.add_argument('pack', help="the pack file")
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help="add colorgrade images or LUTs, named by their paths without the extension")
+    add.add_argument('files', nargs='+')
+    add.add_argument('--relative-to', default='.', help="folder the names are relative to")
+    commands.add_parser('list', help="list the colorgrades in the pack")
+    nearest = commands.add_parser('nearest', help="find the colorgrades closest to the given one")
+    nearest.add_argument('file')
+    nearest.add_argument('-k', type=int, default=5)
+    extract = commands.add_parser('extract', help="save a colorgrade from the pack as an image")
+    extract.add_argument('name')
+    extract.add_argument('output')
+    args = parser.parse_args()
+
+    def read_file(path):
+        with open(path, 'rb') as f:
+            return read_lut_file(path, f.read())
+
+    if args.command == 'add':
+        pack = LUTPack.open_or_create(args.pack)
+        items = []
+        for path in args.files:
+            name = os.path.splitext(os.path.relpath(path, args.relative_to))[0].replace(os.sep, '/')
+            items.append((name, read_file(path), None))
+        pack.extend(items)
+        print(f"added {len(items)} colorgrades, {len(pack)} in the pack")
+
+    elif args.command == 'list':
+        pack = LUTPack(args.pack)
+        for i, name in enumerate(pack.names()):
+            print(f"{i:6d}  {name}")
+
+    elif args.command == 'nearest':
+        pack = LUTPack(args.pack)
+        for i, name, distance in pack.nearest(read_file(args.file), k=args.k):
+            print(f"{255 * distance:8.2f}  {name}")
+
+    elif args.command == 'extract':
+        pack = LUTPack(args.pack)
+        with open(args.output, 'wb') as f:
+            f.write(encode_png(pack.get_image(args.name)))
@@ -0,0 +1,141 @@
+"""
+Saving and loading lists of steps.
+
+Pipelines are stored as versioned JSON:
+    {"format": "celeste-colorgrade-pipeline", "version": 1, "steps": [{"type": ..., "params": {...}}, ...]}
+The compact form (for share links) is the same data with default-valued parameters left out,
+compressed and encoded as URL-safe base64 after a short prefix.
+Exports from older versions (a Python repr of the list of steps) are still accepted.
+"""
+
+import ast
+import base64
+import json
+import zlib
+from colorgrade_steps import process_step_types
+
+FORMAT_NAME = 'celeste-colorgrade-pipeline'
+FORMAT_VERSION = 1
+COMPACT_PREFIX = 'cg1.'
+
+# Allowed parameters and their defaults for each step type, filled in as needed
+_step_schemas = dict()
+
+def get_step_schema(name):
+    """
+    Returns a dictionary of the allowed parameters of the given step type and their default values
+    """
+    if name not in _step_schemas:
+        if name not in process_step_types:
+            raise ValueError(f"unknown step type '{name}'")
+        step = process_step_types[name](0, None, name)
+        schema = dict(step.arguments())
+        if step.has_input():
+            schema['which-step'] = '-1'
+        _step_schemas[name] = schema
+
+    return _step_schemas[name]
+
+def validate_steps(ser_list):
+    """
+    Checks that a list of (type, params) steps is valid, raising a ValueError if not.
+    Returns the list, with any missing params filled in with their defaults.
+    """
+    if not isinstance(ser_list, (list, tuple)):
+        raise ValueError("steps must be a list")
+
+    result = []
+    for i, item in enumerate(ser_list, start=1):
+        try:
+            name, params = item
+        except (TypeError, ValueError):
+            raise ValueError(f"step {i} must be a (type, params) pair") from None
+        if not isinstance(name, str):
+            raise ValueError(f"step {i} has an invalid type")
+        if not isinstance(params, dict):
+            raise ValueError(f"step {i} has invalid parameters")
+
+        schema = get_step_schema(name)
+        for key, value in params.items():
+            if key not in schema:
+                raise ValueError(f"step {i} ({name}) has unknown parameter '{key}'")
+            if not isinstance(value, str):
+                raise ValueError(f"parameter '{key}' of step {i} ({name}) must be a string")
+
+        result.append((name, {**schema, **params}))
+
+    return result
+
+def to_document(ser_list, omit_defaults=False):
+    """
+    Returns the JSON-compatible document for a list of steps
+    """
+    steps = []
+    for name, params in ser_list:
+        if omit_defaults:
+            schema = get_step_schema(name)
+            params = {k: v for k, v in params.items() if schema.get(k) != v}
+        steps.append({'type': name, 'params': params})
+
+    return {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'steps': steps}
+
+def from_document(document):
+    """
+    Reads a list of steps from a JSON document, migrating older versions if needed
+    """
+    if not isinstance(document, dict) or document.get('format') != FORMAT_NAME:
+        raise ValueError("not a colorgrade pipeline")
+    version = document.get('version')
+    if not isinstance(version, int) or version < 1:
+        raise ValueError(f"invalid pipeline version {version!r}")
+    if version > FORMAT_VERSION:
+        raise ValueError(f"pipeline version {version} is newer than this version of the generator supports")
+
+    steps = document.get('steps')
+    if not isinstance(steps, list):
+        raise ValueError("steps must be a list")
+    try:
+        ser_list = [(step['type'], step['params']) for step in steps]
+    except (TypeError, KeyError):
+        raise ValueError("each step needs a type and params") from None
+
+    return validate_steps(ser_list)
+
+def to_json(ser_list, indent=None):
+    """
+    Serializes a list of steps as JSON text
+    """
+    return json.dumps(to_document(ser_list), indent=indent)
+
+def to_compact(ser_list):
+    """
+    Serializes a list of steps as a short URL-safe string
+    """
+    text = json.dumps(to_document(ser_list, omit_defaults=True), separators=(',', ':'))
+    encoded = base64.urlsafe_b64encode(zlib.compress(text.encode(), 9))
+    return COMPACT_PREFIX + encoded.decode().rstrip('=')
+
+def parse_serialization(text):
+    """
+    Reads a list of steps from any of the supported forms:
+    JSON, the compact form, or the Python repr used by older versions
+    """
+    text = text.strip()
+
+    if text.startswith(COMPACT_PREFIX):
+        encoded = text[len(COMPACT_PREFIX):]
+        try:
+            data = zlib.decompress(base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+        except Exception as e:
+            raise ValueError("corrupted compact pipeline") from e
+        return from_document(json.loads(data))
+
+    if text.startswith('{'):
+        return from_document(json.loads(text))
+
+    # Older versions exported a repr() of the list of steps; read it without evaluating any code
+    try:
+        ser_list = ast.literal_eval(text)
+    except (ValueError, SyntaxError) as e:
+        raise ValueError("unrecognized pipeline format") from e
+    return validate_steps(ser_list)
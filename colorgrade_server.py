@@ -0,0 +1,222 @@
+"""
+A local server for development: serves the page and its files like `python -m http.server 4000`,
+and also renders colorgrades from steps given in the request:
+    GET  /render?steps=<exported steps>&size=16&format=png
+    POST /render?size=16&format=png     (with the exported steps as the body)
+Steps can be in any form the page exports (JSON or the compact form used by share links).
+The format is `png` (the image Celeste uses), `cube` or `hald`.
+
+Each step is limited to `DEFAULT_STEP_BUDGET`; steps over it give a 400 error rather than tying up the server.
+The module bundle the page loads (see build_bundle.py) is rebuilt whenever it's requested
+and doesn't match the modules, so the page never runs stale code while developing.
+Results are cached, and sent with an ETag of their contents,
+so asking again for a colorgrade that hasn't changed gets a 304 Not Modified.
+
+Run it from the repository's folder:
+    python colorgrade_server.py --port 4000 --lut film.cube=luts/film.cube
+"""
+
+import hashlib
+import http.server
+import os
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from colorgrade_core import *
+from colorgrade_engine import *
+from colorgrade_io import encode_png, format_cube, colorgrade_to_hald, read_lut_file
+from build_bundle import BUNDLE_PATH, build_bundle
+
+RENDER_FORMATS = {
+    'png': 'image/png',
+    'cube': 'text/plain',
+    'hald': 'image/png',
+}
+MAX_RENDER_SIZE = 64
+
+class RenderCache:
+    """
+    Rendered files by request, shared by all of the server's threads, dropping the least recently used first.
+    Renders run on a pool of worker threads; identical requests made while one is
+    being rendered wait for that render rather than starting another.
+    """
+    def __init__(self, max_bytes=64 << 20, max_workers=None):
+        self.max_bytes = max_bytes
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get(self, key, render):
+        """
+        Returns (etag, data, whether it was cached) for the key, calling `render()` on a worker to make the data if needed
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry + (True,)
+
+            future = self._pending.get(key)
+            if future is None:
+                self.misses += 1
+                future = self.pool.submit(self._render, key, render)
+                self._pending[key] = future
+
+        return future.result() + (False,)
+
+    def _render(self, key, render):
+        try:
+            data = render()
+            entry = ('"' + hashlib.sha256(data).hexdigest()[:32] + '"', data)
+            with self._lock:
+                self._add(key, entry)
+            return entry
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _add(self, key, entry):
+        if len(entry[1]) > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.cache_bytes += len(entry[1])
+        while self.cache_bytes > self.max_bytes:
+            _, (_, dropped) = self._entries.popitem(last=False)
+            self.cache_bytes -= len(dropped)
+
+def render_file(ser_list, size=16, file_format='png', budget=DEFAULT_STEP_BUDGET):
+    """
+    Renders the serialized steps as the contents of a file in one of the `RENDER_FORMATS`
+    """
+    cg = render_pipeline(ser_list, size=size, budget=budget)
+    if file_format == 'png':
+        return encode_png(process_colorgrade(cg).transpose(1,0,2))
+    elif file_format == 'cube':
+        return format_cube(cg, title='Celeste colorgrade').encode()
+    elif file_format == 'hald':
+        return encode_png(colorgrade_to_hald(cg))
+    raise ValueError(f"unknown format '{file_format}'")
+
+def parse_render_request(query, body=None):
+    """
+    Reads the steps, size and format of a render request from its query string (and body, for POST).
+    Returns (serialized steps, size, format, cache key).
+    """
+    from colorgrade_serialization import parse_serialization, to_json
+
+    params = urllib.parse.parse_qs(query, keep_blank_values=True)
+    text = body if body is not None else params.get('steps', [''])[0]
+    if len(text.strip()) == 0:
+        raise ValueError("no steps given")
+    ser_list = parse_serialization(text)
+
+    try:
+        size = int(params.get('size', ['16'])[0])
+    except ValueError as e:
+        raise ValueError("invalid size") from e
+    if not 2 <= size <= MAX_RENDER_SIZE:
+        raise ValueError(f"size must be between 2 and {MAX_RENDER_SIZE}")
+    file_format = params.get('format', ['png'])[0]
+    if file_format not in RENDER_FORMATS:
+        raise ValueError(f"unknown format '{file_format}'")
+
+    # The same steps always give the same result, however they were written
+    return ser_list, size, file_format, (to_json(ser_list), size, file_format)
+
+def make_handler(cache, directory):
+    """
+    Returns a request handler class serving files from `directory` and renders through `cache`
+    """
+    bundle_lock = threading.Lock()
+    
+    class RenderRequestHandler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == '/' + BUNDLE_PATH:
+                with bundle_lock:
+                    build_bundle(directory)
+            if url.path != '/render':
+                return super().do_GET()
+            self.respond_render(url.query)
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != '/render':
+                self.send_error(404)
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            self.respond_render(url.query, self.rfile.read(length).decode('utf-8', errors='replace'))
+
+        def respond_render(self, query, body=None):
+            try:
+                ser_list, size, file_format, key = parse_render_request(query, body)
+                etag, data, cached = cache.get(key, lambda: render_file(ser_list, size, file_format))
+            except ValueError as e:
+                self.send_error(400, explain=str(e))
+                return
+
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', RENDER_FORMATS[file_format])
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', etag)
+            # Clients check back each time, and get a 304 if nothing changed
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('X-Render-Cache', 'hit' if cached else 'miss')
+            self.end_headers()
+            self.wfile.write(data)
+
+    return RenderRequestHandler
+
+def make_server(port=4000, host='127.0.0.1', directory=None, max_workers=None, cache_bytes=64 << 20):
+    """
+    Creates the server (call `serve_forever()` on it); files are served from `directory`, by default this file's folder
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+    cache = RenderCache(max_bytes=cache_bytes, max_workers=max_workers)
+    server = http.server.ThreadingHTTPServer((host, port), make_handler(cache, directory))
+    server.render_cache = cache
+    return server
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the page, and render colorgrades from steps on request")
+    parser.add_argument('--port', type=int, default=4000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--workers', type=int, default=None, help="number of colorgrades rendered at once")
+    parser.add_argument('--cache-mb', type=int, default=64, help="memory for cached results")
+    parser.add_argument('--lut', action='append', default=[], metavar='NAME=PATH',
+                        help="a LUT for Import LUT steps to use (can be repeated)")
+    args = parser.parse_args()
+
+    for lut in args.lut:
+        name, _, path = lut.partition('=')
+        with open(path, 'rb') as f:
+            imported_luts[name] = read_lut_file(name, f.read())
+
+    server = make_server(args.port, args.host, max_workers=args.workers, cache_bytes=args.cache_mb << 20)
+    print(f"serving on http://{args.host}:{args.port}/ (renders at /render)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.render_cache.pool.shutdown()
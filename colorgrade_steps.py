@@ -3,8 +3,13 @@ Defines classes for interfacing between the HTML and
 applying colorgrade effects.
 """
 
+from collections import namedtuple
 from colorgrade_core import *
-from js import document
+try:
+    from js import document
+except ImportError:
+    # Not running in the browser; steps can still be evaluated from their parameters
+    document = None
 
 ### Utility functions
 def parse_arguments_from_element(element, ids):
@@ -55,25 +60,82 @@ def add_input_field(parent, name, label, value, size=4, **kwargs):
 def add_input_field_args(parent, name, label, args, **kwargs):
     add_input_field(parent, name, label, args[name], **kwargs)
 
+def add_select_field(parent, name, label, value, options):
+    """
+    Adds a drop-down list; `options` is a list of (value, text) pairs
+    """
+    parent.appendChild(create_element_with_tags(
+        "label", _for=name, text=label
+    ))
+    select = create_element_with_tags("select", name=name, id=name)
+    for option_value, text in options:
+        option = create_element_with_tags("option", value=option_value, text=text)
+        if option_value == value:
+            option.setAttribute("selected", "")
+        select.appendChild(option)
+    parent.appendChild(select)
+
+# Color spaces palettizing steps can find the closest colors in
+COLOR_SPACE_OPTIONS = [('rgb', 'RGB'), ('oklab', 'OKLab'), ('lab', 'CIELAB')]
+
+# How a step that needs to know something about all of its input colors can still be run a part at a time:
+# `summarize(colors, start)` is applied to runs of the input colors (flattened to (m,3), starting at index `start`),
+# `combine` merges the list of their results, and `kernel_from_summary` gives the kernel for the whole input
+Reduction = namedtuple('Reduction', ['summarize', 'combine', 'kernel_from_summary'])
+
+# Rough estimate of what a step needs: the most memory it uses at once,
+# and the number of simple operations on array elements it does
+StepCost = namedtuple('StepCost', ['bytes', 'operations'])
+
+# Bytes of one color
+COLOR_BYTES = 3 * 8
+
 ### Abstract class
 
 class ColorgradeProcessStep:
     """
     Template class for a colorgrade processing step.
     """
-    def __init__(self, process_id, element, process_type_internal):
+    # Whether `do_processing` also works when the colorgrades have an extra leading axis
+    # for a batch of parameter sets (steps with a kernel always do)
+    supports_batches = False
+    # Whether `get_palette_output` can give the result as a palette and indices
+    palette_output = False
+    
+    def __init__(self, process_id, element, process_type_internal, params=None):
         """
-        Creates a new process step
+        Creates a new process step.
+        Steps without an html element (`element` is None) take their arguments from `params` instead.
         """
         self.process_id = process_id
         self.element = element
         self.process_type_internal = process_type_internal
+        self.params = dict() if params is None else params
+    
+    def get_arguments(self, ids):
+        """
+        Gets the current values of the arguments with the given ids, as a list of strings
+        """
+        if self.element is None:
+            args = {'which-step': '-1', **self.arguments(), **self.params}
+            return [args[id] for id in ids]
+        
+        return parse_arguments_from_element(self.element, ids)
     
     def get_target_index(self):
         """
         Returns the index of the input target
         """
-        return int(parse_arguments_from_element(self.element, ['which-step'])[0])
+        return int(self.get_arguments(['which-step'])[0])
+    
+    def get_input_indices(self):
+        """
+        Returns the indices of all of the previous colorgrades this step reads,
+        in the same form as `get_target_index` (negative indices count back from this step)
+        """
+        if self.has_input():
+            return [self.get_target_index()]
+        return []
     
     # this is not a good way of doing it but I don't want to deal with the alternatives
     def title(self):
@@ -95,19 +157,106 @@ class ColorgradeProcessStep:
         Add input fields to the element
         """
         raise NotImplementedError("")
+    
+    def numeric_arguments(self):
+        """
+        Return a dictionary of the arguments that are numbers, with the number of values 
+        (3 for colors, 1 otherwise) and the range of sensible values for each.
+        Used for automatically varying parameters.
+        """
+        return dict()
+    
+    def get_values(self):
+        """
+        Returns a dictionary of the current values of the numeric arguments,
+        as tuples for colors and floats otherwise
+        """
+        kinds = self.numeric_arguments()
+        values = self.get_arguments(kinds.keys())
         
-    def do_processing(self, cg_steps):
+        return {
+            k: parse_color(v) if kinds[k][0] == 3 else float(v)
+            for k, v in zip(kinds.keys(), values)
+        }
+    
+    def format_values(self, values):
+        """
+        Converts values of numeric arguments back into argument strings
+        """
+        kinds = self.numeric_arguments()
+        
+        return {
+            k: ', '.join(f'{c:.4f}' for c in v) if kinds[k][0] == 3 else f'{float(v):.4f}'
+            for k, v in values.items()
+        }
+    
+    def kernel_from_values(self, values):
+        """
+        For steps with numeric arguments, return the kernel (see `get_kernel`) for the given values.
+        Values can also be arrays that broadcast against the colors, to evaluate several at once.
+        """
         raise NotImplementedError("")
+    
+    def get_kernel(self):
+        """
+        For steps that act on each color independently, return a function applying the step
+        to an array of colors with shape (..., 3); otherwise return None.
+        """
+        if len(self.numeric_arguments()) > 0:
+            return self.kernel_from_values(self.get_values())
+        return None
+        
+    def get_reduction(self, n_points):
+        """
+        For steps that act on each color independently once something is known about
+        all `n_points` of the input colors (such as their range), return a `Reduction`;
+        otherwise return None.
+        """
+        return None
+        
+    def estimate_cost(self, n_points):
+        """
+        Return a `StepCost` for running the step on a colorgrade with `n_points` colors.
+        By default assumes a handful of temporary arrays the size of the colorgrade.
+        """
+        return StepCost(bytes=8 * COLOR_BYTES * n_points, operations=100 * n_points)
+        
+    def get_palette_output(self, cg_steps):
+        """
+        For steps whose result has only a few distinct colors, return it as (palette, indices):
+        an (n,3) array of colors, and an integer array with the index into it for each pixel.
+        Otherwise return None.
+        """
+        return None
+    
+    def get_target_palette(self, cg_steps):
+        """
+        For steps that map each color of their input to the closest of a palette,
+        return (palette, color space the colors are compared in). Otherwise return None.
+        """
+        return None
+        
+    def do_processing(self, cg_steps):
+        """
+        Return the result of this step; by default applies its kernel to the input colorgrade
+        """
+        kernel = self.get_kernel()
+        if kernel is None:
+            raise NotImplementedError("")
+        
+        return kernel(cg_steps[self.get_target_index()])
         
     def serialize(self):
         """
         Returns a dictionary of all of the current fields
         """
-        args = self.arguments()
-        vals = parse_arguments_from_element(self.element, args.keys())
+        ids = list(self.arguments().keys())
+        if self.has_input():
+            ids.append('which-step')
+        vals = self.get_arguments(ids)
         
         return self.process_type_internal, {
-            k:v for k,v in zip(args.keys(), vals)
+            k:v for k,v in zip(ids, vals)
         }
 
 # Template version
@@ -133,6 +282,13 @@ class CopyThisOne(ColorgradeProcessStep):
         """
         args = {**self.arguments(), **parameters}
         raise NotImplementedError("")
+    
+    def get_kernel(self):
+        """
+        Return a function applying the step to an array of colors (..., 3) if it acts on each color independently;
+        then `do_processing` does not need to be overridden.
+        """
+        return None
         
     def do_processing(self, cg_steps):
         """
@@ -159,6 +315,12 @@ class CG8ValueRecolor(ColorgradeProcessStep):
             'magenta': 'FF00FF',
             'cyan': '00FFFF',
         }
+    
+    def numeric_arguments(self):
+        """
+        Return a dictionary of the numeric arguments, with their number of values and range
+        """
+        return {c: (3, 0., 1.) for c in self.arguments().keys()}
         
     def title(self):
         """String title"""
@@ -174,7 +336,7 @@ class CG8ValueRecolor(ColorgradeProcessStep):
         """
         args = {**self.arguments(), **parameters}
         
-        for i,c in enumerate(args.keys()):
+        for i,c in enumerate(self.arguments().keys()):
             # Line break if needed
             if (i%2)==0 and i>0:
                 element.appendChild(create_element_with_tags("br"))
@@ -183,14 +345,9 @@ class CG8ValueRecolor(ColorgradeProcessStep):
                 self.element, c, f' {c.capitalize()}: ', args[c], size=4
             )
         
-    def do_processing(self, cg_steps):
-        cg_in = cg_steps[self.get_target_index()]
-                
-        colors = parse_arguments_from_element(self.element, self.arguments().keys())
-        colors_scalar = [parse_color(c) for c in colors]
-        cg_out = linear_recolor(cg_in, colors_scalar)
-        
-        return cg_out
+    def kernel_from_values(self, values):
+        colors = [values[c] for c in self.arguments().keys()]
+        return lambda cg: linear_recolor(cg, colors)
 
 class CGSimpleRecolor(ColorgradeProcessStep):
     def arguments(self):
@@ -201,6 +358,15 @@ class CGSimpleRecolor(ColorgradeProcessStep):
             'black': '000000',
             'white': 'FFFFFF',
         }
+    
+    def numeric_arguments(self):
+        """
+        Return a dictionary of the numeric arguments, with their number of values and range
+        """
+        return {
+            'black': (3, 0., 1.),
+            'white': (3, 0., 1.),
+        }
         
     def title(self):
         """String title"""
@@ -216,19 +382,13 @@ class CGSimpleRecolor(ColorgradeProcessStep):
         """
         args = {**self.arguments(), **parameters}
         
-        for i,c in enumerate(args.keys()):
+        for i,c in enumerate(self.arguments().keys()):
             add_input_field(
                 self.element, c, f' {c.capitalize()}: ', args[c], size=4
             )
         
-    def do_processing(self, cg_steps):
-        cg_in = cg_steps[self.get_target_index()]
-        
-        colors = parse_arguments_from_element(self.element, ['black','white'])
-        colors_scalar = [parse_color(c) for c in colors]
-        cg_out = simple_recolor(cg_in, *colors_scalar)
-        
-        return cg_out
+    def kernel_from_values(self, values):
+        return lambda cg: simple_recolor(cg, values['black'], values['white'])
 
 class CGRecenterColors(ColorgradeProcessStep):
     def arguments(self):
@@ -255,14 +415,31 @@ class CGRecenterColors(ColorgradeProcessStep):
     def do_processing(self, cg_steps):
         cg_in = cg_steps[self.get_target_index()]
         return rescale_to_fill_range(cg_in)
+    
+    def get_reduction(self, n_points):
+        """
+        Finds the range of the colors, then rescales them
+        """
+        def combine(ranges):
+            min_cs, max_cs = zip(*ranges)
+            return np.min(min_cs, axis=0), np.max(max_cs, axis=0)
+        
+        return Reduction(
+            summarize=lambda colors, start: color_range(colors),
+            combine=combine,
+            kernel_from_summary=lambda color_range: (lambda cg: rescale_colors(cg, *color_range)),
+        )
         
 class CGFill(ColorgradeProcessStep):
+    supports_batches = True
+    palette_output = True
+    
     def arguments(self):
         """
         Return a dictionary of the input things and their default values
         """
         return dict(color='FFFFFF')
-        
+
     def title(self):
         """String title"""
         return "Fill"
@@ -280,14 +457,25 @@ class CGFill(ColorgradeProcessStep):
         
     def do_processing(self, cg_steps):
         color = parse_color(
-            parse_arguments_from_element(
-                self.element,
+            self.get_arguments(
+                ['color']
+            )[0]
+        )
+        # Match the size of the colorgrade being generated
+        return get_filled_colorgrade(color, size=cg_steps[0].shape[0])
+    
+    def get_palette_output(self, cg_steps):
+        color = parse_color(
+            self.get_arguments(
                 ['color']
             )[0]
         )
-        return get_filled_colorgrade(color)
+        size = cg_steps[0].shape[0]
+        return np.array([color], dtype=float), np.zeros((size, size, size), dtype=int)
 
 class CGIfElse(ColorgradeProcessStep):
+    supports_batches = True
+    
     def arguments(self):
         """
         Return a dictionary of the input things and their default values
@@ -298,7 +486,7 @@ class CGIfElse(ColorgradeProcessStep):
             'true-input': '-1',
             'false-input': '-1',
         }
-        
+
     def title(self):
         """String title"""
         return "If-Else"
@@ -326,8 +514,7 @@ class CGIfElse(ColorgradeProcessStep):
         """
         Return the result of this step
         """
-        condition, cond_idx, true_idx, false_idx = parse_arguments_from_element(
-            self.element,
+        condition, cond_idx, true_idx, false_idx = self.get_arguments(
             ['condition', 'cond-input', 'true-input', 'false-input']
         )
         cg_true = cg_steps[int(true_idx)]
@@ -335,6 +522,24 @@ class CGIfElse(ColorgradeProcessStep):
         cg_cond = cg_steps[int(cond_idx)]
         
         return if_else(cg_true, cg_false, cg_cond, condition)
+    
+    def estimate_cost(self, n_points):
+        """
+        Each operation in the condition makes an array the size of the colorgrade
+        """
+        _, n_operations = compile_expression(self.get_arguments(['condition'])[0], ('b', 'g', 'r'))
+        return StepCost(
+            bytes=(n_operations + 4) * COLOR_BYTES * n_points,
+            operations=(n_operations + 4) * n_points,
+        )
+    
+    def get_input_indices(self):
+        """
+        Returns the indices of the condition, true and false sources
+        """
+        return [
+            int(idx) for idx in self.get_arguments(['cond-input', 'true-input', 'false-input'])
+        ]
         
 class CGAdjustRGB(ColorgradeProcessStep):
     def arguments(self):
@@ -346,6 +551,16 @@ class CGAdjustRGB(ColorgradeProcessStep):
             'g-shift': '0.0',
             'b-shift': '0.0',
         }
+    
+    def numeric_arguments(self):
+        """
+        Return a dictionary of the numeric arguments, with their number of values and range
+        """
+        return {
+            'r-shift': (1, -20., 20.),
+            'g-shift': (1, -20., 20.),
+            'b-shift': (1, -20., 20.),
+        }
         
     def title(self):
         """String title"""
@@ -368,21 +583,9 @@ class CGAdjustRGB(ColorgradeProcessStep):
         element.appendChild(create_element_with_tags("br"))
         add_input_field_args(element, 'b-shift', ' B shift: ', args, size=4)
         
-    def do_processing(self, cg_steps):
-        """
-        Return the result of this step
-        """
-        cg_in = cg_steps[self.get_target_index()]
-        
-        shifts = [
-            float(val)
-            for val in parse_arguments_from_element(
-                self.element,
-                ['r-shift', 'g-shift', 'b-shift']
-            )
-        ]
-        
-        return adjust_rgb(cg_in, *shifts)
+    def kernel_from_values(self, values):
+        shifts = [values['r-shift'], values['g-shift'], values['b-shift']]
+        return lambda cg: adjust_rgb(cg, *shifts)
 
 class CGAdjustHSV(ColorgradeProcessStep):
     def arguments(self):
@@ -394,6 +597,16 @@ class CGAdjustHSV(ColorgradeProcessStep):
             's-shift': '0.0',
             'v-shift': '0.0',
         }
+    
+    def numeric_arguments(self):
+        """
+        Return a dictionary of the numeric arguments, with their number of values and range
+        """
+        return {
+            'h-shift': (1, -180., 180.),
+            's-shift': (1, -20., 20.),
+            'v-shift': (1, -20., 20.),
+        }
         
     def title(self):
         """String title"""
@@ -417,21 +630,55 @@ class CGAdjustHSV(ColorgradeProcessStep):
         add_input_field_args(element, 'v-shift', ' V shift: ', args, size=4)
         
         
-    def do_processing(self, cg_steps):
+    def kernel_from_values(self, values):
+        shifts = [values['h-shift'], values['s-shift'], values['v-shift']]
+        return lambda cg: adjust_hsv(cg, *shifts)
+
+class CGAdjustLab(ColorgradeProcessStep):
+    def arguments(self):
         """
-        Return the result of this step
+        Return a dictionary of the input things and their default values
         """
-        cg_in = cg_steps[self.get_target_index()]
+        return {
+            'l-shift': '0.0',
+            'a-shift': '0.0',
+            'b-shift': '0.0',
+        }
+    
+    def numeric_arguments(self):
+        """
+        Return a dictionary of the numeric arguments, with their number of values and range
+        """
+        return {
+            'l-shift': (1, -1., 1.),
+            'a-shift': (1, -0.5, 0.5),
+            'b-shift': (1, -0.5, 0.5),
+        }
         
-        shifts = [
-            float(val)
-            for val in parse_arguments_from_element(
-                self.element,
-                ['h-shift', 's-shift', 'v-shift']
-            )
-        ]
+    def title(self):
+        """String title"""
+        return "Adjust Lab"
+    
+    def has_input(self):
+        """boolean of whether it accepts a single previous step as input"""
+        return True
+    
+    def populate_html_element(self, element, **parameters):
+        """
+        Add input fields to the element (modify in-place).
+        Does not need to return anything.
+        """
+        args = {**self.arguments(), **parameters}
         
-        return adjust_hsv(cg_in, *shifts)
+        add_input_field_args(element, 'l-shift', ' L shift: ', args, size=4)
+        element.appendChild(create_element_with_tags("br"))
+        add_input_field_args(element, 'a-shift', ' a shift: ', args, size=4)
+        element.appendChild(create_element_with_tags("br"))
+        add_input_field_args(element, 'b-shift', ' b shift: ', args, size=4)
+        
+    def kernel_from_values(self, values):
+        shifts = [values['l-shift'], values['a-shift'], values['b-shift']]
+        return lambda cg: adjust_lab(cg, *shifts)
 
 class CGBrightnessContrast(ColorgradeProcessStep):
     def arguments(self):
@@ -442,6 +689,15 @@ class CGBrightnessContrast(ColorgradeProcessStep):
             'bright-shift': '0.0',
             'con-shift': '0.0',
         }
+    
+    def numeric_arguments(self):
+        """
+        Return a dictionary of the numeric arguments, with their number of values and range
+        """
+        return {
+            'bright-shift': (1, -20., 20.),
+            'con-shift': (1, -20., 20.),
+        }
         
     def title(self):
         """String title"""
@@ -462,21 +718,9 @@ class CGBrightnessContrast(ColorgradeProcessStep):
         add_input_field_args(element, 'con-shift', ' Contrast: ', args, size=4)
     
         
-    def do_processing(self, cg_steps):
-        """
-        Return the result of this step
-        """
-        cg_in = cg_steps[self.get_target_index()]
-        
-        shifts = [
-            float(val)
-            for val in parse_arguments_from_element(
-                self.element,
-                ['bright-shift', 'con-shift']
-            )
-        ]
-        
-        return brightness_contrast(cg_in, *shifts)
+    def kernel_from_values(self, values):
+        shifts = [values['bright-shift'], values['con-shift']]
+        return lambda cg: brightness_contrast(cg, *shifts)
 
 class CGCustomMap(ColorgradeProcessStep):
     def arguments(self):
@@ -509,26 +753,40 @@ class CGCustomMap(ColorgradeProcessStep):
         element.appendChild(create_element_with_tags("br"))
         add_input_field_args(element, 'new-b', ' New B: ', args, size=24)
         
-    def do_processing(self, cg_steps):
+    def get_kernel(self):
         """
-        Return the result of this step
+        Return a function applying the step to an array of colors
         """
-        cg_in = cg_steps[self.get_target_index()]
-        
-        expressions = parse_arguments_from_element(
-            self.element,
+        expressions = self.get_arguments(
             ['new-r', 'new-g', 'new-b']
         )
         
-        return custom_rgb_adjust(cg_in, *expressions)
+        return lambda cg: custom_rgb_adjust(cg, *expressions)
+    
+    def estimate_cost(self, n_points):
+        """
+        Each operation in the expressions makes an array the size of one channel of the colorgrade
+        """
+        n_operations = sum(
+            compile_expression(expression, ('b', 'g', 'r', 'shape'))[1]
+            for expression in self.get_arguments(['new-r', 'new-g', 'new-b'])
+        )
+        return StepCost(
+            bytes=(n_operations + 6) * 8 * n_points,
+            operations=(n_operations + 6) * n_points,
+        )
 
 class CGPalettize(ColorgradeProcessStep):
+    palette_output = True
+    
     def arguments(self):
         """
         Return a dictionary of the input things and their default values
         """
         return {
-            'colors': '000000; FFFFFF'
+            'colors': '000000; FFFFFF',
+            'space': 'rgb',
+            'blend': '1',
         }
         
     def title(self):
@@ -546,25 +804,152 @@ class CGPalettize(ColorgradeProcessStep):
         """
         args = {**self.arguments(), **parameters}
         add_input_field_args(element, 'colors', ' Colors: ', args, size=26)
+        element.appendChild(create_element_with_tags("br"))
+        add_select_field(element, 'space', ' Closest in: ', args['space'], COLOR_SPACE_OPTIONS)
+        element.appendChild(create_element_with_tags("br"))
+        add_input_field_args(element, 'blend', ' Blend nearest: ', args, size=3)
         
-    def do_processing(self, cg_steps):
+    def get_kernel(self):
         """
-        Return the result of this step
+        Return a function applying the step to an array of colors
         """
-        cg_in = cg_steps[self.get_target_index()]
+        colors, space, n_blend = self.get_palette()
         
-        color_string = parse_arguments_from_element(
-            self.element,
-            ['colors']
-        )[0].split(';')
+        if n_blend > 1:
+            return lambda cg: soft_palettize(cg, colors, k=n_blend, mode=space)
+        return lambda cg: palettize(cg, colors, mode=space)
+    
+    def get_palette_output(self, cg_steps):
+        colors, space, n_blend = self.get_palette()
+        
+        # Blended colors aren't from the palette
+        if n_blend > 1:
+            return None
+        return palettize_indices(cg_steps[self.get_target_index()], colors, mode=space)
+    
+    def get_target_palette(self, cg_steps):
+        colors, space, _ = self.get_palette()
+        return np.array(colors, dtype=float), space
+    
+    def estimate_cost(self, n_points):
+        """
+        The distances to every palette color are found a chunk of colors at a time
+        """
+        colors, _, n_blend = self.get_palette()
+        return palettize_cost(n_points, len(colors), soft=n_blend > 1)
+    
+    def get_palette(self):
+        """
+        Returns the list of colors, the color space to compare them in, and how many of the closest to blend
+        """
+        color_string, space, n_blend = self.get_arguments(
+            ['colors', 'space', 'blend']
+        )
         
         colors = [
-            parse_color(s.strip()) for s in color_string if len(s.strip()) > 0
+            parse_color(s.strip()) for s in color_string.split(';') if len(s.strip()) > 0
         ]
+        if space not in color_spaces:
+            raise ValueError(f"unknown color space '{space}'")
+        n_blend = int(n_blend)
+        if n_blend < 1:
+            raise ValueError("the number of colors to blend must be at least 1")
+        
+        return colors, space, n_blend
+
+def palettize_cost(n_points, n_colors, soft=False, chunk_size=1024):
+    """
+    Returns the `StepCost` of palettizing `n_points` colors to `n_colors` (see `palettize_indices`)
+    """
+    # The distances for a chunk, and the palettized colors
+    n_bytes = 2 * min(n_points, chunk_size) * n_colors * 8 + 4 * COLOR_BYTES * n_points
+    # The distances are mostly a matrix product, which goes much faster than other operations
+    operations = 2 * n_points * n_colors
+    if soft:
+        # Partitioning the distances, and blending the nearest colors
+        n_bytes += min(n_points, chunk_size) * n_colors * 8
+        operations *= 2
+    return StepCost(bytes=n_bytes, operations=operations)
+
+class CGGradientMap(ColorgradeProcessStep):
+    def arguments(self):
+        """
+        Return a dictionary of the input things and their default values
+        """
+        return {
+            'stops': '000000; FFFFFF',
+            'weights': '0.299, 0.587, 0.114',
+        }
+        
+    def title(self):
+        """String title"""
+        return "Gradient Map"
+    
+    def has_input(self):
+        """boolean of whether it accepts a single previous step as input"""
+        return True
+    
+    def populate_html_element(self, element, **parameters):
+        """
+        Add input fields to the element (modify in-place).
+        Does not need to return anything.
+        """
+        args = {**self.arguments(), **parameters}
+        add_input_field_args(element, 'stops', ' Colors: ', args, size=26)
+        element.appendChild(create_element_with_tags("br"))
+        add_input_field_args(element, 'weights', ' Luma weights: ', args, size=14)
         
-        return palettize(cg_in, colors)
+    def get_kernel(self):
+        """
+        Return a function applying the step to an array of colors
+        """
+        stops_string, weights_string = self.get_arguments(
+            ['stops', 'weights']
+        )
+        stops = parse_gradient_stops(stops_string)
+        
+        try:
+            weights = [float(w) for w in weights_string.split(',')]
+            assert len(weights) == 3
+        except Exception as e:
+            raise ValueError(f"invalid luma weights '{weights_string}'") from e
+        
+        return lambda cg: gradient_map(cg, stops, weights)
+
+def parse_gradient_stops(stops_string):
+    """
+    Parses a list of gradient stops separated by semicolons, each a color optionally followed by
+    `@` and its position from 0 to 1 (e.g. "000000; 802040@0.3; FFFFFF").
+    Stops without a position are spaced evenly between their neighbours.
+    Returns a tuple of (position, color).
+    """
+    parts = [s.strip() for s in stops_string.split(';') if len(s.strip()) > 0]
+    if len(parts) < 2:
+        raise ValueError("a gradient needs at least two colors")
+    
+    colors, positions = [], []
+    for part in parts:
+        color, _, position = part.partition('@')
+        colors.append(parse_color(color.strip()))
+        try:
+            positions.append(float(position) if len(position.strip()) > 0 else np.nan)
+        except ValueError as e:
+            raise ValueError(f"invalid gradient position '{position.strip()}'") from e
+    
+    # The ends default to 0 and 1, and the rest to evenly between the given positions
+    positions = np.array(positions)
+    if np.isnan(positions[0]):
+        positions[0] = 0.
+    if np.isnan(positions[-1]):
+        positions[-1] = 1.
+    known = np.nonzero(~np.isnan(positions))[0]
+    positions = np.interp(np.arange(len(positions)), known, positions[known])
+    
+    return tuple((float(p), c) for p, c in zip(positions, colors))
 
 class CGReduceColors(ColorgradeProcessStep):
+    palette_output = True
+    
     def arguments(self):
         """
         Return a dictionary of the input things and their default values
@@ -572,6 +957,7 @@ class CGReduceColors(ColorgradeProcessStep):
         return {
             'n-colors': '10',
             'seed': '97187',
+            'space': 'rgb',
         }
         
     def title(self):
@@ -591,6 +977,8 @@ class CGReduceColors(ColorgradeProcessStep):
         add_input_field_args(element, 'n-colors', ' # Colors: ', args, size=4)
         element.appendChild(create_element_with_tags("br"))
         add_input_field_args(element, 'seed', ' Random seed: ', args, size=8)
+        element.appendChild(create_element_with_tags("br"))
+        add_select_field(element, 'space', ' Closest in: ', args['space'], COLOR_SPACE_OPTIONS)
         
     def do_processing(self, cg_steps):
         """
@@ -598,13 +986,167 @@ class CGReduceColors(ColorgradeProcessStep):
         """
         cg_in = cg_steps[self.get_target_index()]
         
-        n_colors, seed = [
-            int(val)
-            for val in parse_arguments_from_element(
-                self.element,
-                ['n-colors', 'seed']
-            )
-        ]
+        n_colors, seed, space = self.get_settings()
+        
+        return reduce_colors(cg_in, n_colors, seed=seed, mode=space)
+    
+    def get_palette_output(self, cg_steps):
+        cg_in = cg_steps[self.get_target_index()]
+        
+        n_colors, seed, space = self.get_settings()
         
-        return reduce_colors(cg_in, n_colors, seed=seed)
+        return palettize_indices(cg_in, sample_colors(cg_in, n_colors, seed=seed), mode=space)
+    
+    def get_target_palette(self, cg_steps):
+        cg_in = cg_steps[self.get_target_index()]
+        n_colors, seed, space = self.get_settings()
+        return np.array(sample_colors(cg_in, n_colors, seed=seed), dtype=float), space
+    
+    def estimate_cost(self, n_points):
+        n_colors, _, _ = self.get_settings()
+        return palettize_cost(n_points, n_colors)
+    
+    def get_settings(self):
+        """
+        Returns the number of colors, the random seed and the color space to compare colors in
+        """
+        n_colors, seed, space = self.get_arguments(
+            ['n-colors', 'seed', 'space']
+        )
+        if space not in color_spaces:
+            raise ValueError(f"unknown color space '{space}'")
+        
+        return int(n_colors), int(seed), space
+    
+    def get_reduction(self, n_points):
+        """
+        Picks out the sampled colors, then palettizes to them
+        """
+        n_colors, seed, space = self.get_settings()
+        indices = sample_indices(n_points, n_colors, seed=seed)
+        
+        def summarize(colors, start):
+            which = np.nonzero((indices >= start) & (indices < start + len(colors)))[0]
+            return which, colors[indices[which] - start]
+        
+        def combine(samples):
+            palette = np.empty((n_colors, 3))
+            for which, colors in samples:
+                palette[which] = colors
+            return palette
+        
+        return Reduction(
+            summarize=summarize,
+            combine=combine,
+            kernel_from_summary=lambda palette: (lambda cg: palettize(cg, palette, mode=space)),
+        )
+
+
+# LUTs loaded from .cube files or Hald CLUT images, by name
+imported_luts = dict()
+
+class CGImportLUT(ColorgradeProcessStep):
+    supports_batches = True
+    
+    def arguments(self):
+        """
+        Return a dictionary of the input things and their default values
+        """
+        return {
+            'name': '',
+        }
+
+    def title(self):
+        """String title"""
+        return "Import LUT"
+    
+    def has_input(self):
+        """boolean of whether it accepts a single previous step as input"""
+        return False
+    
+    def populate_html_element(self, element, **parameters):
+        """
+        Add input fields to the element (modify in-place).
+        Does not need to return anything.
+        """
+        args = {**self.arguments(), **parameters}
+        add_input_field_args(element, 'name', ' LUT: ', args, size=26)
+        
+    def do_processing(self, cg_steps):
+        """
+        Return the result of this step
+        """
+        name = self.get_arguments(
+            ['name']
+        )[0]
+        
+        if name not in imported_luts:
+            raise ValueError(f"no LUT named '{name}' has been imported")
+        
+        # Resample to the size of the colorgrade being generated
+        return resample_colorgrade(imported_luts[name], size=cg_steps[0].shape[0])
+
+class CGInvert(ColorgradeProcessStep):
+    def arguments(self):
+        """
+        Return a dictionary of the input things and their default values
+        """
+        return {
+            'highlight': '',
+        }
+        
+    def title(self):
+        """String title"""
+        return "Invert"
+    
+    def has_input(self):
+        """boolean of whether it accepts a single previous step as input"""
+        return True
+    
+    def populate_html_element(self, element, **parameters):
+        """
+        Add input fields to the element (modify in-place).
+        Does not need to return anything.
+        """
+        args = {**self.arguments(), **parameters}
+        add_input_field_args(element, 'highlight', ' Non-invertible color: ', args, size=8)
+        
+    def do_processing(self, cg_steps):
+        """
+        Return the result of this step
+        """
+        cg_in = cg_steps[self.get_target_index()]
+        
+        highlight = self.get_arguments(['highlight'])[0].strip()
+        if len(highlight) == 0:
+            return invert_colorgrade(cg_in)
+        
+        # Mark the colors that can't be properly inverted
+        inverse, diagnostics = invert_colorgrade(cg_in, return_diagnostics=True)
+        inverse[diagnostics['non_invertible']] = parse_color(highlight)
+        return inverse
+    
+    def estimate_cost(self, n_points):
+        """
+        A local linear fit to the 8 nearest colors for each color, refined a few times
+        """
+        return StepCost(bytes=8 * 40 * COLOR_BYTES * n_points, operations=8 * 600 * n_points)
 
+# Process step classes, by their internal name
+process_step_types = {
+    '8-value-recolor': CG8ValueRecolor,
+    'simple-recolor': CGSimpleRecolor,
+    'recenter-colors': CGRecenterColors,
+    'fill': CGFill,
+    'if-else': CGIfElse,
+    'adjust-rgb': CGAdjustRGB,
+    'adjust-hsv': CGAdjustHSV,
+    'adjust-lab': CGAdjustLab,
+    'brightness-contrast': CGBrightnessContrast,
+    'palettize': CGPalettize,
+    'gradient-map': CGGradientMap,
+    'reduce-colors': CGReduceColors,
+    'custom': CGCustomMap,
+    'import-lut': CGImportLUT,
+    'invert': CGInvert,
+}
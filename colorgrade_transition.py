@@ -0,0 +1,140 @@
+"""
+Generates sequences of colorgrades going from one pipeline to another,
+for fading between colorgrades in a map.
+
+Can also be run as a script:
+    python colorgrade_transition.py start.txt end.txt 30 frames/
+where the start and end are lists of steps as exported from the page.
+"""
+
+import io
+import os
+import zipfile
+from colorgrade_core import *
+from colorgrade_engine import *
+from colorgrade_io import encode_png
+
+def can_interpolate(start_steps, end_steps):
+    """
+    Whether the two lists of steps only differ in their numeric arguments,
+    so the frames in between can be made by interpolating those.
+    Every step also has to support being evaluated for a batch of values.
+    """
+    if len(start_steps) != len(end_steps):
+        return False
+
+    for start, end in zip(start_steps, end_steps):
+        if start.process_type_internal != end.process_type_internal:
+            return False
+        if start.get_kernel() is None and not start.supports_batches:
+            return False
+
+        ids = [k for k in start.arguments().keys() if k not in start.numeric_arguments()]
+        if start.has_input():
+            ids.append('which-step')
+        if start.get_arguments(ids) != end.get_arguments(ids):
+            return False
+
+    return True
+
+def render_transition(start_ser, end_ser, n_frames, size=16, mode='auto'):
+    """
+    Renders `n_frames` colorgrades going from the serialized steps `start_ser` to `end_ser`,
+    both included, as an array of shape (n_frames, size, size, size, 3).
+
+    With `mode` 'interpolate', the numeric arguments of the steps are interpolated linearly
+    and the whole sequence is evaluated as one batch; this needs `can_interpolate`.
+    With 'blend', the two final colorgrades are mixed linearly instead.
+    'auto' interpolates when possible and blends otherwise.
+    """
+    start_steps = create_steps(start_ser)
+    end_steps = create_steps(end_ser)
+    t = np.linspace(0, 1, n_frames)
+
+    if mode == 'auto':
+        has_values = any(len(step.numeric_arguments()) > 0 for step in start_steps)
+        mode = 'interpolate' if has_values and can_interpolate(start_steps, end_steps) else 'blend'
+
+    if mode == 'interpolate':
+        if not can_interpolate(start_steps, end_steps):
+            raise ValueError("the pipelines differ in more than their numeric values, so can only be blended")
+
+        values = []
+        for start, end in zip(start_steps, end_steps):
+            start_values, end_values = start.get_values(), end.get_values()
+            values.append({
+                name: _lerp(np.asarray(start_values[name]), np.asarray(end_values[name]), t)
+                for name in start_values
+            })
+        frames = run_pipeline_batch(start_steps, values, get_default_colorgrade(size))
+        return np.array(frames)
+
+    elif mode == 'blend':
+        cg_start = run_pipeline(start_steps, size=size, fuse=True, compress=True)[-1]
+        cg_end = run_pipeline(end_steps, size=size, fuse=True, compress=True)[-1]
+        return _lerp(cg_start, cg_end, t)
+
+    raise ValueError(f"unknown transition mode '{mode}'")
+
+def _lerp(a, b, t):
+    """
+    Linear interpolation from a to b for each of the values in t, along a new first axis
+    """
+    t = t.reshape((-1,) + (1,) * a.ndim)
+    return a + t * (b - a)
+
+def frame_filenames(n_frames, prefix='colorgrade_'):
+    """
+    Returns the numbered file names for the frames, padded so they sort in order
+    """
+    width = max(2, len(str(n_frames - 1)))
+    return [f'{prefix}{i:0{width}d}.png' for i in range(n_frames)]
+
+def encode_frames(frames, prefix='colorgrade_'):
+    """
+    Yields (file name, PNG data) for each colorgrade in the sequence, as images usable in Celeste
+    """
+    for filename, cg in zip(frame_filenames(len(frames), prefix), frames):
+        yield filename, encode_png(process_colorgrade(cg).transpose(1,0,2))
+
+def write_frames(directory, frames, prefix='colorgrade_'):
+    """
+    Writes the colorgrades as numbered PNG images into the directory
+    """
+    os.makedirs(directory, exist_ok=True)
+    for filename, data in encode_frames(frames, prefix):
+        with open(os.path.join(directory, filename), 'wb') as f:
+            f.write(data)
+
+def frames_to_zip(frames, prefix='colorgrade_'):
+    """
+    Returns a zip archive of the colorgrades as numbered PNG images, as bytes
+    """
+    buffer = io.BytesIO()
+    # PNG data is already compressed
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for filename, data in encode_frames(frames, prefix):
+            archive.writestr(filename, data)
+    return buffer.getvalue()
+
+if __name__ == '__main__':
+    import argparse
+    from colorgrade_serialization import parse_serialization
+
+    parser = argparse.ArgumentParser(description="Render the colorgrades in between two pipelines as numbered PNG images")
+    parser.add_argument('start', help="file with the exported steps to start from")
+    parser.add_argument('end', help="file with the exported steps to end at")
+    parser.add_argument('frames', type=int, help="number of colorgrades, including the start and end")
+    parser.add_argument('directory', help="directory to write the images to")
+    parser.add_argument('--prefix', default='colorgrade_')
+    parser.add_argument('--mode', choices=['auto', 'interpolate', 'blend'], default='auto')
+    args = parser.parse_args()
+
+    with open(args.start) as f:
+        start = parse_serialization(f.read())
+    with open(args.end) as f:
+        end = parse_serialization(f.read())
+
+    frames = render_transition(start, end, args.frames, mode=args.mode)
+    write_frames(args.directory, frames, prefix=args.prefix)
+    print(f"wrote {len(frames)} colorgrades to {args.directory}")
@@ -0,0 +1,90 @@
+"""
+Random variations of the numeric arguments of a pipeline, rendered together
+so that they can be compared side by side and one of them picked.
+"""
+
+from colorgrade_core import *
+from colorgrade_engine import *
+from colorgrade_fit import get_free_parameters
+
+def sample_variations(ser_list, n_variants, strength=0.1, seed=0):
+    """
+    Returns the values of the numeric arguments for `n_variants` variations of the serialized steps,
+    in the form `run_pipeline_batch` takes: a dictionary for each step from argument names to arrays.
+    Each value is moved from its current one by a normal random amount with a standard deviation
+    of `strength` times its range, and kept within the range.
+    The first variation is the pipeline unchanged.
+    """
+    steps = create_steps(ser_list)
+    params = get_free_parameters(steps)
+    if len(params) == 0:
+        raise ValueError("the steps have no numeric arguments to vary")
+
+    rng = np.random.default_rng(seed)
+    values = [dict() for _ in steps]
+    for i, name, n_values, lo, hi in params:
+        current = np.atleast_1d(np.array(steps[i].get_values()[name], dtype=float))
+        varied = current + strength * (hi - lo) * rng.standard_normal((n_variants, n_values))
+        varied[0] = current
+        varied = np.clip(varied, lo, hi)
+        values[i][name] = varied if n_values > 1 else varied[:,0]
+
+    return values
+
+def variation_steps(ser_list, values, index):
+    """
+    Returns the serialized steps of one of the variations
+    """
+    steps = create_steps(ser_list)
+    varied = [(name, dict(params)) for name, params in ser_list]
+    for i, step_values in enumerate(values):
+        if len(step_values) > 0:
+            varied[i][1].update(steps[i].format_values({
+                name: v[index] for name, v in step_values.items()
+            }))
+    return varied
+
+def render_variations(ser_list, values, size=16):
+    """
+    Renders every variation, returning an array of shape (n_variants, size, size, size, 3).
+    They are evaluated as one batch when every step supports it, and one by one otherwise.
+    """
+    steps = create_steps(ser_list)
+    n_variants = len(next(v for step_values in values for v in step_values.values()))
+
+    if all(step.get_kernel() is not None or step.supports_batches for step in steps):
+        return np.array(run_pipeline_batch(steps, values, get_default_colorgrade(size)))
+
+    return np.stack([
+        run_pipeline(create_steps(variation_steps(ser_list, values, i)), size=size, fuse=True, compress=True)[-1]
+        for i in range(n_variants)
+    ])
+
+def variations_image(cgs, columns=4, gap=2):
+    """
+    Lays out the colorgrades (n, 16, 16, 16, 3) as their Celeste images in a grid, left to right then top to bottom,
+    with `gap` white pixels between them. Returns a uint8 image of shape (height, width, 3).
+    """
+    strips = process_colorgrade(cgs).transpose(0,2,1,3)
+    n, strip_height, strip_width = strips.shape[:3]
+    rows = -(-n // columns)
+
+    image = np.full(
+        (rows * (strip_height + gap) - gap, columns * (strip_width + gap) - gap, 3), 255, dtype=np.uint8
+    )
+    for i, strip in enumerate(strips):
+        y = (i // columns) * (strip_height + gap)
+        x = (i % columns) * (strip_width + gap)
+        image[y:y+strip_height, x:x+strip_width] = strip
+    return image
+
+def variation_at(x, y, n_variants, columns=4, gap=2, strip_height=16, strip_width=256):
+    """
+    Returns the index of the variation at pixel (x, y) of `variations_image`, or None if it's in a gap
+    """
+    column, x_in = divmod(int(x), strip_width + gap)
+    row, y_in = divmod(int(y), strip_height + gap)
+    index = row * columns + column
+    if x_in >= strip_width or y_in >= strip_height or column >= columns or index >= n_variants:
+        return None
+    return index